@@ -0,0 +1,301 @@
+'''
+Benchmarks of LazyDict operations against a plain dict.
+
+Every public operation is timed for each combination of dict size,
+fraction of entries that are stubs and resolver cost, and the same
+operation is timed on a plain dict holding the same items as a baseline.
+Each measurement is the best of several runs on a freshly built dict,
+followed by one run under tracemalloc to record the peak memory that
+operation allocates.
+
+Results are written as JSON so that runs can be compared:
+
+    PYTHONPATH=lib python bench/bench_lazydict.py --output new.json
+    PYTHONPATH=lib python bench/bench_lazydict.py --compare old.json new.json
+
+The default grid is small enough to run in a minute or two. Use
+--sizes 100,1000,10000,100000,1000000,10000000 for the full range.
+'''
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from lazydict import LazyDict, BatchResolver
+
+clock = time.perf_counter
+
+
+def resolver(key, cost):
+    if cost:
+        end = clock() + cost / 1e6
+        while clock() < end:
+            pass
+    return key
+
+
+def fetch(keys):
+    return dict((key, key) for key in keys)
+
+
+def build(impl, size, ratio, cost):
+    """
+    Returns a dict of size integer keys, the first size * ratio
+    of them stubs when impl is 'lazy'
+    """
+    if impl == 'dict':
+        return dict((i, i) for i in range(size))
+    stubs = int(size * ratio)
+    d = LazyDict((i, i) for i in range(stubs, size))
+    for i in range(stubs):
+        d.set_stub(i, resolver, cost)
+    return d
+
+
+def build_batch(impl, size, ratio, cost):
+    if impl == 'dict':
+        return build(impl, size, ratio, cost)
+    stubs = int(size * ratio)
+    batch = BatchResolver(fetch)
+    d = LazyDict((i, i) for i in range(stubs, size))
+    for i in range(stubs):
+        d.set_stub(i, batch)
+    return d
+
+
+def resolved(impl, size, ratio, cost):
+    d = build(impl, size, ratio, cost)
+    if impl == 'lazy':
+        d.resolve()
+    return d
+
+
+def op_contains(d, keys):
+    for key in keys:
+        key in d
+
+def op_missing_contains(d, keys):
+    for key in keys:
+        -1 - key in d
+
+def op_len(d, keys):
+    for key in keys:
+        len(d)
+
+def op_iter(d, keys):
+    for key in d:
+        pass
+
+def op_keys(d, keys):
+    for key in d.keys():
+        pass
+
+def op_getitem(d, keys):
+    for key in keys:
+        d[key]
+
+def op_get(d, keys):
+    for key in keys:
+        d.get(key)
+
+def op_get_missing(d, keys):
+    for key in keys:
+        d.get(-1 - key)
+
+def op_setitem(d, keys):
+    for key in keys:
+        d[key] = key
+
+def op_delitem(d, keys):
+    for key in keys:
+        del d[key]
+
+def op_pop(d, keys):
+    for key in keys:
+        d.pop(key)
+
+def op_setdefault(d, keys):
+    for key in keys:
+        d.setdefault(key, None)
+
+def op_items(d, keys):
+    for item in d.items():
+        pass
+
+def op_values(d, keys):
+    for value in d.values():
+        pass
+
+def op_update(d, keys):
+    d.update(dict((key, key) for key in keys))
+
+def op_copy(d, keys):
+    d.copy()
+
+def op_eq(d, keys):
+    d == d.copy()
+
+def op_set_stub(d, keys):
+    for key in keys:
+        d.set_stub(key, resolver, 0)
+
+def op_resolve(d, keys):
+    d.resolve()
+
+def op_get_many(d, keys):
+    d.get_many(keys)
+
+
+# name: (operation, builder, runs on a plain dict)
+OPERATIONS = {
+    'contains': (op_contains, build, True),
+    'contains_missing': (op_missing_contains, build, True),
+    'len': (op_len, build, True),
+    'iter': (op_iter, build, True),
+    'keys': (op_keys, build, True),
+    'getitem': (op_getitem, build, True),
+    'getitem_resolved': (op_getitem, resolved, True),
+    'get': (op_get, build, True),
+    'get_missing': (op_get_missing, build, True),
+    'setitem': (op_setitem, build, True),
+    'delitem': (op_delitem, build, True),
+    'pop': (op_pop, build, True),
+    'setdefault': (op_setdefault, build, True),
+    'items': (op_items, build, True),
+    'values': (op_values, build, True),
+    'update': (op_update, build, True),
+    'copy': (op_copy, build, True),
+    'eq': (op_eq, build, True),
+    'set_stub': (op_set_stub, build, False),
+    'resolve': (op_resolve, build, False),
+    'resolve_batch': (op_resolve, build_batch, False),
+    'get_many': (op_get_many, build, False),
+    'get_many_batch': (op_get_many, build_batch, False),
+}
+
+
+def measure(operation, builder, impl, size, ratio, cost, sample, repeat):
+    """
+    Returns the best time in seconds over repeat runs and the peak
+    memory in bytes allocated by one run
+    """
+    keys = sorted(random.Random(size).sample(range(size), min(size, sample)))
+    best = None
+    for i in range(repeat):
+        d = builder(impl, size, ratio, cost)
+        gc.collect()
+        start = clock()
+        operation(d, keys)
+        elapsed = clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+        del d
+    d = builder(impl, size, ratio, cost)
+    gc.collect()
+    tracemalloc.start()
+    operation(d, keys)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, len(keys)
+
+
+def run(ops, sizes, ratios, costs, sample, repeat, out=sys.stderr):
+    results = []
+    for name in ops:
+        operation, builder, baseline = OPERATIONS[name]
+        for size in sizes:
+            grid = [('lazy', ratio, cost) for ratio in ratios
+                    for cost in (costs if ratio else [0])]
+            if baseline:
+                grid.insert(0, ('dict', 0.0, 0))
+            for impl, ratio, cost in grid:
+                seconds, peak, count = measure(operation, builder, impl, size,
+                                               ratio, cost, sample, repeat)
+                results.append({
+                    'op': name, 'impl': impl, 'size': size,
+                    'stub_ratio': ratio, 'cost_us': cost,
+                    'seconds': seconds, 'keys': count,
+                    'peak_bytes': peak,
+                })
+                out.write('%-18s %-5s size=%-9d stubs=%-5s cost=%-5s '
+                          '%10.6fs %12d B\n' % (name, impl, size, ratio, cost,
+                                                seconds, peak))
+    return results
+
+
+def compare(old, new, tolerance):
+    """
+    Returns the measurements of new that are more than tolerance
+    times slower than the same measurement in old
+    """
+    def index(results):
+        return dict(((r['op'], r['impl'], r['size'], r['stub_ratio'],
+                      r['cost_us']), r) for r in results['results'])
+    before = index(old)
+    regressions = []
+    for key, result in index(new).items():
+        if key in before and \
+                result['seconds'] > before[key]['seconds'] * tolerance:
+            regressions.append((key, before[key]['seconds'],
+                                result['seconds']))
+    return sorted(regressions)
+
+
+def numbers(kind):
+    return lambda value: [kind(float(v)) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--ops', type=lambda v: v.split(','),
+                        default=sorted(OPERATIONS))
+    parser.add_argument('--sizes', type=numbers(int),
+                        default=[100, 10000, 100000])
+    parser.add_argument('--stub-ratios', type=numbers(float),
+                        default=[0.0, 0.5, 1.0])
+    parser.add_argument('--costs', type=numbers(int), default=[0, 10],
+                        help='resolver cost in microseconds')
+    parser.add_argument('--sample', type=int, default=10000,
+                        help='maximum number of keys per operation')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--tolerance', type=float, default=1.2)
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as fp:
+            old = json.load(fp)
+        with open(args.compare[1]) as fp:
+            new = json.load(fp)
+        regressions = compare(old, new, args.tolerance)
+        for key, before, after in regressions:
+            print('%s: %.6fs -> %.6fs (%.2fx)' % (
+                ' '.join(str(k) for k in key), before, after, after / before))
+        return 1 if regressions else 0
+
+    results = run(args.ops, args.sizes, args.stub_ratios, args.costs,
+                  args.sample, args.repeat)
+    document = {
+        'meta': {
+            'python': sys.version,
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(document, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+'''
+AsyncLazyDict is a LazyDict whose stubs may be resolved by coroutines.
+
+Stubs are registered with the same set_stub and set_resolver methods
+as in LazyDict. Resolvers may be coroutine functions or plain callables,
+and a BatchResolver may wrap a coroutine function as well.
+
+Stubs with async resolvers are resolved with the awaitable API, so that
+a slow resolver never blocks the event loop. Concurrent aget() calls for
+the same key share a single resolution.
+
+Example:
+
+    async def resolver(key, table=None):
+        print("resolving")
+        return await query(table, key)
+
+    d = AsyncLazyDict({'a': 1})
+    d.set_stub('b', resolver, table='items')
+
+    print(len(d))                    # 2
+    x = await d.aget('b')            # resolving
+    x2 = d['b']                      #
+    await d.aresolve(concurrency=10)
+
+AsyncLazyDict requires Python 3.6+.
+'''
+import asyncio
+import inspect
+from functools import partial
+
+from lazydict import LazyDict, BatchResolver, ResolveReport, Stub, \
+    _clock, _job_resolver
+
+__all__ = ["AsyncLazyDict",]
+
+
+def _is_async_stub(stub):
+    """
+    Returns True if the stub's resolver is a coroutine function
+    """
+    func = stub.func
+    if isinstance(func, BatchResolver):
+        func = func.func
+    return asyncio.iscoroutinefunction(func)
+
+
+class AsyncLazyDict(LazyDict):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncLazyDict, self).__init__(*args, **kwargs)
+        self._inflight = {}
+
+    def __missing__(self, key):
+        stub = self._get_stub(key)
+        if stub is not None and _is_async_stub(stub):
+            raise TypeError("%r has an async resolver, use aget()" % (key,))
+        return LazyDict.__missing__(self, key)
+
+    def _jobs(self, keys):
+        for job in LazyDict._jobs(self, keys):
+            if _is_async_stub(self._get_stub(job[0][0])):
+                raise TypeError("%r has an async resolver, use aresolve()"
+                                % (job[0][0],))
+            yield job
+
+    __marker = object()
+
+    async def aget(self, key, default=None):
+        """
+        Returns the value for key, awaiting its resolver if it is a stub
+        """
+        value = dict.get(self, key, self.__marker)
+        if value is not self.__marker:
+            return value
+        task = self._inflight.get(key)
+        if task is None:
+            stored = self._stubs.get(key)
+            if stored is None and self._keyspaces is not None and \
+                    self._keyspace(key) is not None:
+                # registered, so that it is resolved only once
+                stored = self._stubs[key] = self._get_stub(key)
+                self._shadowed.add(key)
+            if stored is None:
+                return default
+            task = asyncio.ensure_future(self._aresolve_key(key, stored))
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+
+    async def aresolve(self, concurrency=None, errors='raise'):
+        """
+        Resolves all stubs concurrently and returns a ResolveReport
+
+        At most concurrency resolutions run at the same time, and stubs
+        run after the stubs they depend on.
+        Stubs sharing a BatchResolver are resolved with one call per chunk.
+        Errors are handled as in LazyDict.resolve.
+        """
+        if errors not in ('raise', 'collect'):
+            raise ValueError("errors must be 'raise' or 'collect'")
+        report = ResolveReport()
+        keys = list(self._stubs)
+        if self._keyspaces is not None:
+            keys.extend(self._virtual_keys())
+        if not keys:
+            return report
+        semaphore = asyncio.Semaphore(concurrency or len(keys))
+
+        async def run(job_keys, batch, func):
+            async with semaphore:
+                try:
+                    if batch is None:
+                        await self.aget(job_keys[0])
+                        report.resolved.append(job_keys[0])
+                    else:
+                        result = await self._acall_job(job_keys, batch, func)
+                        self._store(job_keys, batch, result, report, errors)
+                except Exception as e:
+                    if errors == 'raise':
+                        raise
+                    report.failed.update((key, e) for key in job_keys)
+
+        for wave in self._graph(keys)[0] if self._deps else [keys]:
+            if report.failed:
+                wave = self._skip_failed(wave, report)
+            tasks = [asyncio.ensure_future(run(*job))
+                     for job in LazyDict._jobs(self, wave)]
+            if not tasks:
+                continue
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        return report
+
+    async def aitems(self):
+        """
+        Iterates over (key, value) pairs, resolving stubs as they are reached
+        """
+        for key in list(self):
+            value = await self.aget(key, self.__marker)
+            if value is not self.__marker:
+                yield key, value
+
+    async def avalues(self):
+        """
+        Iterates over values, resolving stubs as they are reached
+        """
+        async for key, value in self.aitems():
+            yield value
+
+    async def _acall(self, func):
+        if isinstance(func, Stub) and isinstance(func.func, BatchResolver):
+            # looked up alone, BatchResolver.__call__ would index the
+            # coroutine of the batch instead of its result
+            result = await self._acall(partial(func.func.func, [func.key]))
+            return result[func.key]
+        result = func()
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def _acall_job(self, keys, batch, func):
+        """
+        Awaits a resolution job through the failure policy, the memo cache,
+        the backing store and the cost model, like LazyDict._call
+        """
+        model = self._cost_model
+        if model is None:
+            return await self._acall_admitted(keys, batch, func)
+        start = _clock()
+        try:
+            return await self._acall_admitted(keys, batch, func)
+        finally:
+            model.observe(_job_resolver(batch, func),
+                          (_clock() - start) / len(keys))
+
+    async def _acall_admitted(self, keys, batch, func):
+        policy = self._failure_policy
+        if policy is None:
+            return await self._acall_memo(keys, batch, func)
+        keys, func = self._admit(keys, batch, func)
+        resolver = _job_resolver(batch, func)
+        try:
+            result = await self._acall_memo(keys, batch, func)
+        except Exception as e:
+            policy.record(resolver, keys, e)
+            raise
+        policy.record(resolver, keys)
+        return result
+
+    async def _acall_memo(self, keys, batch, func):
+        if self._memo is None:
+            return await self._acall_backed(keys, batch, func)
+        found, missing = self._from_memo(keys, batch, func)
+        if not missing:
+            return found if batch else found[keys[0]]
+        if batch is not None and len(missing) < len(keys):
+            func = partial(batch.func, missing)
+        result = await self._acall_backed(missing, batch, func)
+        self._to_memo(missing, batch, func, result)
+        if batch is None:
+            return result
+        found.update((k, result[k]) for k in missing if k in result)
+        return found
+
+    async def _acall_backed(self, keys, batch, func):
+        if self._backing is None:
+            return await self._acall(func)
+        found, missing = self._from_backing(keys)
+        if not missing:
+            return found if batch else found[keys[0]]
+        try:
+            if batch is None:
+                value = await self._acall(func)
+                self._to_backing(keys, None, value)
+                return value
+            result = await self._acall(partial(batch.func, missing))
+            self._to_backing(missing, batch, result)
+        finally:
+            self._release_backing(missing)
+        found.update((k, result[k]) for k in missing if k in result)
+        return found
+
+    async def _aresolve_dependencies(self, key):
+        """
+        Resolves the stubs the stub of key depends on, transitively
+        """
+        waves = self._graph([key])[0]
+        # key depends on all other keys of its graph, so it comes last
+        for wave in waves[:-1]:
+            await asyncio.gather(*[self.aget(k) for k in wave])
+
+    async def _aresolve_key(self, key, stored):
+        try:
+            if key in self._deps:
+                await self._aresolve_dependencies(key)
+            stub = self._get_stub(key)
+            value = await self._acall_job([key], None, stub)
+            if self._stubs.get(key) is stored:
+                self[key] = value
+            return value
+        finally:
+            del self._inflight[key]
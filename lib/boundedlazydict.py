@@ -0,0 +1,221 @@
+'''
+BoundedLazyDict is a LazyDict that keeps at most a fixed number
+of resolved stub values in memory.
+
+When the capacity is exceeded, a resolved entry chosen by the eviction
+policy is turned back into its original stub, so a later lookup resolves
+it again. Values set explicitly are never evicted and do not count
+towards the capacity. len(), `in` and iteration always report the full
+key set, whether its entries are currently resolved or not. get_many()
+and items() keep the values of a batch resolution until they have been
+returned, even if the batch is larger than the capacity.
+
+Example:
+
+    d = BoundedLazyDict()
+    d.set_capacity(1000, policy='lfu')
+    for id in ids:
+        d.set_stub(id, load_document)
+
+    x = d[ids[0]]                    # resolving
+    ...                              # ids[0] is evicted
+    print(ids[0] in d)               # True
+    x = d[ids[0]]                    # resolving
+
+'''
+from collections import OrderedDict
+
+from lazydict import LazyDict
+
+__all__ = ["BoundedLazyDict", "LRUPolicy", "LFUPolicy"]
+
+
+class LRUPolicy(object):
+    """
+    Evicts the least recently used key
+    """
+
+    def __init__(self):
+        self._keys = OrderedDict()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        self._keys[key] = None
+
+    def touch(self, key):
+        if key in self._keys:
+            self._keys.move_to_end(key)
+
+    def discard(self, key):
+        self._keys.pop(key, None)
+
+    def victim(self):
+        return next(iter(self._keys))
+
+
+class LFUPolicy(object):
+    """
+    Evicts the least frequently used key, the oldest one among equals
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._buckets = {}
+        self._min = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def add(self, key):
+        self._counts[key] = 0
+        self._buckets.setdefault(0, OrderedDict())[key] = None
+        self._min = 0
+
+    def touch(self, key):
+        count = self._counts.get(key)
+        if count is None:
+            return
+        self._unlink(key, count)
+        self._counts[key] = count + 1
+        self._buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def discard(self, key):
+        count = self._counts.pop(key, None)
+        if count is not None:
+            self._unlink(key, count)
+
+    def victim(self):
+        if self._min not in self._buckets:
+            self._min = min(self._buckets)
+        return next(iter(self._buckets[self._min]))
+
+    def _unlink(self, key, count):
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+
+
+class BoundedLazyDict(LazyDict):
+    policies = {'lru': LRUPolicy, 'lfu': LFUPolicy}
+    _capacity = None
+    _freezable = False
+    _holding = 0
+
+    def __init__(self, *args, **kwargs):
+        super(BoundedLazyDict, self).__init__(*args, **kwargs)
+        self._origins = {}
+        self._policy = LRUPolicy()
+        # resolved by get_many() or items() and not returned yet
+        self._held = set()
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        self._policy.touch(key)
+        return value
+
+    def __setitem__(self, key, item):
+        self._forget(key)
+        LazyDict.__setitem__(self, key, item)
+
+    def __delitem__(self, key):
+        self._forget(key)
+        LazyDict.__delitem__(self, key)
+
+    def clear(self):
+        self._origins.clear()
+        self._held.clear()
+        self._policy = self._policy.__class__()
+        LazyDict.clear(self)
+
+    def copy(self):
+        x = LazyDict.copy(self)
+        x.set_capacity(self._capacity, self._policy.__class__)
+        for key, stub in self._origins.items():
+            x._origins[key] = stub
+            x._policy.add(key)
+        return x
+
+    def get_many(self, keys, default=None):
+        keys = list(keys)
+        self._holding += 1
+        try:
+            return LazyDict.get_many(self, keys, default)
+        finally:
+            self._holding -= 1
+            self._release(keys)
+
+    def set_stub(self, key, rslv=None, *args, **kwargs):
+        self._forget(key)
+        LazyDict.set_stub(self, key, rslv, *args, **kwargs)
+
+    def set_capacity(self, capacity, policy='lru'):
+        """
+        Sets the maximum number of resolved stub values kept in memory.
+
+        policy is 'lru', 'lfu' or a policy class. None removes the bound.
+        """
+        if not isinstance(policy, type):
+            policy = self.policies[policy]
+        if not isinstance(self._policy, policy):
+            self._policy = policy()
+            for key in self._origins:
+                self._policy.add(key)
+        self._capacity = capacity
+        self._evict(0)
+
+    def _iter_resolving(self):
+        resolving = LazyDict._iter_resolving(self)
+        while True:
+            self._holding += 1
+            try:
+                key, value = next(resolving)
+            except StopIteration:
+                return
+            finally:
+                self._holding -= 1
+            self._release([key])
+            yield key, value
+
+    def _set_resolved(self, key, stub, value):
+        LazyDict._set_resolved(self, key, stub, value)
+        if stub is not None:
+            if self._holding:
+                self._held.add(key)
+            self._evict(1)
+            self._origins[key] = stub
+            self._policy.add(key)
+
+    def _forget(self, key):
+        self._held.discard(key)
+        if self._origins.pop(key, None) is not None:
+            self._policy.discard(key)
+
+    def _release(self, keys):
+        """
+        Lets the held keys among keys be evicted again, and evicts once
+        no key is held
+        """
+        self._held.difference_update(keys)
+        self._evict(0)
+
+    def _evict(self, room):
+        """
+        Turns resolved values back into stubs until room is left
+
+        Nothing is evicted while keys resolved by a batch are held until
+        they are returned, so that a chunk larger than the capacity is not
+        resolved again key by key.
+        """
+        if self._capacity is None or self._held:
+            return
+        while self._origins and len(self._policy) + room > self._capacity:
+            key = self._policy.victim()
+            self._policy.discard(key)
+            stub = self._origins.pop(key)
+            dict.__delitem__(self, key)
+            self._stubs[key] = stub
+            self.evictions += 1
@@ -0,0 +1,384 @@
+'''
+ConcurrentLazyDict is a LazyDict that can be shared between threads.
+
+Each stub is resolved at most once at a time: concurrent lookups of the
+same key wait for the one in-flight resolution and get its value, or its
+exception. Resolvers run without holding any lock.
+
+Bookkeeping is guarded by a set of lock stripes selected by the hash of
+the key, so misses on unrelated keys rarely share a lock, and lookups of
+resolved keys take the native dict path and no lock at all. The stripes
+guard every compound operation on the stub table, so correctness does not
+depend on the GIL.
+
+Example:
+
+    d = ConcurrentLazyDict()
+    d.set_stub('config', load_config)
+
+    # called from many threads, load_config runs once
+    x = d['config']
+
+resolve_async() resolves stubs on background threads and returns a WarmUp
+handle at once. Lookups block only on keys whose resolution is in flight,
+and resolve keys that have not been started yet right away.
+
+    warmup = d.resolve_async(max_workers=8)
+    x = d['config']                  # waits only if config is in flight
+    warmup.wait()
+
+'''
+import threading
+from collections import deque
+from functools import partial
+
+from lazydict import LazyDict, BatchResolver, _clock
+
+__all__ = ["ConcurrentLazyDict", "WarmUp"]
+
+
+class _Flight(object):
+    """
+    An in-flight resolution that other threads can wait on
+    """
+    __slots__ = ('stored', 'event', 'value', 'error')
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class WarmUp(object):
+    """
+    Handle of a background resolution started by resolve_async().
+
+    total is the number of stubs to resolve, failed maps the keys that
+    failed to their exceptions. Keys resolved by lookups while waiting
+    in the queue count as completed.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.completed = 0
+        self.failed = {}
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def progress(self):
+        """
+        Returns the number of completed stubs and the total number
+        """
+        return self.completed, self.total
+
+    def cancel(self):
+        """
+        Stops starting resolutions, those in flight are finished
+        """
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the warm-up is done or cancelled and its resolutions
+        in flight are finished, and returns False on timeout
+        """
+        return self._event.wait(timeout)
+
+    def _complete(self, keys, failed):
+        with self._lock:
+            self.completed += len(keys)
+            self.failed.update(failed)
+
+
+class ConcurrentLazyDict(LazyDict):
+    stripes = 64
+
+    def __init__(self, *args, **kwargs):
+        self._locks = [threading.Lock() for i in range(self.stripes)]
+        self._inflight = {}
+        super(ConcurrentLazyDict, self).__init__(*args, **kwargs)
+
+    def _lock(self, key):
+        return self._locks[hash(key) % self.stripes]
+
+    def __setitem__(self, key, item):
+        with self._lock(key):
+            dict.__setitem__(self, key, item)
+            if self._stubs.pop(key, None) is None and \
+                    self._keyspaces is not None:
+                self._shadow(key)
+
+    def __delitem__(self, key):
+        with self._lock(key):
+            LazyDict.__delitem__(self, key)
+
+    def __missing__(self, key):
+        if key in self._deps:
+            self._resolve_dependencies(key)
+        return self._resolve_one(key)
+
+    def set_stub(self, key, rslv=None, *args, **kwargs):
+        with self._lock(key):
+            LazyDict.set_stub(self, key, rslv, *args, **kwargs)
+
+    def clear(self):
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            LazyDict.clear(self)
+        finally:
+            for lock in self._locks:
+                lock.release()
+
+    def _resolve_wave(self, keys, report, errors='raise'):
+        batches = {}
+        for key in keys:
+            stub = self._get_stub(key)
+            if stub is not None and isinstance(stub.func, BatchResolver):
+                batches.setdefault(stub.func, []).append(key)
+                continue
+            start = _clock()
+            try:
+                value = self._resolve_one(key, False)
+            except Exception as e:
+                report.timings[key] = _clock() - start
+                if errors == 'raise':
+                    raise
+                report.failed[key] = e
+            else:
+                if value is not self.__marker:
+                    report.timings[key] = _clock() - start
+                    report.resolved.append(key)
+        for batch, batch_keys in batches.items():
+            for chunk in batch.chunks(batch_keys):
+                start = _clock()
+                failed = self._resolve_batch(chunk, batch, True)
+                elapsed = _clock() - start
+                report.timings.update((key, elapsed) for key in chunk)
+                if failed and errors == 'raise':
+                    raise next(iter(failed.values()))
+                report.failed.update(failed)
+                report.resolved.extend(k for k in chunk if k not in failed and
+                                       dict.__contains__(self, k))
+
+    def _claim_job(self, keys, batch, func):
+        own = [key for key in keys if self._claim(key)[2] is not None]
+        if batch is not None and len(own) < len(keys):
+            func = partial(batch.func, own)
+        return own, func
+
+    def _end_job(self, keys, failed):
+        for key in keys:
+            with self._lock(key):
+                flight = self._inflight.pop(key)
+                value = dict.get(self, key, self.__marker)
+            if value is self.__marker:
+                # failed, or dropped and left to the lookups waiting for it
+                flight.error = failed.get(key)
+            flight.value = value
+            flight.event.set()
+
+    def _set_resolved(self, key, stub, value):
+        with self._lock(key):
+            flight = self._inflight.get(key)
+            # keep explicit writes made while the resolver was running
+            if flight is not None and self._stubs.get(key) is not flight.stored:
+                return
+            dict.__setitem__(self, key, value)
+            if self._stubs.pop(key, None) is None and \
+                    self._keyspaces is not None:
+                self._shadow(key)
+
+    __marker = object()
+
+    def _resolve_one(self, key, required=True):
+        """
+        Resolves the stub of key, or waits for its in-flight resolution
+
+        If key is neither resolved nor stubbed, raises KeyError,
+        or returns the marker if not required.
+        """
+        value, flight, stub = self._claim(key)
+        if flight is None:
+            if value is self.__marker and required:
+                raise KeyError(key)
+            return value
+        if stub is None:
+            return self._wait(key, flight, required)
+        try:
+            value = self._call([key], None, stub)
+        except BaseException as e:
+            self._land(key, flight, error=e)
+            raise
+        self._land(key, flight, value)
+        return value
+
+    def _wait(self, key, flight, required=True):
+        """
+        Waits for the in-flight resolution of key and returns its value
+        """
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        if flight.value is self.__marker:
+            # dropped by resolve(), resolved here instead
+            return self._resolve_one(key, required)
+        return flight.value
+
+    def _claim(self, key):
+        """
+        Returns the value of key, its in-flight resolution and, if the
+        caller has just started it and must resolve it, its Stub
+
+        The value is the marker and the flight None if key is neither
+        resolved nor stubbed.
+        """
+        lock = self._lock(key)
+        with lock:
+            value = dict.get(self, key, self.__marker)
+            if value is not self.__marker:
+                return value, None, None
+            flight = self._inflight.get(key)
+            if flight is not None:
+                return self.__marker, flight, None
+            stored = self._stubs.get(key)
+            if stored is None and self._keyspaces is not None and \
+                    self._keyspace(key) is not None:
+                # registered, so that it is resolved only once
+                stored = self._stubs[key] = self._get_stub(key)
+                self._shadowed.add(key)
+            if stored is None:
+                return self.__marker, None, None
+            flight = self._inflight[key] = _Flight(stored)
+            return self.__marker, flight, self._get_stub(key)
+
+    def _land(self, key, flight, value=None, error=None):
+        """
+        Ends the resolution of key, storing its value unless it failed
+        """
+        with self._lock(key):
+            # keep explicit writes made while the resolver was running
+            if error is None and self._stubs.get(key) is flight.stored:
+                dict.__setitem__(self, key, value)
+                del self._stubs[key]
+            del self._inflight[key]
+        flight.value = value
+        flight.error = error
+        flight.event.set()
+
+    def _resolve_batch(self, keys, batch, wait=False):
+        """
+        Resolves the stubs of keys with one call of batch, except those
+        resolved or in flight already, and returns a dict of the keys
+        that failed and their exceptions
+
+        With wait, also waits for the keys in flight in other threads.
+        """
+        flights = {}
+        others = {}
+        for key in keys:
+            value, flight, stub = self._claim(key)
+            if stub is not None:
+                flights[key] = flight
+            elif flight is not None:
+                others[key] = flight
+        failed = {}
+        if flights:
+            keys = list(flights)
+            try:
+                result = self._call(keys, batch, partial(batch.func, keys))
+            except Exception as e:
+                result = {}
+                failed = dict.fromkeys(keys, e)
+            policy = self._failure_policy
+            for key in keys:
+                if key in result:
+                    self._land(key, flights[key], result[key])
+                    continue
+                error = failed.get(key)
+                if error is None:
+                    # left out of the call for its cached error
+                    error = policy is not None and policy.error(key) or \
+                        KeyError(key)
+                    failed[key] = error
+                self._land(key, flights[key], error=error)
+        if wait:
+            for key, flight in others.items():
+                try:
+                    self._wait(key, flight, False)
+                except Exception as e:
+                    failed[key] = e
+        return failed
+
+    def resolve_async(self, executor=None, max_workers=4, keys=None,
+                      where=None, resolver=None):
+        """
+        Starts resolving all stubs, or the selection of them described
+        in resolve(), in the background and returns a WarmUp handle.
+
+        Stubs are resolved by max_workers threads, in dependency order,
+        stubs sharing a BatchResolver one chunk per call. executor may
+        be a thread pool to run them on instead. A lookup of a key waits
+        for its resolution if it is in flight, and resolves it at once
+        if it has not been started, so no stub is resolved twice.
+        """
+        if keys is None:
+            keys = list(self._stubs)
+            if self._keyspaces is not None:
+                keys.extend(self._virtual_keys())
+        keys = [k for k in keys if self._is_stub(k) and
+                (where is None and resolver is None or
+                 self._selected(k, where, resolver))]
+        waves = self._graph(keys)[0]
+        jobs = deque()
+        for wave in waves:
+            jobs.extend(self._jobs(wave))
+        warmup = WarmUp(sum(len(job[0]) for job in jobs))
+        owned = executor is None
+        if owned:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        workers = [min(max_workers, len(jobs))]
+        if not workers[0]:
+            warmup._event.set()
+        for i in range(workers[0]):
+            executor.submit(self._warm, jobs, warmup, workers)
+        if owned:
+            executor.shutdown(wait=False)
+        return warmup
+
+    def _warm(self, jobs, warmup, workers):
+        """
+        Resolves jobs until there are none left or warmup is cancelled
+        """
+        try:
+            while not warmup.cancelled():
+                try:
+                    job_keys, batch, func = jobs.popleft()
+                except IndexError:
+                    break
+                failed = {}
+                try:
+                    for key in job_keys:
+                        if key in self._deps:
+                            self._resolve_dependencies(key)
+                    if batch is None:
+                        self._resolve_one(job_keys[0], False)
+                    else:
+                        failed = self._resolve_batch(job_keys, batch)
+                except Exception as e:
+                    failed = dict.fromkeys(job_keys, e)
+                warmup._complete(job_keys, failed)
+        finally:
+            with warmup._lock:
+                workers[0] -= 1
+                if not workers[0]:
+                    warmup._event.set()
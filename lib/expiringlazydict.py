@@ -0,0 +1,175 @@
+'''
+ExpiringLazyDict is a LazyDict whose resolved stubs expire.
+
+Each resolved stub keeps its original resolver. Once the value is older
+than its TTL, the next lookup runs the resolver again. TTLs can be set for
+the whole dict with set_ttl and for single stubs with set_stub_ttl.
+
+With stale_while_revalidate, a lookup of an expired value returns the old
+value immediately and refreshes it in the background, so readers never
+wait for the resolver once a value has been resolved for the first time.
+
+Example:
+
+    d = ExpiringLazyDict()
+    d.set_ttl(60, stale_while_revalidate=True)
+    d.set_stub('config', load_config)
+    d.set_stub_ttl('config', 300)
+
+    x = d['config']                  # resolving
+    ...                              # 5 minutes later
+    x = d['config']                  # old value, refreshing in background
+
+'''
+import threading
+import time
+
+from lazydict import LazyDict
+
+__all__ = ["ExpiringLazyDict",]
+
+
+class ExpiringLazyDict(LazyDict):
+    _ttl = None
+    _stale_while_revalidate = False
+    _executor = None
+    _retry = None
+    _freezable = False
+    clock = staticmethod(time.monotonic)
+
+    def __init__(self, *args, **kwargs):
+        super(ExpiringLazyDict, self).__init__(*args, **kwargs)
+        self._origins = {}
+        self._expires = {}
+        self._ttls = {}
+        self._refreshing = set()
+        self._refreshing_lock = threading.Lock()
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        expires = self._expires.get(key)
+        if expires is not None and expires <= self.clock():
+            if self._stale_while_revalidate:
+                self._refresh_later(key)
+            else:
+                value = self._refresh(key)
+        return value
+
+    def __setitem__(self, key, item):
+        self._forget(key)
+        LazyDict.__setitem__(self, key, item)
+
+    def __delitem__(self, key):
+        self._forget(key)
+        self._ttls.pop(key, None)
+        LazyDict.__delitem__(self, key)
+
+    def clear(self):
+        self._origins.clear()
+        self._expires.clear()
+        self._ttls.clear()
+        LazyDict.clear(self)
+
+    def copy(self):
+        x = LazyDict.copy(self)
+        x.set_ttl(self._ttl, self._stale_while_revalidate, self._executor,
+                  self._retry)
+        x._origins.update(self._origins)
+        x._expires.update(self._expires)
+        x._ttls.update(self._ttls)
+        return x
+
+    def set_stub(self, key, rslv=None, *args, **kwargs):
+        self._forget(key)
+        LazyDict.set_stub(self, key, rslv, *args, **kwargs)
+
+    def set_ttl(self, ttl, stale_while_revalidate=False, executor=None,
+                retry=None):
+        """
+        Sets the default number of seconds a resolved stub stays fresh.
+
+        With stale_while_revalidate, expired values are returned as they
+        are and refreshed in the background, on executor if given or
+        on a new daemon thread otherwise. After a failed background
+        refresh the stale value is served for retry more seconds, by
+        default its TTL, before it is refreshed again. None disables
+        expiry.
+
+        Refreshes go through the failure policy, memo cache and backing
+        store like first resolutions.
+        """
+        self._ttl = ttl
+        self._stale_while_revalidate = stale_while_revalidate
+        self._executor = executor
+        self._retry = retry
+
+    def set_stub_ttl(self, key, ttl):
+        """
+        Sets the number of seconds the stub of key stays fresh
+        once resolved, overriding the default TTL.
+        """
+        self._ttls[key] = ttl
+        if key in self._expires:
+            self._expire_in(key, ttl)
+
+    def expire(self, key):
+        """
+        Marks the resolved value of key as expired
+        """
+        if key in self._origins:
+            self._expires[key] = self.clock()
+
+    def _set_resolved(self, key, stub, value):
+        LazyDict._set_resolved(self, key, stub, value)
+        if stub is not None:
+            self._origins[key] = stub
+            self._expire_in(key, self._ttls.get(key, self._ttl))
+
+    def _expire_in(self, key, ttl):
+        if ttl is None:
+            self._expires.pop(key, None)
+        else:
+            self._expires[key] = self.clock() + ttl
+
+    def _forget(self, key):
+        self._origins.pop(key, None)
+        self._expires.pop(key, None)
+
+    def _refresh(self, key):
+        """
+        Runs the original resolver of key again and stores its value
+        """
+        stub = self._origins[key]
+        value = self._call([key], None, stub)
+        if self._origins.get(key) is stub:
+            dict.__setitem__(self, key, value)
+            self._expire_in(key, self._ttls.get(key, self._ttl))
+        return value
+
+    def _refresh_later(self, key):
+        with self._refreshing_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        if self._executor is not None:
+            self._executor.submit(self._background_refresh, key)
+        else:
+            thread = threading.Thread(target=self._background_refresh,
+                                      args=(key,))
+            thread.daemon = True
+            thread.start()
+
+    def _background_refresh(self, key):
+        stub = self._origins.get(key)
+        try:
+            self._refresh(key)
+        except Exception:
+            # the stale value is kept until the retry delay is over
+            if stub is not None and self._origins.get(key) is stub:
+                retry = self._retry
+                if retry is None:
+                    retry = self._ttls.get(key, self._ttl)
+                self._expire_in(key, retry)
+        finally:
+            with self._refreshing_lock:
+                self._refreshing.discard(key)
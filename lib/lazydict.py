@@ -22,82 +22,590 @@ Example:
     print(isinstance(x2, QueryValue) # True
 
 '''
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
 from functools import partial
-from collections import MutableMapping, ItemsView, ValuesView
+from itertools import chain
+try:
+    from collections.abc import MutableMapping, ItemsView, ValuesView
+except ImportError:
+    from collections import MutableMapping, ItemsView, ValuesView
+from collections import OrderedDict
+
+__all__ = ["LazyDict", "BatchResolver", "ResolveReport", "Stub",
+           "FailurePolicy", "CircuitOpenError", "Keyspace", "LazyOverlay",
+           "MemoCache", "CostModel"]
+
+
+class Stub(object):
+    """
+    A pending call of func(key, *args, **keywords).
+
+    Stubs are smaller than functools.partial objects and share their
+    args and keywords with other stubs registered with equal arguments,
+    so keywords must not be modified.
+    """
+    __slots__ = ('func', 'key', 'args', 'keywords')
+
+    def __init__(self, func, key, args=(), keywords=None):
+        self.func = func
+        self.key = key
+        self.args = args
+        self.keywords = keywords
+
+    def __call__(self):
+        if self.keywords:
+            return self.func(self.key, *self.args, **self.keywords)
+        return self.func(self.key, *self.args)
+
+    def __reduce__(self):
+        return (Stub, (self.func, self.key, self.args, self.keywords))
+
+
+# stored in place of a Stub of the default resolver without arguments
+_DEFAULT = object()
+
+
+class BatchResolver(object):
+    """
+    Wraps a callable that resolves many keys with a single call.
+
+    The callable takes a list of keys and returns a mapping from
+    each key to its value. Stubs registered with a BatchResolver
+    are grouped together by resolve(), items(), values() and get_many()
+    and resolved in chunks of at most chunk_size keys. They take no
+    arguments besides their key.
+    """
+    chunk_size = 1000
+
+    def __init__(self, func, chunk_size=None):
+        self.func = func
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+    def __call__(self, key):
+        return self.func([key])[key]
+
+    def chunks(self, keys):
+        """
+        Splits keys into lists of at most chunk_size elements
+        """
+        size = self.chunk_size or len(keys) or 1
+        for i in range(0, len(keys), size):
+            yield keys[i:i+size]
+
+
+class ResolveReport(object):
+    """
+    Outcome of a bulk resolution: the list of resolved keys, a dict
+    mapping failed keys to their exceptions and a dict mapping keys to
+    the seconds their resolution took. Keys resolved by one batch call
+    share its time. pending lists the stubs a budget left unresolved.
+    """
+
+    def __init__(self):
+        self.resolved = []
+        self.failed = {}
+        self.timings = {}
+        self.pending = []
+
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+def _timed(func):
+    """
+    Calls func and returns its result, its exception or None, and the
+    seconds it took
+    """
+    start = _clock()
+    try:
+        result = func()
+    except Exception as e:
+        return None, e, _clock() - start
+    return result, None, _clock() - start
+
+
+def _typed(token):
+    """
+    Returns token with the types of its items, so that equal tokens of
+    different types, like (1,), (True,) and (1.0,), are told apart
+    """
+    return token, tuple(_typed(item) if type(item) is tuple else type(item)
+                        for item in token)
+
+
+def _untraced(error):
+    """
+    Returns error without the traceback of its earlier raises, which every
+    raise of a cached exception would extend
+    """
+    with_traceback = getattr(error, 'with_traceback', None)
+    return with_traceback(None) if with_traceback is not None else error
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised instead of calling a resolver whose circuit breaker is open
+    """
+
+
+class FailurePolicy(object):
+    """
+    Decides when the stubs of failed resolutions are tried again.
+
+    The error of a failed stub is raised again without calling its
+    resolver for negative_ttl seconds, multiplied by backoff with every
+    further failure of the stub, up to max_ttl. After threshold failures
+    of one resolver in a row, its circuit breaker opens: its stubs fail
+    with CircuitOpenError for reset seconds, then a single call is let
+    through to probe whether the resolver has recovered.
+
+    Errors are cached by key, so a policy should only be shared between
+    dicts whose keys mean the same.
+    """
+    clock = staticmethod(getattr(time, 'monotonic', time.time))
+
+    def __init__(self, negative_ttl=1.0, backoff=2.0, max_ttl=60.0,
+                 threshold=5, reset=30.0):
+        self.negative_ttl = negative_ttl
+        self.backoff = backoff
+        self.max_ttl = max_ttl
+        self.threshold = threshold
+        self.reset = reset
+        self._errors = {}
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def admit(self, resolver, keys):
+        """
+        Returns the keys a resolver may be called for now.
+
+        Raises the cached error of the first key if none may be resolved,
+        or CircuitOpenError if the circuit breaker of resolver is open.
+        """
+        now = self.clock()
+        with self._lock:
+            allowed = [k for k in keys if k not in self._errors or
+                       self._errors[k][2] <= now]
+            if not allowed:
+                raise _untraced(self._errors[keys[0]][0])
+            breaker = self._breakers.get(resolver)
+            if breaker is not None and breaker[1] is not None:
+                if now < breaker[1]:
+                    raise CircuitOpenError("%s failed %d times in a row" %
+                                           (_resolver_name(resolver),
+                                            breaker[0]))
+                # half-open, block other calls while this one probes
+                breaker[1] = now + self.reset
+        return allowed
+
+    def record(self, resolver, keys, error=None):
+        """
+        Records the outcome of calling resolver for keys
+        """
+        now = self.clock()
+        with self._lock:
+            if error is None:
+                self._breakers.pop(resolver, None)
+                for key in keys:
+                    self._errors.pop(key, None)
+                return
+            breaker = self._breakers.setdefault(resolver, [0, None])
+            breaker[0] += 1
+            if breaker[0] >= self.threshold:
+                breaker[1] = now + self.reset
+            for key in keys:
+                failures = self._errors.get(key, (None, 0))[1] + 1
+                ttl = min(self.negative_ttl * self.backoff ** (failures - 1),
+                          self.max_ttl)
+                self._errors[key] = (error, failures, now + ttl)
+
+    def error(self, key):
+        """
+        Returns the cached error of key, or None
+        """
+        entry = self._errors.get(key)
+        return _untraced(entry[0]) if entry is not None else None
+
+    def forget(self, key):
+        """
+        Drops the cached error of key
+        """
+        with self._lock:
+            self._errors.pop(key, None)
+
+
+class MemoCache(object):
+    """
+    Memoizes resolver results across LazyDicts.
+
+    Entries are keyed by the resolver and the key, args and keywords of
+    a stub, so dicts sharing a cache resolve equal stubs once. Stubs of a
+    BatchResolver are memoized per key. Stubs with unhashable arguments
+    are not memoized.
+
+    The least recently used entries are evicted once there are more than
+    max_entries of them or their values take more than max_bytes, as
+    measured by sizeof.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None,
+                 sizeof=sys.getsizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, memo):
+        """
+        Returns the value memoized under memo, or raises KeyError
+        """
+        with self._lock:
+            try:
+                value = self._entries[memo][0]
+            except KeyError:
+                self.misses += 1
+                raise
+            self._entries.move_to_end(memo)
+            self.hits += 1
+        return value
+
+    def set(self, memo, value):
+        """
+        Memoizes value under memo, evicting old entries if over the bounds
+        """
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            old = self._entries.pop(memo, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[memo] = (value, size)
+            self.bytes += size
+            entries = self._entries
+            while len(entries) > 1 and (
+                    (self.max_entries is not None and
+                     len(entries) > self.max_entries) or
+                    (self.max_bytes is not None and
+                     self.bytes > self.max_bytes)):
+                self.bytes -= entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        Returns the counters of the cache as a dict
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class CostModel(object):
+    """
+    Estimates the seconds a resolver takes per key, as an exponentially
+    weighted moving average of its observed latencies with weight alpha.
+    Resolvers that were not observed yet are estimated at default seconds.
+    """
+
+    def __init__(self, default=0.001, alpha=0.2):
+        self.default = default
+        self.alpha = alpha
+        self._estimates = {}
+
+    def estimate(self, resolver):
+        return self._estimates.get(resolver, self.default)
+
+    def observe(self, resolver, seconds):
+        """
+        Records that resolver took seconds per key
+        """
+        old = self._estimates.get(resolver)
+        if old is not None:
+            seconds = old + self.alpha * (seconds - old)
+        self._estimates[resolver] = seconds
+
+
+def _memo_key(key, batch, func):
+    """
+    Returns the MemoCache key of key in a resolution job, or None if
+    it cannot be memoized
+    """
+    if batch is not None:
+        memo = (batch, key)
+    elif isinstance(func, Stub) and isinstance(func.func, BatchResolver):
+        # looked up alone, memoized like in a batch
+        memo = (func.func, key)
+    elif isinstance(func, Stub):
+        keywords = tuple(sorted(func.keywords.items())) \
+            if func.keywords else ()
+        memo = (func.func, key, _typed(func.args), _typed(keywords))
+    else:
+        return None
+    try:
+        hash(memo)
+    except TypeError:
+        return None
+    return memo
+
+
+def _job_resolver(batch, func):
+    """
+    Returns the resolver a resolution job calls
+    """
+    return batch if batch is not None else func.func
+
+
+class Keyspace(object):
+    """
+    A set of keys that are stubs of one resolver without being registered
+    one by one.
+
+    keys is a range, a set or frozenset, a sorted sequence such as an
+    array, or a predicate taking a key and returning whether it belongs
+    to the keyspace. Predicate keyspaces can not be counted or iterated.
+    """
+    __slots__ = ('keys', 'contains', 'func', 'args', 'keywords')
+
+    def __init__(self, keys, func=None, args=(), keywords=None):
+        self.keys = keys
+        self.func = func
+        self.args = args
+        self.keywords = keywords
+        if isinstance(keys, range):
+            self.contains = self._in_range
+        elif isinstance(keys, (set, frozenset)):
+            self.contains = keys.__contains__
+        elif callable(keys):
+            self.contains = keys
+        else:
+            self.contains = self._bisect
+
+    def _in_range(self, key):
+        # range falls back to a linear scan for other types
+        return isinstance(key, int) and key in self.keys
+
+    def _bisect(self, key):
+        keys = self.keys
+        try:
+            i = bisect_left(keys, key)
+        except TypeError:
+            return False
+        return i < len(keys) and keys[i] == key
+
+    def __len__(self):
+        if self.contains is self.keys:
+            raise TypeError("a predicate keyspace has no length")
+        return len(self.keys)
+
+    def __iter__(self):
+        if self.contains is self.keys:
+            raise TypeError("a predicate keyspace can not be iterated")
+        return iter(self.keys)
 
-__all__ = ["LazyDict",]
 
 class LazyItemsView(ItemsView):
 
     def __iter__(self):
-        self._mapping.resolve()
-        for key in self._mapping:
-            yield (key, self._mapping[key])
+        for key, value in self._mapping._iter_resolving():
+            yield (key, value)
 
 
 class LazyValuesView(ValuesView):
 
     def __iter__(self):
-        self._mapping.resolve()
-        for key in self._mapping:
-            yield self._mapping[key]
+        for key, value in self._mapping._iter_resolving():
+            yield value
+
+
+def _check_batch_args(method, rslv, args, kwargs):
+    """
+    Raises TypeError if arguments are given for stubs of a BatchResolver,
+    which is called with keys only
+    """
+    if (args or kwargs) and isinstance(rslv, BatchResolver):
+        raise TypeError("%s() takes no resolver arguments for a "
+                        "BatchResolver" % method)
+
+
+def _same_stub(a, b):
+    """
+    Returns True if both stubs are known to resolve to the same value
+    """
+    if a is None or b is None:
+        return False
+    return a is b or (a.func is b.func and a.args == b.args and
+                      (a.keywords or {}) == (b.keywords or {}))
 
 
 class LazyDict(dict):
     _resolver = None
+    _backing = None
+    _failure_policy = None
+    _memo = None
+    _cost_model = None
+    _costs = None
+    _keyspaces = None
+    # False for subclasses that keep track of reads of resolved keys
+    _freezable = True
+    # distinct stub arguments interned before the table starts over
+    _intern_limit = 1024
+    __marker = object()
 
     def __init__(self, *args, **kwargs):
         super(LazyDict, self).__init__(*args, **kwargs)
         self._stubs = {}
+        self._interned = {}
+        self._deps = {}
 
     def __cmp__(self, other):
         self.resolve()
         return dict.__cmp__(self, other)
 
     def __eq__(self, other):
-        self.resolve()
-        return dict.__eq__(self, other)
+        if not isinstance(other, dict):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for key in self:
+            if key not in other:
+                return False
+        other_stub = other._get_stub if isinstance(other, LazyDict) else \
+            (lambda key: None)
+        pending = []
+        for key in self:
+            value = dict.get(self, key, self.__marker)
+            other_value = dict.get(other, key, self.__marker)
+            if value is self.__marker or other_value is self.__marker:
+                if not _same_stub(self._get_stub(key), other_stub(key)):
+                    pending.append(key)
+            elif value is not other_value and not value == other_value:
+                # identical values are equal, as in dict, even nan
+                return False
+        for key in pending:
+            value, other_value = self[key], other[key]
+            if value is not other_value and not value == other_value:
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
     def __len__(self):
+        if self._keyspaces is not None:
+            return dict.__len__(self) + len(self._stubs) + \
+                sum(len(keyspace) for keyspace in self._keyspaces) - \
+                len(self._shadowed)
         return dict.__len__(self)+len(self._stubs)
 
+    def __bool__(self):
+        if dict.__len__(self) or self._stubs:
+            return True
+        if self._keyspaces is None:
+            return False
+        try:
+            return len(self) > 0
+        except TypeError:
+            # predicate keyspaces can not be counted, they are not empty
+            return True
+
+    __nonzero__ = __bool__
+
     def __setitem__(self, key, item, dict_setitem=dict.__setitem__):
         if key in self._stubs:
             del self._stubs[key]
+        elif self._keyspaces is not None:
+            self._shadow(key)
         dict_setitem(self, key, item)
 
     def __delitem__(self, key):
         try:
             del self._stubs[key]
         except KeyError:
+            if self._keyspaces is not None and \
+                    not dict.__contains__(self, key) and \
+                    self._keyspace(key) is not None:
+                self._shadow(key)
+                return
             dict.__delitem__(self, key)
 
     def __missing__(self, key):
-        try:
-            stub = self._stubs.pop(key)
-        except KeyError:
+        if key in self._deps:
+            self._resolve_dependencies(key)
+        # the stub stays registered until its resolver has succeeded
+        stub = self._get_stub(key)
+        if stub is None:
             raise KeyError(key)
-        self[key] = s = stub()
-        return s
+        value = self._call([key], None, stub)
+        self._set_resolved(key, stub, value)
+        return value
 
     def __contains__(self, key):
-        return dict.__contains__(self, key) or key in self._stubs
+        return dict.__contains__(self, key) or key in self._stubs or \
+            (self._keyspaces is not None and self._keyspace(key) is not None)
 
     def __iter__(self):
         for key in dict.keys(self):
             yield key
         for key in self._stubs.keys():
             yield key
+        if self._keyspaces is not None:
+            for key in self._virtual_keys():
+                yield key
 
     def clear(self):
         self._stubs.clear()
+        self._interned.clear()
+        self._keyspaces = None
         dict.clear(self)
 
     def copy(self):
-        x = self.__class__(self)
+        x = self._new_copy(dict.items(self))
         x._stubs = self._stubs.copy()
+        x._resolver = self._resolver
+        x._backing = self._backing
+        x._deps = self._deps.copy()
+        x._failure_policy = self._failure_policy
+        x._memo = self._memo
+        x._cost_model = self._cost_model
+        if self._costs is not None:
+            x._costs = self._costs.copy()
+        if self._keyspaces is not None:
+            x._keyspaces = list(self._keyspaces)
+            x._shadowed = set(self._shadowed)
         return x
 
+    def _new_copy(self, items):
+        """
+        Returns a dict of the class of this one holding items, which
+        copy() then gives the stubs and settings of this one
+        """
+        return self.__class__(items)
+
     get = MutableMapping.get
     keys = MutableMapping.keys
     update = MutableMapping.update
@@ -112,7 +620,6 @@ class LazyDict(dict):
     def values(self):
         return LazyValuesView(self)
 
-    __marker = object()
     def pop(self, key, default=__marker):
         try:
             value = self[key]
@@ -131,23 +638,793 @@ class LazyDict(dict):
         for the first time.
 
         If rslv is None, LazyDict will try to use default resolver
-        provided by set_default_resolver.
+        provided by set_resolver. Such stubs without arguments
+        only store the key and use the default resolver at the time
+        they are resolved.
         """
+        if not rslv and self._resolver is None:
+            raise TypeError("set_stub() requires a resolver "
+                            "when no default resolver is set")
+        _check_batch_args('set_stub', rslv or self._resolver, args, kwargs)
         if key in dict.keys(self):
             dict.__delitem__(self, key)
-        self._stubs[key] = partial(rslv if rslv else self._resolver,
-                                   key, *args, **kwargs)
+        elif self._keyspaces is not None:
+            self._shadow(key)
+        if self._failure_policy is not None:
+            self._failure_policy.forget(key)
+        if not rslv and not args and not kwargs:
+            self._stubs[key] = _DEFAULT
+            return
+        if kwargs:
+            kwargs = self._intern(tuple(sorted(kwargs.items())), kwargs)
+        self._stubs[key] = Stub(rslv or self._resolver, key,
+                                self._intern(args, args), kwargs or None)
 
-    def resolve(self):
+    def set_dependencies(self, key, keys):
         """
-        Resolves all stubs
+        Declares that the stub of key reads the given keys when resolved.
+
+        The stubs among them are resolved before it, by lookups of key
+        and by resolve(), which runs independent stubs in parallel when
+        given an executor. An empty keys removes the declaration.
         """
+        keys = tuple(OrderedDict.fromkeys(keys))
+        if keys:
+            self._deps[key] = keys
+        else:
+            self._deps.pop(key, None)
+
+    def add_keyspace(self, keys, rslv=None, *args, **kwargs):
+        """
+        Adds stubs for all keys of a keyspace at once, resolved by
+        calling rslv(key, *args, **kwargs).
+
+        keys is a range, a set, a sorted sequence or a predicate, see
+        Keyspace. Keys are looked up in the keyspace on demand, explicit
+        set_stub, __setitem__ and __delitem__ override single keys, and
+        keys already stored or stubbed keep their values and stubs.
+        Keyspaces must not overlap each other.
+        """
+        if not rslv and self._resolver is None:
+            raise TypeError("add_keyspace() requires a resolver "
+                            "when no default resolver is set")
+        _check_batch_args('add_keyspace', rslv or self._resolver, args, kwargs)
+        if kwargs:
+            kwargs = self._intern(tuple(sorted(kwargs.items())), kwargs)
+        keyspace = Keyspace(keys, rslv, self._intern(args, args),
+                            kwargs or None)
+        if self._keyspaces is None:
+            self._keyspaces = []
+            self._shadowed = set()
+        for key in chain(dict.keys(self), self._stubs):
+            try:
+                if keyspace.contains(key):
+                    self._shadowed.add(key)
+            except TypeError:
+                pass
+        self._keyspaces.append(keyspace)
+
+    def _keyspace(self, key):
+        """
+        Returns the Keyspace of key if key is one of its stubs, or None
+        """
+        if key in self._shadowed:
+            return None
+        for keyspace in self._keyspaces:
+            try:
+                if keyspace.contains(key):
+                    return keyspace
+            except TypeError:
+                pass
+        return None
+
+    def _shadow(self, key):
+        """
+        Records that key of a keyspace is stored or was deleted explicitly
+        """
+        if key not in self._shadowed and self._keyspace(key) is not None:
+            self._shadowed.add(key)
+
+    def _virtual_keys(self):
+        """
+        Yields the keys of keyspaces that are still stubs of their keyspace
+        """
+        shadowed = self._shadowed
+        for keyspace in self._keyspaces:
+            for key in keyspace:
+                if key not in shadowed:
+                    yield key
+
+    def _is_stub(self, key):
+        return key in self._stubs or (self._keyspaces is not None and
+                                      self._keyspace(key) is not None)
+
+    def _intern(self, token, value):
+        """
+        Returns the value first interned under token, so that equal stub
+        arguments of the same types are stored once
+
+        The table holds at most _intern_limit tokens and is emptied when
+        it is full, so arguments of resolved stubs are not kept forever.
+        """
+        interned = self._interned
         try:
-            while True:
-                k,v = self._stubs.popitem()
-                self[k] = v()
+            token = _typed(token)
+            return interned[token]
         except KeyError:
-            pass
+            if len(interned) >= self._intern_limit:
+                interned.clear()
+            interned[token] = value
+            return value
+        except TypeError:
+            return value
+
+    def _get_stub(self, key, default=None):
+        """
+        Returns the Stub of key, or default if key is not stubbed
+        """
+        stub = self._stubs.get(key)
+        if stub is _DEFAULT:
+            return Stub(self._resolver, key)
+        if stub is not None:
+            return stub
+        if self._keyspaces is not None and not dict.__contains__(self, key):
+            keyspace = self._keyspace(key)
+            if keyspace is not None:
+                return Stub(keyspace.func or self._resolver, key,
+                            keyspace.args, keyspace.keywords)
+        return default
+
+    def resolve(self, executor=None, max_workers=None, errors='raise',
+                keys=None, where=None, resolver=None, budget=None,
+                priority=None):
+        """
+        Resolves all stubs, or a selection of them, and returns
+        a ResolveReport
+
+        keys limits the resolution to the stubs among keys, where to the
+        stubs for which where(key, stub) is true, given their Stub, and
+        resolver to the stubs of that resolver. The stubs the selected
+        stubs depend on are resolved as well.
+
+        Stubs sharing a BatchResolver are resolved with one call per chunk.
+
+        If executor is given, stubs are resolved on it in parallel.
+        It may be an Executor instance or an Executor class, which is
+        then created with max_workers and shut down afterwards.
+        A ProcessPoolExecutor requires picklable resolvers.
+
+        With errors='raise' the first failure is raised and pending work
+        is cancelled. With errors='collect' all stubs are attempted and
+        failures are stored in the report. Failed keys stay stubbed.
+        Stubs depending on a failed stub fail with its exception.
+
+        With budget, no resolution is started after budget seconds, and
+        resolutions estimated to take longer than the time left are not
+        started at all. Stubs are started by priority per estimated second,
+        priority(key, stub) being 1 by default. The estimates are those of
+        set_cost, or else of the cost model. Stubs left unresolved are
+        listed in the pending keys of the report.
+
+        Raises ValueError if stub dependencies form a cycle.
+        """
+        if errors not in ('raise', 'collect'):
+            raise ValueError("errors must be 'raise' or 'collect'")
+        if budget is not None:
+            return self._resolve_budgeted(executor, max_workers, errors,
+                                          keys, where, resolver, budget,
+                                          priority)
+        report = ResolveReport()
+        if keys is None:
+            keys = list(self._stubs)
+            if self._keyspaces is not None:
+                keys.extend(self._virtual_keys())
+        else:
+            keys = [k for k in keys if self._is_stub(k)]
+        if where is not None or resolver is not None:
+            keys = [k for k in keys if self._selected(k, where, resolver)]
+        if executor is None:
+            self._resolve_keys(keys, report, errors)
+        else:
+            self._resolve_parallel(keys, executor, max_workers, report, errors)
+        return report
+
+    def _resolve_budgeted(self, executor, max_workers, errors, keys, where,
+                          resolver, budget, priority):
+        deadline = _clock() + budget
+        if self._cost_model is None:
+            self._cost_model = CostModel()
+        if keys is None:
+            keys = list(self._stubs)
+            if self._keyspaces is not None:
+                keys.extend(self._virtual_keys())
+        keys = [k for k in keys if self._is_stub(k) and
+                (where is None and resolver is None or
+                 self._selected(k, where, resolver))]
+        waves = self._graph(keys)[0]
+        report = ResolveReport()
+        order = self._job_order(priority)
+        if executor is None:
+            for wave in waves:
+                if report.failed:
+                    wave = self._skip_failed(wave, report)
+                wave = [k for k in wave if not any(
+                    self._is_stub(dep) for dep in self._deps.get(k, ()))]
+                for job_keys, batch, func in sorted(self._jobs(wave),
+                                                    key=order):
+                    left = deadline - _clock()
+                    if left <= 0:
+                        break
+                    if self._cost(job_keys, batch, func) <= left:
+                        self._resolve_wave(job_keys, report, errors)
+        else:
+            self._resolve_parallel(keys, executor, max_workers, report,
+                                   errors, deadline, order)
+        report.pending = [k for wave in waves for k in wave
+                          if k not in report.failed and self._is_stub(k)]
+        return report
+
+    def _cost(self, keys, batch, func):
+        """
+        Returns the estimated seconds of a resolution job
+        """
+        costs = self._costs or {}
+        estimate = None
+        total = 0.0
+        for key in keys:
+            cost = costs.get(key)
+            if cost is None:
+                if estimate is None:
+                    estimate = self._cost_model.estimate(
+                        _job_resolver(batch, func))
+                cost = estimate
+            total += cost
+        return total
+
+    def _job_order(self, priority):
+        """
+        Returns the sort key of resolution jobs, by priority per second
+        """
+        def order(job):
+            keys, batch, func = job
+            cost = max(self._cost(keys, batch, func), 1e-9)
+            if priority is None:
+                return -len(keys) / cost
+            return -sum(priority(k, self._get_stub(k)) for k in keys) / cost
+        return order
+
+    def _selected(self, key, where, resolver):
+        stub = self._get_stub(key)
+        if resolver is not None and stub.func != resolver:
+            return False
+        return where is None or where(key, stub)
+
+    def get_many(self, keys, default=None):
+        """
+        Returns a dict of values for the given keys, using default
+        for keys that are not present.
+
+        Stubs sharing a BatchResolver are resolved with one call per chunk.
+        """
+        keys = list(keys)
+        self._resolve_keys([k for k in keys if self._is_stub(k)],
+                           ResolveReport())
+        return dict((k, self.get(k, default)) for k in keys)
+
+    def _jobs(self, keys):
+        """
+        Groups stub keys into resolution jobs of (keys, batch, callable)
+        """
+        batches = {}
+        for key in keys:
+            stub = self._get_stub(key)
+            if stub is None:
+                continue
+            if isinstance(stub.func, BatchResolver):
+                batches.setdefault(stub.func, []).append(key)
+            else:
+                yield [key], None, stub
+        for batch, batch_keys in batches.items():
+            for chunk in batch.chunks(batch_keys):
+                yield chunk, batch, partial(batch.func, chunk)
+
+    def _graph(self, keys):
+        """
+        Returns the dependency graph of the stubs among keys and the stubs
+        they depend on, transitively.
+
+        The graph is a list of waves of keys, each wave depending only on
+        the ones before it, a dict of the number of stubs each key waits
+        for, and a dict of the keys waiting for each stub.
+        Raises ValueError if the dependencies form a cycle.
+        """
+        order = list(OrderedDict.fromkeys(k for k in keys if self._is_stub(k)))
+        seen = set(order)
+        waiting = {}
+        dependents = {}
+        for key in order:
+            count = 0
+            for dep in self._deps.get(key, ()):
+                if not self._is_stub(dep):
+                    continue
+                count += 1
+                dependents.setdefault(dep, []).append(key)
+                if dep not in seen:
+                    seen.add(dep)
+                    order.append(dep)
+            waiting[key] = count
+        left = dict(waiting)
+        waves = []
+        wave = [k for k in order if not left[k]]
+        while wave:
+            waves.append(wave)
+            next_wave = []
+            for key in wave:
+                for dependent in dependents.get(key, ()):
+                    left[dependent] -= 1
+                    if not left[dependent]:
+                        next_wave.append(dependent)
+            wave = next_wave
+        if sum(len(wave) for wave in waves) < len(order):
+            self._cycle(set(k for k in order if left[k]))
+        return waves, waiting, dependents
+
+    def _cycle(self, keys):
+        """
+        Raises ValueError naming a dependency cycle among keys
+        """
+        key = next(iter(keys))
+        path = []
+        while key not in path:
+            path.append(key)
+            key = next(k for k in self._deps[key] if k in keys)
+        cycle = path[path.index(key):] + [key]
+        raise ValueError("stub dependencies form a cycle: %s" %
+                         ' -> '.join(repr(k) for k in cycle))
+
+    def _resolve_dependencies(self, key):
+        """
+        Resolves the stubs the stub of key depends on, transitively
+        """
+        if not self._is_stub(key):
+            return
+        waves = self._graph([key])[0]
+        # key depends on all other keys of its graph, so it comes last
+        for wave in waves[:-1]:
+            self._resolve_wave(wave, ResolveReport())
+
+    def _resolve_keys(self, keys, report, errors='raise'):
+        if not self._deps:
+            self._resolve_wave(keys, report, errors)
+            return
+        for wave in self._graph(keys)[0]:
+            if report.failed:
+                wave = self._skip_failed(wave, report)
+            self._resolve_wave(wave, report, errors)
+
+    def _skip_failed(self, keys, report):
+        """
+        Returns the keys whose dependencies have not failed, reporting
+        the others as failed with the exception of a dependency
+        """
+        runnable = []
+        for key in keys:
+            failed = [k for k in self._deps.get(key, ()) if k in report.failed]
+            if failed:
+                report.failed[key] = report.failed[failed[0]]
+            else:
+                runnable.append(key)
+        return runnable
+
+    def _resolve_wave(self, keys, report, errors='raise'):
+        """
+        Resolves the stubs of keys, which do not depend on each other
+        """
+        for job_keys, batch, func in self._jobs(keys):
+            start = _clock()
+            try:
+                result = self._call(job_keys, batch, func)
+            except Exception as e:
+                if errors == 'raise':
+                    raise
+                report.failed.update((key, e) for key in job_keys)
+            else:
+                self._store(job_keys, batch, result, report, errors)
+            finally:
+                elapsed = _clock() - start
+                report.timings.update((key, elapsed) for key in job_keys)
+
+    def _call(self, keys, batch, func):
+        """
+        Runs a resolution job for keys in the calling thread
+
+        If a failure policy is set, keys with a cached error are left out
+        of the job, and its outcome is recorded. If a memo cache or a
+        backing store is set, values found there are used instead of
+        calling the resolver, and resolved values are written to them.
+        If a cost model is set, the latency of the job is recorded in it.
+        """
+        model = self._cost_model
+        if model is not None:
+            result, error, elapsed = _timed(
+                partial(self._call_admitted, keys, batch, func))
+            model.observe(_job_resolver(batch, func), elapsed / len(keys))
+            if error is not None:
+                raise error
+            return result
+        return self._call_admitted(keys, batch, func)
+
+    def _call_admitted(self, keys, batch, func):
+        policy = self._failure_policy
+        if policy is None:
+            return self._call_memo(keys, batch, func)
+        keys, func = self._admit(keys, batch, func)
+        resolver = _job_resolver(batch, func)
+        try:
+            result = self._call_memo(keys, batch, func)
+        except Exception as e:
+            policy.record(resolver, keys, e)
+            raise
+        policy.record(resolver, keys)
+        return result
+
+    def _admit(self, keys, batch, func):
+        """
+        Returns the keys of a resolution job the failure policy lets
+        through and the callable resolving them
+        """
+        allowed = self._failure_policy.admit(_job_resolver(batch, func), keys)
+        if len(allowed) < len(keys):
+            # only batch jobs resolve more than one key
+            func = partial(batch.func, allowed)
+        return allowed, func
+
+    def _call_memo(self, keys, batch, func):
+        if self._memo is None:
+            return self._call_backed(keys, batch, func)
+        found, missing = self._from_memo(keys, batch, func)
+        if not missing:
+            return found if batch else found[keys[0]]
+        if batch is not None and len(missing) < len(keys):
+            func = partial(batch.func, missing)
+        result = self._call_backed(missing, batch, func)
+        self._to_memo(missing, batch, func, result)
+        if batch is None:
+            return result
+        found.update((k, result[k]) for k in missing if k in result)
+        return found
+
+    def _from_memo(self, keys, batch, func):
+        """
+        Returns a dict of the values of keys found in the memo cache
+        and a list of the keys that were not found
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            memo = _memo_key(key, batch, func)
+            try:
+                if memo is None:
+                    raise KeyError(key)
+                found[key] = self._memo.get(memo)
+            except KeyError:
+                missing.append(key)
+        return found, missing
+
+    def _to_memo(self, keys, batch, func, result):
+        if batch is None:
+            memo = _memo_key(keys[0], None, func)
+            if memo is not None:
+                self._memo.set(memo, result)
+            return
+        for key in keys:
+            if key in result:
+                self._memo.set((batch, key), result[key])
+
+    def _call_backed(self, keys, batch, func):
+        if self._backing is None:
+            return func()
+        found, missing = self._from_backing(keys)
+        if not missing:
+            return found if batch else found[keys[0]]
+        try:
+            if batch is None:
+                value = func()
+                self._to_backing(keys, None, value)
+                return value
+            result = batch.func(missing)
+            self._to_backing(missing, batch, result)
+        finally:
+            self._release_backing(missing)
+        found.update((k, result[k]) for k in missing if k in result)
+        return found
+
+    def _from_backing(self, keys):
+        """
+        Returns a dict of the values of keys found in the backing store
+        and a list of the keys that were not found
+        """
+        found = {}
+        missing = []
+        for key in keys:
+            try:
+                found[key] = self._backing.get(key)
+            except KeyError:
+                missing.append(key)
+        return found, missing
+
+    def _release_backing(self, keys):
+        """
+        Releases the claims a store may hold on keys it was asked for
+        but that were not written to it
+        """
+        release = getattr(self._backing, 'release', None)
+        if release is not None:
+            for key in keys:
+                release(key)
+
+    def _to_backing(self, keys, batch, result):
+        """
+        Writes the resolved values of keys through to the backing store
+
+        A value the store fails to write, like one it cannot serialize, is
+        only kept in the dict, and the claim on its key is released.
+        """
+        if batch is None:
+            values = [(keys[0], result)]
+        else:
+            values = [(key, result[key]) for key in keys if key in result]
+        for key, value in values:
+            try:
+                self._backing.set(key, value)
+            except Exception:
+                self._release_backing([key])
+
+    def _resolve_parallel(self, keys, executor, max_workers, report, errors,
+                          deadline=None, order=None):
+        """
+        Resolves the stubs of keys on executor, submitting each stub
+        as soon as the stubs it depends on are resolved
+
+        With deadline, jobs are submitted in the given order while they
+        fit in the time left, and queued jobs are cancelled at deadline.
+        """
+        from concurrent.futures import wait, FIRST_COMPLETED
+        waves, waiting, dependents = self._graph(keys)
+        policy = self._failure_policy
+        owned = isinstance(executor, type)
+        if owned:
+            executor = executor(max_workers=max_workers)
+        futures = {}
+        claimed = []
+
+        def finish(done):
+            ready = []
+            for key in done:
+                for dependent in dependents.get(key, ()):
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        ready.append(dependent)
+            return ready
+
+        def submit(ready):
+            while ready:
+                done = []
+                if report.failed:
+                    runnable = self._skip_failed(ready, report)
+                    done.extend(k for k in ready if k in report.failed)
+                else:
+                    runnable = ready
+                done.extend(k for k in runnable if not self._is_stub(k))
+                jobs = self._jobs(runnable)
+                if deadline is not None:
+                    jobs = sorted(jobs, key=order)
+                for job_keys, batch, func in jobs:
+                    if deadline is not None and self._cost(
+                            job_keys, batch, func) > deadline - _clock():
+                        continue
+                    if self._memo is not None:
+                        found, job_keys = self._from_memo(job_keys, batch,
+                                                          func)
+                        if found:
+                            self._store(list(found), True, found, report,
+                                        errors)
+                            done.extend(found)
+                        if not job_keys:
+                            continue
+                        if batch is not None:
+                            func = partial(batch.func, job_keys)
+                    if self._backing is not None:
+                        found, job_keys = self._from_backing(job_keys)
+                        claimed.extend(job_keys)
+                        if found:
+                            # found is a mapping, stored like a batch result
+                            self._store(list(found), True, found, report,
+                                        errors)
+                            done.extend(found)
+                        if not job_keys:
+                            continue
+                        if batch is not None:
+                            func = partial(batch.func, job_keys)
+                    if policy is not None:
+                        try:
+                            allowed, func = self._admit(job_keys, batch, func)
+                        except Exception as e:
+                            allowed, error = [], e
+                        for key in job_keys:
+                            if key not in allowed:
+                                if errors == 'raise':
+                                    raise policy.error(key) or error
+                                report.failed[key] = policy.error(key) or error
+                                done.append(key)
+                        if not allowed:
+                            continue
+                        job_keys = allowed
+                    own, func = self._claim_job(job_keys, batch, func)
+                    if len(own) < len(job_keys):
+                        done.extend(k for k in job_keys if k not in own)
+                        if not own:
+                            continue
+                        job_keys = own
+                    futures[executor.submit(_timed, func)] = (job_keys, batch,
+                                                              func)
+                ready = finish(done)
+
+        try:
+            submit(waves[0] if waves else [])
+            while futures:
+                timeout = None
+                if deadline is not None and _clock() < deadline:
+                    timeout = deadline - _clock()
+                finished = wait(futures, timeout,
+                                return_when=FIRST_COMPLETED)[0]
+                if deadline is not None and _clock() >= deadline:
+                    # running jobs are waited for, queued ones cancelled
+                    for future in list(futures):
+                        if future not in finished and future.cancel():
+                            self._end_job(futures.pop(future)[0], {})
+                done = []
+                for future in finished:
+                    job_keys, batch, func = futures.pop(future)
+                    done.extend(job_keys)
+                    try:
+                        self._finish_job(job_keys, batch, func,
+                                         future.result(), report, errors)
+                    finally:
+                        self._end_job(job_keys, report.failed)
+                submit(finish(done))
+        finally:
+            for future, job in futures.items():
+                future.cancel()
+                self._end_job(job[0], {})
+            if owned:
+                executor.shutdown()
+            if claimed:
+                self._release_backing(claimed)
+
+    def _finish_job(self, keys, batch, func, outcome, report, errors):
+        """
+        Records the outcome of a parallel resolution job and stores its
+        result
+        """
+        self._record_job(keys, batch, func, outcome)
+        result, error, elapsed = outcome
+        policy = self._failure_policy
+        report.timings.update((key, elapsed) for key in keys)
+        if self._cost_model is not None:
+            self._cost_model.observe(_job_resolver(batch, func),
+                                     elapsed / len(keys))
+        if error is not None:
+            if policy is not None:
+                policy.record(_job_resolver(batch, func), keys, error)
+            report.failed.update((key, error) for key in keys)
+            if errors == 'raise':
+                raise error
+            return
+        if policy is not None:
+            policy.record(_job_resolver(batch, func), keys)
+        if self._memo is not None:
+            self._to_memo(keys, batch, func, result)
+        if self._backing is not None:
+            self._to_backing(keys, batch, result)
+        self._store(keys, batch, result, report, errors)
+
+    def _record_job(self, keys, batch, func, outcome):
+        """
+        Called with the (result, error, seconds) outcome of every parallel
+        resolution job, which runs without going through _call
+        """
+
+    def _claim_job(self, keys, batch, func):
+        """
+        Returns the keys of a parallel resolution job that are resolved
+        by it, and the callable resolving them. Subclasses leave out the
+        keys resolved elsewhere meanwhile.
+        """
+        return keys, func
+
+    def _end_job(self, keys, failed):
+        """
+        Called once a parallel resolution job claimed for keys has been
+        stored, has failed with the exceptions in failed, or was dropped
+        """
+
+    def _store(self, keys, batch, result, report, errors):
+        """
+        Stores the result of a resolution job, replacing its stubs
+        """
+        if batch is None:
+            self._set_resolved(keys[0], self._get_stub(keys[0]), result)
+            report.resolved.append(keys[0])
+            return
+        missing = None
+        for key in keys:
+            try:
+                value = result[key]
+            except KeyError as e:
+                if self._failure_policy is not None:
+                    # left out of the job for its cached error
+                    e = self._failure_policy.error(key) or e
+                report.failed[key] = e
+                missing = missing or e
+            else:
+                self._set_resolved(key, self._get_stub(key), value)
+                report.resolved.append(key)
+        if missing and errors == 'raise':
+            raise missing
+
+    def _iter_resolving(self):
+        """
+        Yields (key, value) pairs, resolving stubs as they are reached
+
+        Stubs sharing a BatchResolver are resolved one chunk at a time.
+        Raises RuntimeError if the dict changes size during iteration.
+        """
+        keys = list(self)
+        size = len(keys)
+        for i, key in enumerate(keys):
+            if len(self) != size:
+                raise RuntimeError("dictionary changed size during iteration")
+            stub = self._get_stub(key)
+            if stub is not None and isinstance(stub.func, BatchResolver):
+                batch = stub.func
+                chunk = [k for k in keys[i:i+(batch.chunk_size or size)]
+                         if getattr(self._get_stub(k), 'func', None) is batch]
+                self._resolve_keys(chunk, ResolveReport())
+            yield key, self[key]
+
+    def _set_resolved(self, key, stub, value):
+        """
+        Stores the value a stub resolved to, replacing the stub
+        """
+        self[key] = value
+
+    def freeze(self, executor=None, max_workers=None):
+        """
+        Resolves all stubs and switches the dict to the methods of dict,
+        so that reads run at native speed. Adding a stub switches it back.
+
+        executor and max_workers are as in resolve(). Raises TypeError
+        for dicts that keep track of reads.
+        """
+        if not self._freezable:
+            raise TypeError("%s cannot be frozen" % type(self).__name__)
+        self.resolve(executor, max_workers)
+        # every key of the keyspaces is stored in the dict now
+        self._keyspaces = None
+        self.__class__ = _frozen_class(type(self))
+
+    def is_frozen(self):
+        """
+        Returns True if the dict is frozen
+        """
+        return False
+
+    def overlay(self):
+        """
+        Returns a LazyOverlay of this dict, created in constant time
+        """
+        return LazyOverlay(self)
 
     def set_resolver(self, resolver):
         """
@@ -155,21 +1432,420 @@ class LazyDict(dict):
         """
         self._resolver = resolver
 
+    def set_failure_policy(self, policy):
+        """
+        Sets the FailurePolicy deciding when failed stubs are retried.
+        None retries them on every lookup.
+        """
+        self._failure_policy = policy
+
+    def set_memo(self, cache):
+        """
+        Sets a MemoCache consulted before calling a resolver, which may
+        be shared by many dicts. None removes the cache.
+        """
+        self._memo = cache
+
+    def set_cost(self, key, seconds):
+        """
+        Sets the estimated seconds the stub of key takes to resolve,
+        used by resolve() with a budget instead of the cost model
+        """
+        if self._costs is None:
+            self._costs = {}
+        self._costs[key] = seconds
+
+    def set_cost_model(self, model):
+        """
+        Sets the CostModel estimating the latency of resolvers, which
+        may be shared by many dicts. Latencies of all resolutions are
+        recorded in it. resolve() with a budget sets one if none is set.
+        """
+        self._cost_model = model
+
+    def set_store(self, store):
+        """
+        Sets a backing store consulted before calling a resolver.
+
+        The store must provide get(key), raising KeyError for unknown
+        keys, and set(key, value). A store may also provide release(key),
+        which is called when a key it was asked for could not be resolved
+        or its value could not be written. None removes the store.
+        """
+        self._backing = store
+
+
+class _Frozen(object):
+    """
+    Mixin of frozen dicts, without stubs, using the methods of dict
+    """
+    _lazy_class = None
+
+    __contains__ = dict.__contains__
+    __iter__ = dict.__iter__
+    __len__ = dict.__len__
+    __setitem__ = dict.__setitem__
+    __delitem__ = dict.__delitem__
+    get = dict.get
+    keys = dict.keys
+    items = dict.items
+    values = dict.values
+    update = dict.update
+    setdefault = dict.setdefault
+    pop = dict.pop
+
+    def __missing__(self, key):
+        raise KeyError(key)
+
+    def __bool__(self):
+        return dict.__len__(self) != 0
+
+    __nonzero__ = __bool__
+
+    def __reduce_ex__(self, protocol):
+        # the frozen class cannot be looked up by name, unlike the lazy one
+        return (_unpickle_frozen, (self._lazy_class, dict(self),
+                                   self.__dict__))
+
+    def is_frozen(self):
+        return True
+
+    def set_stub(self, key, rslv=None, *args, **kwargs):
+        self.__class__ = self._lazy_class
+        self.set_stub(key, rslv, *args, **kwargs)
+
+    def add_keyspace(self, keys, rslv=None, *args, **kwargs):
+        self.__class__ = self._lazy_class
+        self.add_keyspace(keys, rslv, *args, **kwargs)
+
+
+_frozen_classes = {}
+
+
+def _frozen_class(cls):
+    """
+    Returns the frozen variant of the LazyDict class cls
+    """
+    frozen = _frozen_classes.get(cls)
+    if frozen is None:
+        frozen = type(cls.__name__, (_Frozen, cls),
+                      {'_lazy_class': cls, '__module__': cls.__module__})
+        frozen = _frozen_classes.setdefault(cls, frozen)
+    return frozen
+
+
+def _unpickle_frozen(cls, items, state):
+    d = cls.__new__(cls)
+    dict.update(d, items)
+    d.__dict__.update(state)
+    d.__class__ = _frozen_class(cls)
+    return d
+
+
+class LazyOverlay(LazyDict):
+    """
+    LazyDict layered over a base LazyDict.
+
+    Reads fall through to the base, so the overlay shares its values and
+    stubs, and sees later changes of it. Writes, stubs and deletes are
+    kept in the overlay. Stubs of the base are resolved in the base, so
+    all overlays of one base resolve each of them only once.
+    """
+    _freezable = False
+
+    def __init__(self, base):
+        super(LazyOverlay, self).__init__()
+        self._base = base
+        # keys of the base that are overridden or deleted in the overlay
+        self._hidden = set()
+
+    def _shared(self, key):
+        """
+        Returns True if key is looked up in the base
+        """
+        return not dict.__contains__(self, key) and key not in self._stubs \
+            and key not in self._hidden and key in self._base
+
+    def __missing__(self, key):
+        if self._shared(key):
+            return self._base[key]
+        return LazyDict.__missing__(self, key)
+
+    def __contains__(self, key):
+        return LazyDict.__contains__(self, key) or \
+            (key not in self._hidden and key in self._base)
+
+    def __len__(self):
+        base = self._base
+        return LazyDict.__len__(self) + len(base) - \
+            sum(1 for key in self._hidden if key in base)
+
+    def __iter__(self):
+        for key in LazyDict.__iter__(self):
+            yield key
+        for key in self._base:
+            if key not in self._hidden:
+                yield key
+
+    def __bool__(self):
+        if LazyDict.__bool__(self):
+            return True
+        if not self._hidden:
+            return bool(self._base)
+        try:
+            return any(key not in self._hidden for key in self._base)
+        except TypeError:
+            return True
+
+    __nonzero__ = __bool__
+
+    def __setitem__(self, key, item):
+        self._hidden.add(key)
+        LazyDict.__setitem__(self, key, item)
+
+    def __delitem__(self, key):
+        if self._shared(key):
+            self._hidden.add(key)
+            return
+        LazyDict.__delitem__(self, key)
+
+    def set_stub(self, key, rslv=None, *args, **kwargs):
+        self._hidden.add(key)
+        LazyDict.set_stub(self, key, rslv, *args, **kwargs)
+
+    def clear(self):
+        LazyDict.clear(self)
+        self._base = LazyDict()
+        self._hidden = set()
+
+    def copy(self):
+        x = LazyDict.copy(self)
+        x._hidden = set(self._hidden)
+        return x
+
+    def _new_copy(self, items):
+        x = self.__class__(self._base)
+        dict.update(x, items)
+        return x
+
+    def resolve(self, executor=None, max_workers=None, errors='raise',
+                keys=None, where=None, resolver=None, budget=None,
+                priority=None):
+        """
+        Resolves the stubs of the overlay, and the selected stubs of the
+        base in the base, and returns a combined ResolveReport
+        """
+        start = _clock()
+        report = LazyDict.resolve(self, executor, max_workers, errors,
+                                  keys, where, resolver, budget, priority)
+        if budget is not None:
+            budget = max(budget - (_clock() - start), 0)
+        if keys is not None:
+            shared = [k for k in keys if self._shared(k)]
+        elif self._hidden:
+            shared = [k for k in self._base if k not in self._hidden]
+        else:
+            shared = None
+        if shared is None or shared:
+            base = self._base.resolve(executor, max_workers, errors, shared,
+                                      where, resolver, budget, priority)
+            report.resolved.extend(base.resolved)
+            report.pending.extend(base.pending)
+            report.failed.update(base.failed)
+            report.timings.update(base.timings)
+        return report
+
+    def get_many(self, keys, default=None):
+        keys = list(keys)
+        shared = [k for k in keys if self._shared(k)]
+        if shared:
+            self._base.get_many(shared)
+        return LazyDict.get_many(self, keys, default)
+
+
+class LatencyHistogram(object):
+    """
+    Histogram of latencies in power-of-two microsecond buckets
+    """
+    __slots__ = ('buckets', 'count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        bound = 1
+        while bound < seconds * 1e6:
+            bound <<= 1
+        self.buckets[bound] = self.buckets.get(bound, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        Returns the upper bound in seconds of the bucket holding
+        the p-th percentile
+        """
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bound in sorted(self.buckets):
+            seen += self.buckets[bound]
+            if seen >= rank:
+                return bound / 1e6
+        return None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': dict((str(b), n) for b, n in self.buckets.items()),
+        }
+
+
+def _resolver_name(func):
+    name = getattr(func, '__qualname__', None) or \
+        getattr(func, '__name__', None)
+    if name is None:
+        return repr(func)
+    return '%s.%s' % (getattr(func, '__module__', None), name)
+
 
 class LazyDictDebug(LazyDict):
+    """
+    LazyDict that counts lookups and resolutions, records resolver latency
+    per key and per resolver, and records which API call and which call site
+    triggered each resolution.
+
+    Latencies and triggers are recorded for one in every sample_every
+    resolutions, counters are always exact.
+    """
+    sample_every = 1
+    timer = staticmethod(_clock)
+    _freezable = False
+
+    _views = {'LazyItemsView': 'items', 'LazyValuesView': 'values'}
+    _apis = {'__missing__': '__getitem__'}
+
     def __init__(self, *args, **kwargs):
         super(LazyDictDebug, self).__init__(*args, **kwargs)
-        self.stats = {'realitems': 0, 'stubs': 0, 'resolved': 0}
+        self.stats = {'realitems': 0, 'stubs': 0, 'resolved': 0,
+                      'hits': 0, 'misses': 0, 'sweeps': 0, 'sampled': 0}
         self.timers = {}
+        self.resolver_timers = {}
+        self.triggers = {}
+        self._calls = 0
 
-    def set_stub(self, key, resolver, *args, **kwargs):
+    def set_stub(self, key, resolver=None, *args, **kwargs):
         self.stats['stubs']+=1
         LazyDict.set_stub(self, key, resolver, *args, **kwargs)
 
+    def set_sampling(self, every):
+        """
+        Records latencies and triggers for one in every resolutions
+        """
+        self.sample_every = every
+
+    def __getitem__(self, key):
+        misses = self.stats['misses']
+        value = dict.__getitem__(self, key)
+        if self.stats['misses'] == misses:
+            self.stats['hits']+=1
+        return value
+
     def __missing__(self, key):
+        if self._is_stub(key):
+            self.stats['misses']+=1
+        return LazyDict.__missing__(self, key)
+
+    def resolve(self, *args, **kwargs):
+        self.stats['sweeps']+=1
+        return LazyDict.resolve(self, *args, **kwargs)
+
+    def _set_resolved(self, key, stub, value):
         self.stats['resolved']+=1
-        #start = timer()
-        LazyDict.__missing__(self, key)
-        #stop = timer()
-        #self.timers[key] = stop-start
+        LazyDict._set_resolved(self, key, stub, value)
 
+    def _call(self, keys, batch, func):
+        if not self._sample(keys):
+            return LazyDict._call(self, keys, batch, func)
+        start = self.timer()
+        try:
+            return LazyDict._call(self, keys, batch, func)
+        finally:
+            self._add_latency(keys, func, self.timer() - start)
+
+    def _record_job(self, keys, batch, func, outcome):
+        if self._sample(keys):
+            self._add_latency(keys, func, outcome[2])
+
+    def _sample(self, keys):
+        """
+        Returns True if this resolution is sampled, recording its trigger
+        """
+        self._calls += 1
+        if self._calls % self.sample_every:
+            return False
+        self.stats['sampled']+=1
+        trigger = self._trigger()
+        self.triggers[trigger] = self.triggers.get(trigger, 0) + len(keys)
+        return True
+
+    def _add_latency(self, keys, func, elapsed):
+        name = _resolver_name(getattr(func, 'func', func))
+        self.resolver_timers.setdefault(name, LatencyHistogram()).add(elapsed)
+        for key in keys:
+            self.timers.setdefault(key, LatencyHistogram()).add(elapsed)
+
+    def _trigger(self):
+        """
+        Returns the (api, call site) of the outermost call into this dict
+        """
+        api = None
+        frame = sys._getframe(2)
+        while frame is not None:
+            owner = frame.f_locals.get('self')
+            if owner is self:
+                name = frame.f_code.co_name
+                api = self._apis.get(name, name)
+            elif getattr(owner, '_mapping', None) is self:
+                api = self._views.get(type(owner).__name__,
+                                      frame.f_code.co_name)
+            elif api is not None:
+                return (api, '%s:%d' % (frame.f_code.co_filename,
+                                        frame.f_lineno))
+            frame = frame.f_back
+        return (api, None)
+
+    def report(self, top=20):
+        """
+        Returns counters, latency summaries and the top triggers and keys
+        as a JSON-serializable dict
+        """
+        keys = sorted(self.timers.items(), key=lambda item: -item[1].total)
+        triggers = sorted(self.triggers.items(), key=lambda item: -item[1])
+        return {
+            'stats': dict(self.stats),
+            'resolvers': dict((name, h.as_dict()) for name, h
+                              in self.resolver_timers.items()),
+            'keys': [dict(h.as_dict(), key=repr(key))
+                     for key, h in keys[:top]],
+            'triggers': [{'api': api, 'site': site, 'resolutions': count}
+                         for (api, site), count in triggers[:top]],
+        }
+
+    def export(self, fp, top=20):
+        """
+        Writes the report as JSON to the file object fp
+        """
+        json.dump(self.report(top), fp, indent=2, sort_keys=True)
@@ -0,0 +1,436 @@
+'''
+Persistent backing stores for LazyDict.
+
+A store set with LazyDict.set_store is consulted before a stub's resolver
+is called, and every resolved value is written through to it, so after a
+restart stubs are resolved from disk instead of being computed again.
+
+SqliteStore keeps values in a local SQLite file. Entries live in a
+namespace and a version: bumping the version makes all older entries
+invisible, and purge() deletes them. With max_bytes the least recently
+read entries are evicted once the namespace grows past that size.
+
+SharedMemoryStore publishes values into named shared memory segments,
+so that pre-forked workers on one host resolve every key only once.
+The first worker to miss a key claims it with a file lock, the others wait
+for it to publish the value. Large bytes-like values are read without
+copying, other values are copied or unpickled once per worker.
+
+Example:
+
+    store = SqliteStore('/var/cache/app/users.db', namespace='users',
+                        version=3, max_bytes=512 * 2**20)
+    d = LazyDict()
+    d.set_store(store)
+    d.set_stub('alice', load_user)
+
+    x = d['alice']                   # read from disk after a restart
+
+'''
+import errno
+import hashlib
+import os
+import pickle
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    fcntl = shared_memory = resource_tracker = None
+
+__all__ = ["SqliteStore", "SharedMemoryStore"]
+
+# before Python 3.13 every SharedMemory registers itself with the resource
+# tracker, which unlinks it when the process exits
+_TRACKED = sys.version_info < (3, 13)
+_tracker_lock = threading.Lock()
+
+# segments of values read without copying, closed once no longer in use
+_mapped = []
+_mapped_lock = threading.Lock()
+_sweep_at = [64]
+
+
+def _keep_mapped(segment):
+    """
+    Keeps segment open while values read from it are in use, and closes
+    the segments of values that are no longer referenced
+    """
+    with _mapped_lock:
+        _mapped.append(segment)
+        if len(_mapped) < _sweep_at[0]:
+            return
+        in_use = []
+        for mapped in _mapped:
+            try:
+                mapped.close()
+            except BufferError:
+                in_use.append(mapped)
+        _mapped[:] = in_use
+        _sweep_at[0] = max(64, 2 * len(in_use))
+
+
+class SqliteStore(object):
+    """
+    Stores serialized values in a SQLite database at path.
+
+    serializer is any object with dumps and loads, pickle by default.
+    Keys are always pickled, so they must pickle deterministically.
+    """
+    key_protocol = 2
+
+    def __init__(self, path, namespace='default', version=0,
+                 serializer=pickle, max_bytes=None):
+        self.namespace = namespace
+        self.version = str(version)
+        self.serializer = serializer
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False,
+                                   isolation_level=None)
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS entries ('
+                ' namespace TEXT, version TEXT, key BLOB, value BLOB,'
+                ' size INTEGER, atime REAL,'
+                ' PRIMARY KEY (namespace, version, key))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS entries_atime'
+                ' ON entries (namespace, version, atime)')
+        self._bytes = self.size()
+
+    def _key(self, key):
+        return sqlite3.Binary(pickle.dumps(key, self.key_protocol))
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or raises KeyError
+        """
+        k = self._key(key)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM entries'
+                ' WHERE namespace=? AND version=? AND key=?',
+                (self.namespace, self.version, k)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            if self.max_bytes is not None:
+                self._db.execute(
+                    'UPDATE entries SET atime=?'
+                    ' WHERE namespace=? AND version=? AND key=?',
+                    (time.time(), self.namespace, self.version, k))
+        return self.serializer.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Stores value for key, evicting old entries if over max_bytes
+        """
+        data = self.serializer.dumps(value)
+        if not isinstance(data, str):
+            data = sqlite3.Binary(data)
+        size = len(data)
+        k = self._key(key)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size FROM entries'
+                ' WHERE namespace=? AND version=? AND key=?',
+                (self.namespace, self.version, k)).fetchone()
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                (self.namespace, self.version, k, data, size, time.time()))
+            self._bytes += size - (row[0] if row else 0)
+            if self.max_bytes is not None and self._bytes > self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM entries WHERE namespace=? AND version=? AND key=?',
+                (self.namespace, self.version, self._key(key)))
+        self._bytes = self.size()
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute(
+                'SELECT 1 FROM entries'
+                ' WHERE namespace=? AND version=? AND key=?',
+                (self.namespace, self.version, self._key(key))
+            ).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM entries WHERE namespace=? AND version=?',
+                (self.namespace, self.version)).fetchone()[0]
+
+    def size(self):
+        """
+        Returns the number of bytes of values in this namespace and version
+        """
+        with self._lock:
+            return self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM entries'
+                ' WHERE namespace=? AND version=?',
+                (self.namespace, self.version)).fetchone()[0]
+
+    def clear(self):
+        """
+        Deletes all entries of this namespace and version
+        """
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM entries WHERE namespace=? AND version=?',
+                (self.namespace, self.version))
+        self._bytes = 0
+
+    def purge(self):
+        """
+        Deletes the entries of all other versions of this namespace
+        """
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM entries WHERE namespace=? AND version!=?',
+                (self.namespace, self.version))
+
+    def close(self):
+        self._db.close()
+
+    def _evict(self):
+        """
+        Deletes the least recently used entries until under max_bytes
+        """
+        self._bytes = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries'
+            ' WHERE namespace=? AND version=?',
+            (self.namespace, self.version)).fetchone()[0]
+        rows = self._db.execute(
+            'SELECT key, size FROM entries WHERE namespace=? AND version=?'
+            ' ORDER BY atime, rowid', (self.namespace, self.version))
+        doomed = []
+        for key, size in rows:
+            if self._bytes <= self.max_bytes:
+                break
+            doomed.append((self.namespace, self.version, key))
+            self._bytes -= size
+        self._db.executemany(
+            'DELETE FROM entries WHERE namespace=? AND version=? AND key=?',
+            doomed)
+
+
+class SharedMemoryStore(object):
+    """
+    Shares values between processes of one host in shared memory.
+
+    Stores with the same prefix see the same values. Claims are file locks
+    in lock_dir, so a claim is dropped when its process dies. A process
+    waits at most timeout seconds for another one to publish a value before
+    resolving it itself.
+
+    Each value is a segment with a header of its state and size. The state
+    is written last, so readers never see a partially written value.
+
+    bytes-like values of at least zero_copy bytes are returned as
+    memoryviews of their segment, which stays mapped while they are
+    referenced and holds two file descriptors meanwhile. Smaller ones are
+    copied back as bytearray if they were stored as one and as bytes
+    otherwise. Other values are unpickled. Copied and unpickled values do
+    not keep their segment open.
+    """
+    header = struct.Struct('!BQ')
+    WRITING, RAW, PICKLED, BYTEARRAY = 0, 1, 2, 3
+    poll = 0.005
+    zero_copy = 1 << 16
+    _MISSING = object()
+
+    def __init__(self, prefix, lock_dir=None, timeout=60.0):
+        if shared_memory is None:
+            raise RuntimeError("SharedMemoryStore requires Python 3.8+ "
+                               "on a POSIX system")
+        self.prefix = prefix
+        self.timeout = timeout
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(),
+                                                 'lazystore-' + prefix)
+        try:
+            os.makedirs(self.lock_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._claims = {}
+        self._lock = threading.Lock()
+
+    def _name(self, key):
+        digest = hashlib.sha1(pickle.dumps(key, 2)).hexdigest()[:24]
+        return '%s_%s' % (self.prefix, digest)
+
+    def get(self, key):
+        """
+        Returns the value published for key.
+
+        If no value is published, claims key and raises KeyError, so that
+        the caller resolves it and calls set, or release if it fails.
+        """
+        name = self._name(key)
+        value = self._read(name)
+        if value is not self._MISSING:
+            return value
+        fd = os.open(os.path.join(self.lock_dir, name),
+                     os.O_RDWR | os.O_CREAT, 0o600)
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+            value = self._read(name)
+            if value is not self._MISSING or time.time() > deadline:
+                os.close(fd)
+                if value is self._MISSING:
+                    raise KeyError(key)
+                return value
+            time.sleep(self.poll)
+        value = self._read(name)
+        if value is not self._MISSING:
+            os.close(fd)
+            return value
+        with self._lock:
+            self._claims[name] = fd
+        raise KeyError(key)
+
+    def set(self, key, value):
+        """
+        Publishes value for key and releases the claim on it
+        """
+        name = self._name(key)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            state = self.BYTEARRAY if isinstance(value, bytearray) \
+                else self.RAW
+            data = memoryview(value).cast('B')
+        else:
+            state, data = self.PICKLED, pickle.dumps(value, -1)
+        size = len(data)
+        try:
+            segment = self._open(name, self.header.size + max(size, 1))
+        except FileExistsError:
+            # published by another process that did not hold the claim
+            self.release(key)
+            return
+        # clear() finds the segments of this prefix by their lock files
+        os.close(os.open(os.path.join(self.lock_dir, name),
+                         os.O_RDWR | os.O_CREAT, 0o600))
+        try:
+            segment.buf[self.header.size:self.header.size + size] = data
+            self.header.pack_into(segment.buf, 0, self.WRITING, size)
+            segment.buf[0] = state
+        finally:
+            segment.close()
+        self.release(key)
+
+    def release(self, key):
+        """
+        Releases the claim on key, if this store holds it
+        """
+        with self._lock:
+            fd = self._claims.pop(self._name(key), None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def __contains__(self, key):
+        segment = self._attach(self._name(key))
+        if segment is None:
+            return False
+        try:
+            return segment.buf[0] != self.WRITING
+        finally:
+            segment.close()
+
+    def delete(self, key):
+        """
+        Removes the value of key from the host
+        """
+        self._unlink(self._name(key))
+
+    def clear(self):
+        """
+        Removes all values with this prefix from the host
+        """
+        for name in os.listdir(self.lock_dir):
+            self._unlink(name)
+            try:
+                os.unlink(os.path.join(self.lock_dir, name))
+            except OSError:
+                pass
+
+    def _attach(self, name):
+        """
+        Returns the segment called name, or None if it does not exist
+        """
+        try:
+            return self._open(name)
+        except FileNotFoundError:
+            return None
+
+    def _unlink(self, name):
+        segment = self._attach(name)
+        if segment is None:
+            return
+        try:
+            # readers that are still attached see the value as missing
+            segment.buf[0] = self.WRITING
+            with _tracker_lock:
+                if _TRACKED:
+                    # unlink() unregisters the segment, _open did already
+                    resource_tracker.register('/' + name, 'shared_memory')
+                try:
+                    segment.unlink()
+                except FileNotFoundError:
+                    pass
+        finally:
+            segment.close()
+
+    def _read(self, name):
+        segment = self._attach(name)
+        if segment is None:
+            return self._MISSING
+        state, size = self.header.unpack_from(segment.buf, 0)
+        start = self.header.size
+        if state in (self.RAW, self.BYTEARRAY) and size >= self.zero_copy:
+            data = segment.buf[start:start + size]
+            _keep_mapped(segment)
+            return data
+        try:
+            if state == self.WRITING:
+                # deleted, or still being written by another process
+                return self._MISSING
+            with segment.buf[start:start + size] as data:
+                if state == self.RAW:
+                    return data.tobytes()
+                if state == self.BYTEARRAY:
+                    return bytearray(data)
+                return pickle.loads(data)
+        finally:
+            segment.close()
+
+    def _open(self, name, size=0):
+        """
+        Attaches to, or with size creates, the segment called name without
+        leaving it registered with the resource tracker, as segments
+        outlive the processes that use them
+        """
+        create = size > 0
+        if not _TRACKED:
+            return shared_memory.SharedMemory(name, create, size, track=False)
+        with _tracker_lock:
+            segment = shared_memory.SharedMemory(name, create, size)
+            # POSIX names of segments start with a slash
+            resource_tracker.unregister('/' + name, 'shared_memory')
+        return segment
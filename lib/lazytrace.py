@@ -0,0 +1,415 @@
+'''
+Access traces of LazyDicts and an offline planner of eager loading.
+
+A TracedLazyDict records every lookup, whether it hit a resolved value or
+missed a stub, and the latency and size of every resolution to a
+TraceRecorder. The recorder queues events without locking and appends
+them in bulk to a compact binary trace file, one fixed-size struct per
+event, with the repr of each key written once.
+
+plan() replays the traces of one or more runs and recommends, for each
+traced dict:
+ * an eager set - keys read in most runs, to load at startup
+ * a prefetch order - the other keys, by when runs first read them
+ * a cache size - for BoundedLazyDict, from an LRU replay of the lookups
+with the latency and memory each of them is projected to save.
+
+Example:
+
+    with TraceRecorder('/tmp/app.trace') as trace:
+        d = TracedLazyDict()
+        d.set_tracer(trace, 'users')
+        d.set_stub('alice', load_user)
+        serve(d)
+
+    PYTHONPATH=lib python lib/lazytrace.py /tmp/app-*.trace
+
+'''
+import argparse
+import json
+import struct
+import sys
+import threading
+from collections import OrderedDict, deque
+
+from lazydict import LazyDict, _clock
+
+__all__ = ["TraceRecorder", "TracedLazyDict", "read_trace", "plan"]
+
+
+MAGIC = b'LZTR\x01'
+KEY, HIT, MISS, RESOLVE = 0, 1, 2, 3
+# kind, key id, name length, repr length, followed by name and repr
+_KEY = struct.Struct('!BIHH')
+# kind, key id, microseconds since the start of the trace
+_ACCESS = struct.Struct('!BIQ')
+# kind, key id, microseconds since the start, latency in microseconds and
+# size in bytes
+_RESOLVE = struct.Struct('!BIQII')
+_MAX_REPR = 1024
+
+
+class TraceRecorder(object):
+    """
+    Writes lookup and resolution events of TracedLazyDicts to path.
+
+    Events are queued and written once buffer_events of them are pending,
+    and by flush() and close(). A recorder may be shared by dicts and
+    threads; recording an event of a known key takes no lock.
+    """
+    buffer_events = 4096
+
+    def __init__(self, path):
+        # events are buffered by the recorder
+        self._fp = open(path, 'wb', 0)
+        self._fp.write(MAGIC)
+        self._events = deque()
+        self._ids = {}
+        self._lock = threading.Lock()
+        self._start = _clock()
+
+    def _id(self, name, key):
+        """
+        Returns the id of key in the dict called name, queueing a record
+        of the key when it is first seen
+        """
+        with self._lock:
+            key_id = self._ids.get((name, key))
+            if key_id is None:
+                key_id = len(self._ids)
+                # queued before the id is used by any event
+                self._events.append((KEY, key_id, name, key))
+                self._ids[name, key] = key_id
+        return key_id
+
+    def access(self, name, key, hit):
+        """
+        Records a lookup of key, which hit a resolved value or missed
+        """
+        key_id = self._ids.get((name, key))
+        if key_id is None:
+            key_id = self._id(name, key)
+        events = self._events
+        events.append((HIT if hit else MISS, key_id, _clock()))
+        if len(events) >= self.buffer_events:
+            self.flush()
+
+    def resolution(self, name, key, seconds, size):
+        """
+        Records that resolving key took seconds and returned size bytes
+        """
+        key_id = self._ids.get((name, key))
+        if key_id is None:
+            key_id = self._id(name, key)
+        events = self._events
+        events.append((RESOLVE, key_id, _clock(), seconds, size))
+        if len(events) >= self.buffer_events:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the queued events
+        """
+        with self._lock:
+            if self._fp.closed:
+                return
+            start = self._start
+            events = self._events
+            data = bytearray()
+            while True:
+                try:
+                    event = events.popleft()
+                except IndexError:
+                    break
+                kind = event[0]
+                if kind == KEY:
+                    name = event[2].encode('utf-8')[:_MAX_REPR]
+                    text = repr(event[3]).encode('utf-8')[:_MAX_REPR]
+                    data += _KEY.pack(KEY, event[1], len(name), len(text))
+                    data += name + text
+                elif kind == RESOLVE:
+                    data += _RESOLVE.pack(
+                        RESOLVE, event[1], int((event[2] - start) * 1e6),
+                        min(int(event[3] * 1e6), 0xffffffff),
+                        min(event[4], 0xffffffff))
+                else:
+                    data += _ACCESS.pack(kind, event[1],
+                                         int((event[2] - start) * 1e6))
+            self._fp.write(data)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TracedLazyDict(LazyDict):
+    """
+    LazyDict that records its lookups and resolutions to a TraceRecorder.
+
+    Sizes of resolved values are measured with sizeof, which does not
+    follow references by default.
+    """
+    sizeof = staticmethod(sys.getsizeof)
+    _tracer = None
+    _name = 'default'
+    _freezable = False
+
+    def set_tracer(self, tracer, name='default'):
+        """
+        Records to the TraceRecorder tracer, under name. None stops
+        recording.
+        """
+        self._tracer = tracer
+        self._name = name
+
+    def __getitem__(self, key):
+        tracer = self._tracer
+        if tracer is not None:
+            tracer.access(self._name, key, dict.__contains__(self, key))
+        return dict.__getitem__(self, key)
+
+    def _call(self, keys, batch, func):
+        if self._tracer is None:
+            return LazyDict._call(self, keys, batch, func)
+        start = _clock()
+        result = LazyDict._call(self, keys, batch, func)
+        self._trace_resolution(keys, batch, result, _clock() - start)
+        return result
+
+    def _record_job(self, keys, batch, func, outcome):
+        result, error, elapsed = outcome
+        if self._tracer is not None and error is None:
+            self._trace_resolution(keys, batch, result, elapsed)
+
+    def _trace_resolution(self, keys, batch, result, elapsed):
+        tracer = self._tracer
+        if batch is None:
+            tracer.resolution(self._name, keys[0], elapsed,
+                              self.sizeof(result))
+        else:
+            for key in keys:
+                if key in result:
+                    tracer.resolution(self._name, key, elapsed,
+                                      self.sizeof(result[key]))
+
+
+def read_trace(path):
+    """
+    Yields the events of the trace at path as (kind, name, key, seconds,
+    latency, size) tuples, kind being 'hit', 'miss' or 'resolve', key the
+    repr of the key and seconds the time since the start of the trace.
+    latency and size are None for lookups.
+
+    Raises ValueError if path does not hold a trace.
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("%s is not a LazyDict trace" % path)
+    keys = {}
+    kinds = {HIT: 'hit', MISS: 'miss'}
+    pos = len(MAGIC)
+    size = len(data)
+    while pos < size:
+        kind = data[pos] if not isinstance(data, str) else ord(data[pos])
+        if kind == KEY:
+            kind, key_id, name_len, repr_len = _KEY.unpack_from(data, pos)
+            pos += _KEY.size
+            name = data[pos:pos + name_len].decode('utf-8', 'replace')
+            pos += name_len
+            key = data[pos:pos + repr_len].decode('utf-8', 'replace')
+            pos += repr_len
+            keys[key_id] = (name, key)
+        elif kind == RESOLVE:
+            kind, key_id, now, latency, value_size = \
+                _RESOLVE.unpack_from(data, pos)
+            pos += _RESOLVE.size
+            yield ('resolve',) + keys[key_id] + (now / 1e6, latency / 1e6,
+                                                 value_size)
+        else:
+            kind, key_id, now = _ACCESS.unpack_from(data, pos)
+            pos += _ACCESS.size
+            yield (kinds[kind],) + keys[key_id] + (now / 1e6, None, None)
+
+
+class _KeyStats(object):
+    """
+    Statistics of one key over all replayed runs
+    """
+    __slots__ = ('runs', 'ranks', 'latency', 'resolutions', 'size')
+
+    def __init__(self):
+        self.runs = 0
+        self.ranks = 0
+        self.latency = 0.0
+        self.resolutions = 0
+        self.size = 0
+
+    def mean_latency(self):
+        return self.latency / self.resolutions if self.resolutions else 0.0
+
+
+def _replay(paths):
+    """
+    Returns the key statistics and the lookup sequence of each run of
+    each dict, by dict name
+    """
+    dicts = {}
+    for path in paths:
+        runs = {}
+        for kind, name, key, now, latency, size in read_trace(path):
+            stats, lookups = dicts.setdefault(name, ({}, []))
+            stat = stats.get(key)
+            if stat is None:
+                stat = stats[key] = _KeyStats()
+            run = runs.get(name)
+            if run is None:
+                run = runs[name] = []
+                lookups.append(run)
+            if kind == 'resolve':
+                stat.latency += latency
+                stat.resolutions += 1
+                stat.size = max(stat.size, size)
+            else:
+                run.append(key)
+        for name, run in runs.items():
+            stats = dicts[name][0]
+            first = OrderedDict.fromkeys(run)
+            for rank, key in enumerate(first):
+                stats[key].runs += 1
+                stats[key].ranks += rank
+    return dicts
+
+
+def _lru_misses(runs, capacity):
+    """
+    Returns the lookups of runs that miss an LRU cache of capacity keys,
+    as a dict of the number of misses of each key
+    """
+    misses = {}
+    for run in runs:
+        cache = OrderedDict()
+        for key in run:
+            if key in cache:
+                cache.move_to_end(key)
+                continue
+            misses[key] = misses.get(key, 0) + 1
+            cache[key] = None
+            if len(cache) > capacity:
+                cache.popitem(last=False)
+    return misses
+
+
+def _plan_dict(stats, runs, min_share, hit_rate):
+    count = max(len(runs), 1)
+    # keys that were never resolved were not stubs
+    stubs = dict((key, stat) for key, stat in stats.items()
+                 if stat.resolutions)
+    share = dict((key, float(stat.runs) / count)
+                 for key, stat in stubs.items())
+    eager = sorted((k for k in stubs if share[k] >= min_share),
+                   key=lambda k: (-share[k], stubs[k].ranks / max(
+                       stubs[k].runs, 1)))
+    lazy = [k for k in stubs if share[k] < min_share]
+    read = [k for k in lazy if stubs[k].runs]
+    order = sorted(read, key=lambda k: stubs[k].ranks / stubs[k].runs)
+
+    def latency(keys, weighted=True):
+        return sum(stubs[k].mean_latency() * (share[k] if weighted else 1)
+                   for k in keys)
+
+    # explicitly set values are never evicted, only stubs are cached
+    runs = [[k for k in run if k in stubs] for run in runs]
+    lookups = sum(len(run) for run in runs)
+    sizes = sorted((stubs[k].size for k in stubs), reverse=True)
+    curve = []
+    capacity = 1
+    distinct = max(len(stubs), 1)
+    while True:
+        capacity = min(capacity, distinct)
+        misses = _lru_misses(runs, capacity)
+        curve.append({
+            'capacity': capacity,
+            'hit_rate': 1 - float(sum(misses.values())) / lookups
+            if lookups else 0.0,
+            'resolve_seconds_per_run': sum(
+                stubs[k].mean_latency() * n for k, n in misses.items()) /
+            count,
+            'memory_bytes': sum(sizes[:capacity]),
+        })
+        if capacity >= distinct:
+            break
+        capacity *= 2
+    best = curve[-1]['hit_rate']
+    cache = next(point for point in curve
+                 if point['hit_rate'] >= best * hit_rate)
+    return {
+        'runs': len(runs),
+        'keys': len(stats),
+        'stubs': len(stubs),
+        'eager': {
+            'keys': eager,
+            'startup_seconds': latency(eager, False),
+            'memory_bytes': sum(stubs[k].size for k in eager),
+            'saved_seconds_per_run': latency(eager),
+        },
+        'lazy': {
+            'count': len(lazy),
+            'saved_startup_seconds': latency(lazy, False),
+            'saved_memory_bytes': sum(stubs[k].size * (1 - share[k])
+                                      for k in lazy),
+        },
+        'prefetch': {
+            'order': order,
+            'saved_seconds_per_run': latency(order),
+        },
+        'cache': dict(cache, curve=curve),
+    }
+
+
+def plan(paths, min_share=0.5, hit_rate=0.95):
+    """
+    Replays the traces at paths, one per run, and returns the
+    recommendations for each traced dict, by name, as a JSON-serializable
+    dict.
+
+    Keys read in at least min_share of the runs are recommended for
+    eager loading. The recommended cache is the smallest whose LRU hit
+    rate reaches hit_rate of that of an unbounded one. Projected savings
+    are averages per run: eager keys move their resolution latency out of
+    lookups, prefetched keys at most theirs, and lazy keys save their
+    startup latency and the memory of the runs that do not read them.
+    """
+    dicts = _replay(paths)
+    return dict((name, _plan_dict(stats, runs, min_share, hit_rate))
+                for name, (stats, runs) in dicts.items())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('traces', nargs='+')
+    parser.add_argument('--min-share', type=float, default=0.5,
+                        help='share of runs reading a key to load it eagerly')
+    parser.add_argument('--hit-rate', type=float, default=0.95,
+                        help='share of the unbounded hit rate to size the '
+                        'cache for')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args(argv)
+    document = plan(args.traces, args.min_share, args.hit_rate)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(document, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
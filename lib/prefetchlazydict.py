@@ -0,0 +1,188 @@
+'''
+PrefetchingLazyDict is a ConcurrentLazyDict that resolves the stubs
+it expects to be read next in the background.
+
+A Prefetcher predicts the next keys from a hint graph, from key-to-key
+transitions it learns from the order of lookups in each thread, or both.
+After every lookup it submits up to budget predicted stubs to an executor.
+Queued prefetches that turn out to be wrong are cancelled on the next
+lookup. Foreground lookups share in-flight prefetches instead of running
+the resolver again.
+
+Example:
+
+    prefetcher = Prefetcher(hints={'user': ['profile', 'permissions']})
+    d = PrefetchingLazyDict()
+    d.set_prefetcher(prefetcher)
+    d.set_stub('user', load_user)
+    d.set_stub('profile', load_profile)
+    d.set_stub('permissions', load_permissions)
+
+    x = d['user']                    # resolving user, prefetching the rest
+    y = d['profile']                 # already resolved
+    print(prefetcher.counters())     # {'hits': 1, 'issued': 2, ...}
+
+'''
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from concurrentlazydict import ConcurrentLazyDict
+
+__all__ = ["PrefetchingLazyDict", "Prefetcher"]
+
+
+class Prefetcher(object):
+    """
+    Predicts and resolves the stubs that are likely to be read next.
+
+    budget is the maximum number of prefetches issued per lookup.
+    A learned transition is followed if it was taken in at least
+    threshold of the cases. Prefetches run on executor, or on a
+    thread pool of max_workers owned by the prefetcher.
+
+    At most max_transitions learned transitions are kept, the table is
+    emptied when it is full. Likewise, at most max_unused prefetched
+    keys that have not been read yet are remembered for the hit counter.
+    """
+    max_transitions = 10000
+    max_unused = 10000
+
+    def __init__(self, hints=None, learn=True, budget=2, threshold=0.2,
+                 executor=None, max_workers=2):
+        self.hints = hints or {}
+        self.learn = learn
+        self.budget = budget
+        self.threshold = threshold
+        self._owned = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers)
+        self._transitions = {}
+        self._learned = 0
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._unused = set()
+        self.stats = {'issued': 0, 'completed': 0, 'cancelled': 0,
+                      'failed': 0, 'hits': 0}
+
+    def predict(self, key):
+        """
+        Returns the keys expected to follow key, most likely first
+        """
+        keys = list(self.hints.get(key, ()))
+        following = self._transitions.get(key) if self.learn else None
+        if following:
+            # copied at once, other threads learn without locking
+            following = list(following.items())
+            total = float(sum(count for k, count in following))
+            ranked = sorted(following, key=lambda item: -item[1])
+            keys.extend(k for k, count in ranked
+                        if count / total >= self.threshold and k not in keys)
+        return keys[:self.budget]
+
+    def observe(self, mapping, key):
+        """
+        Records a lookup of key in mapping and prefetches its successors
+
+        Lookups that find no prefetch to count, cancel or issue, like most
+        lookups of resolved keys, do not take the lock.
+        """
+        last = getattr(self._local, 'last', self)
+        self._local.last = key
+        if self.learn and last is not self and last != key:
+            self._learn(last, key)
+        if key in self._unused:
+            with self._lock:
+                if key in self._unused:
+                    self._unused.discard(key)
+                    self.stats['hits'] += 1
+        predicted = self.predict(key)
+        stubs = mapping._stubs
+        if not self._pending and not any(k in stubs for k in predicted):
+            return
+        with self._lock:
+            for pending_key, future in list(self._pending.items()):
+                if pending_key != key and pending_key not in predicted and \
+                        future.cancel():
+                    self._pending.pop(pending_key, None)
+            for next_key in predicted:
+                if next_key in self._pending or next_key not in stubs:
+                    continue
+                future = self._executor.submit(mapping._resolve_one,
+                                               next_key, False)
+                self._pending[next_key] = future
+                self.stats['issued'] += 1
+                future.add_done_callback(
+                    lambda f, k=next_key: self._done(k, f))
+
+    def _learn(self, last, key):
+        """
+        Counts a lookup of key following a lookup of last, without locking,
+        so that concurrent lookups may lose a count
+        """
+        following = self._transitions.get(last)
+        if following is None:
+            following = self._transitions[last] = {}
+        count = following.get(key)
+        if count is None:
+            if self._learned >= self.max_transitions:
+                self._transitions.clear()
+                self._learned = 0
+                following = self._transitions[last] = {}
+            self._learned += 1
+            count = 0
+        following[key] = count + 1
+
+    def counters(self):
+        """
+        Returns the counters with the derived hit rate and waste.
+
+        wasted counts prefetched values that have not been read yet.
+        """
+        with self._lock:
+            counters = dict(self.stats)
+        completed = counters['completed']
+        counters['wasted'] = completed - counters['hits']
+        counters['hit_rate'] = (float(counters['hits']) / completed
+                                if completed else 0.0)
+        return counters
+
+    def close(self):
+        """
+        Cancels queued prefetches and shuts down the owned executor
+        """
+        with self._lock:
+            for future in list(self._pending.values()):
+                future.cancel()
+        if self._owned:
+            self._executor.shutdown()
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+            if future.cancelled():
+                self.stats['cancelled'] += 1
+            elif future.exception() is not None:
+                self.stats['failed'] += 1
+            else:
+                self.stats['completed'] += 1
+                if len(self._unused) >= self.max_unused:
+                    self._unused.clear()
+                self._unused.add(key)
+
+
+class PrefetchingLazyDict(ConcurrentLazyDict):
+    _prefetcher = None
+    _freezable = False
+
+    def __getitem__(self, key):
+        prefetcher = self._prefetcher
+        if prefetcher is not None:
+            prefetcher.observe(self, key)
+        return dict.__getitem__(self, key)
+
+    def set_prefetcher(self, prefetcher):
+        """
+        Sets the Prefetcher observing lookups of this dict
+        """
+        self._prefetcher = prefetcher
@@ -0,0 +1,240 @@
+'''
+RecordLazyDict exposes a large JSONL or CSV record file as a LazyDict
+keyed by one of its fields.
+
+The file is memory-mapped and scanned once to build an index from each
+key to the byte offset of its record. Every record is a stub that parses
+just that record when it is looked up. The index is saved to a sidecar
+file next to the records, so later startups load it instead of scanning
+the file again, as long as the file has not changed. resolve() reads the
+records in file order, so a full resolution reads the file sequentially.
+
+Example:
+
+    users = RecordLazyDict.from_jsonl('/data/users.jsonl', key='id')
+    print(len(users))                # read from users.jsonl.idx
+    x = users[1042]                  # parses a single line
+
+    orders = RecordLazyDict.from_csv('/data/orders.csv', key='order_id')
+
+'''
+import csv
+import json
+import mmap
+import os
+from array import array
+
+from lazydict import LazyDict, Stub
+
+__all__ = ["RecordLazyDict",]
+
+
+def _as_json(value):
+    """
+    Returns value as read back from JSON, with lists in place of tuples
+    """
+    return json.loads(json.dumps(value))
+
+
+def _records(buf, quote=None):
+    """
+    Yields the offset and bytes of each non-empty record in buf.
+
+    Records are lines. With quote, a line with an odd number of quote
+    characters continues on the next line, as in CSV.
+    """
+    pos = 0
+    size = len(buf)
+    while pos < size:
+        end = _record_end(buf, pos, quote)
+        record = buf[pos:end].rstrip(b'\r\n')
+        if record:
+            yield pos, record
+        pos = end
+
+
+def _record_end(buf, pos, quote=None):
+    """
+    Returns the offset after the record starting at pos
+    """
+    quotes = 0
+    while True:
+        end = buf.find(b'\n', pos)
+        end = len(buf) if end < 0 else end + 1
+        if quote is None:
+            return end
+        quotes += buf[pos:end].count(quote)
+        if not quotes % 2 or end == len(buf):
+            return end
+        pos = end
+
+
+class RecordLazyDict(LazyDict):
+    """
+    LazyDict of the records of a JSONL or CSV file.
+
+    Stubs of records are stored as the offsets of the records, a Stub is
+    only created when one is resolved.
+    """
+    index_version = 2
+    encoding = 'utf-8'
+    _buf = None
+    _format = None
+    _fieldnames = None
+    _csv_params = None
+
+    @classmethod
+    def from_jsonl(cls, path, key, index_path=None):
+        """
+        Returns a dict of the JSON objects in the lines of the file at path.
+
+        key is the name of the field holding the key of each record, or a
+        callable returning it from a parsed record. The index is saved to
+        index_path, path + '.idx' by default; False does not save it.
+        """
+        d = cls()
+        d._open(path, 'jsonl', key, index_path, {})
+        return d
+
+    @classmethod
+    def from_csv(cls, path, key, index_path=None, **fmtparams):
+        """
+        Returns a dict of the rows of the CSV file at path as dicts
+        mapping the names in its header to values.
+
+        key and index_path are as in from_jsonl. fmtparams are passed
+        on to csv.reader.
+        """
+        d = cls()
+        d._open(path, 'csv', key, index_path, fmtparams)
+        return d
+
+    def copy(self):
+        x = LazyDict.copy(self)
+        x._buf = self._buf
+        x._format = self._format
+        x._fieldnames = self._fieldnames
+        x._csv_params = self._csv_params
+        return x
+
+    def _open(self, path, format, key, index_path, fmtparams):
+        self._format = format
+        self._csv_params = fmtparams
+        with open(path, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            self._buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) \
+                if stat.st_size else b''
+        if index_path is None:
+            index_path = path + '.idx'
+        source = {
+            'version': self.index_version,
+            'format': format,
+            'key': key if not callable(key) else None,
+            'params': sorted(fmtparams.items()),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        }
+        if index_path and source['key'] is not None:
+            index = self._load_index(index_path, source)
+            if index is not None:
+                return
+        self._scan(key)
+        if index_path and source['key'] is not None:
+            self._save_index(index_path, source)
+
+    def _scan(self, key):
+        """
+        Builds the index by parsing every record of the file
+        """
+        get = key if callable(key) else (lambda record: record[key])
+        stubs = self._stubs
+        records = _records(self._buf, self._quote())
+        if self._format == 'csv':
+            for offset, header in records:
+                self._fieldnames = self._parse_csv(header)
+                break
+        for offset, record in records:
+            stubs[get(self._parse(record))] = offset
+
+    def _load_index(self, index_path, source):
+        """
+        Loads the index from index_path if it was saved for the file
+        in its current state, and returns True or None
+
+        The index is a JSON header line, one JSON line per key and the
+        offsets as an array of 64-bit integers. An index that cannot be
+        read in any way is stale.
+        """
+        try:
+            with open(index_path, 'rb') as fp:
+                header = json.loads(fp.readline().decode('utf-8'))
+                if header['source'] != _as_json(source):
+                    return None
+                keys = [json.loads(fp.readline().decode('utf-8'))
+                        for i in range(header['count'])]
+                offsets = array('q')
+                offsets.fromfile(fp, header['count'])
+            index = dict(zip(keys, offsets))
+            fieldnames = header['fieldnames']
+        except Exception:
+            return None
+        self._fieldnames = fieldnames
+        self._stubs.update(index)
+        return True
+
+    def _save_index(self, index_path, source):
+        keys = []
+        offsets = array('q')
+        for key, stored in self._stubs.items():
+            keys.append(key)
+            offsets.append(stored)
+        try:
+            header = json.dumps({'source': _as_json(source),
+                                 'fieldnames': self._fieldnames,
+                                 'count': len(keys)})
+            lines = [json.dumps(key) for key in keys]
+        except (TypeError, ValueError):
+            # format parameters or keys JSON cannot hold, scanned each time
+            return
+        tmp = '%s.%d.tmp' % (index_path, os.getpid())
+        with open(tmp, 'wb') as fp:
+            fp.write(('\n'.join([header] + lines) + '\n').encode('utf-8'))
+            offsets.tofile(fp)
+        os.rename(tmp, index_path)
+
+    def _quote(self):
+        if self._format != 'csv':
+            return None
+        return self._csv_params.get('quotechar', '"').encode(self.encoding)
+
+    def _parse_csv(self, record):
+        text = record.decode(self.encoding)
+        return next(csv.reader([text], **self._csv_params))
+
+    def _parse(self, record):
+        if self._format == 'csv':
+            return dict(zip(self._fieldnames, self._parse_csv(record)))
+        return json.loads(record.decode(self.encoding))
+
+    def _read(self, key, offset):
+        """
+        Parses the record at offset
+        """
+        end = _record_end(self._buf, offset, self._quote())
+        return self._parse(self._buf[offset:end].rstrip(b'\r\n'))
+
+    def _get_stub(self, key, default=None):
+        stored = self._stubs.get(key, default)
+        if isinstance(stored, int):
+            return Stub(self._read, key, (stored,))
+        return LazyDict._get_stub(self, key, default)
+
+    def _jobs(self, keys):
+        """
+        Groups stub keys into resolution jobs, records in file order
+        """
+        stubs = self._stubs
+        def order(key):
+            stored = stubs.get(key)
+            return stored if isinstance(stored, int) else -1
+        return LazyDict._jobs(self, sorted(keys, key=order))
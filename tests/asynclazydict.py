@@ -0,0 +1,235 @@
+import asyncio
+import unittest
+
+from lazydict import BatchResolver, FailurePolicy, MemoCache, CostModel
+from asynclazydict import AsyncLazyDict
+
+def run(coro):
+    return asyncio.run(coro)
+
+class AsyncLazyDictTestCase(unittest.TestCase):
+    def test_aget(self):
+        calls = []
+        async def resolver(key, suffix=''):
+            calls.append(key)
+            await asyncio.sleep(0)
+            return key + suffix
+        d = AsyncLazyDict({'a': 1})
+        d.set_stub('b', resolver, suffix='!')
+        d.set_stub('c', lambda x: x)
+        self.assertEqual(len(d), 3)
+        self.assertTrue('b' in d)
+        self.assertEqual(run(d.aget('a')), 1)
+        self.assertEqual(run(d.aget('b')), 'b!')
+        self.assertEqual(run(d.aget('c')), 'c')
+        self.assertIs(run(d.aget('x')), None)
+        self.assertEqual(run(d.aget('x', 5)), 5)
+        self.assertEqual(d['b'], 'b!')
+        self.assertEqual(calls, ['b'])
+        self.assertEqual(len(d._stubs), 0)
+
+    def test_aget_single_flight(self):
+        calls = []
+        async def resolver(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return key
+        d = AsyncLazyDict()
+        d.set_resolver(resolver)
+        d.set_stub('a')
+        async def main():
+            return await asyncio.gather(*[d.aget('a') for i in range(5)])
+        self.assertEqual(run(main()), ['a'] * 5)
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(d._inflight, {})
+
+    def test_sync_access_to_async_stub(self):
+        async def resolver(key):
+            return key
+        d = AsyncLazyDict()
+        d.set_stub('a', resolver)
+        self.assertRaises(TypeError, d.__getitem__, 'a')
+        self.assertRaises(TypeError, d.resolve)
+        self.assertEqual(len(d._stubs), 1)
+
+    def test_aresolve(self):
+        state = {'running': 0, 'peak': 0}
+        async def resolver(key):
+            state['running'] += 1
+            state['peak'] = max(state['peak'], state['running'])
+            await asyncio.sleep(0.001)
+            state['running'] -= 1
+            return key * 2
+        async def fetch(keys):
+            return dict((k, -k) for k in keys)
+        d = AsyncLazyDict()
+        for i in range(20):
+            d.set_stub(i, resolver)
+        batch = BatchResolver(fetch, chunk_size=2)
+        for i in range(100, 105):
+            d.set_stub(i, batch)
+        report = run(d.aresolve(concurrency=3))
+        self.assertEqual(len(report.resolved), 25)
+        self.assertEqual(state['peak'], 3)
+        self.assertEqual(len(d._stubs), 0)
+        self.assertEqual(d[7], 14)
+        self.assertEqual(d[101], -101)
+
+    def test_aresolve_errors(self):
+        async def resolver(key):
+            if key % 2:
+                raise ValueError(key)
+            return key
+        d = AsyncLazyDict()
+        for i in range(6):
+            d.set_stub(i, resolver)
+        report = run(d.aresolve(errors='collect'))
+        self.assertEqual(sorted(report.failed), [1, 3, 5])
+        self.assertEqual(sorted(d._stubs), [1, 3, 5])
+        self.assertRaises(ValueError, run, d.aresolve())
+        self.assertEqual(sorted(d._stubs), [1, 3, 5])
+
+    def test_aitems_avalues(self):
+        async def resolver(key):
+            return key.upper()
+        d = AsyncLazyDict({'a': 'A'})
+        d.set_stub('b', resolver)
+        d.set_stub('c', lambda x: x)
+        async def collect(aiter):
+            return [x async for x in aiter]
+        self.assertEqual(sorted(run(collect(d.aitems()))),
+                         [('a', 'A'), ('b', 'B'), ('c', 'c')])
+        self.assertEqual(sorted(run(collect(d.avalues()))), ['A', 'B', 'c'])
+
+    def test_aget_batch(self):
+        calls = []
+        async def fetch(keys):
+            calls.append(sorted(keys))
+            await asyncio.sleep(0)
+            return dict((k, k.upper()) for k in keys)
+        batch = BatchResolver(fetch)
+        d = AsyncLazyDict({'a': 'A'})
+        for key in 'bcd':
+            d.set_stub(key, batch)
+        self.assertEqual(run(d.aget('b')), 'B')
+        async def collect(aiter):
+            return [x async for x in aiter]
+        self.assertEqual(sorted(run(collect(d.aitems()))),
+                         [('a', 'A'), ('b', 'B'), ('c', 'C'), ('d', 'D')])
+        self.assertEqual(calls, [['b'], ['c'], ['d']])
+        self.assertEqual(len(d._stubs), 0)
+
+    def test_aget_failure_policy(self):
+        calls = []
+        async def resolver(key):
+            calls.append(key)
+            raise ValueError(key)
+        d = AsyncLazyDict()
+        d.set_failure_policy(FailurePolicy(negative_ttl=100))
+        d.set_stub('a', resolver)
+        for i in range(3):
+            self.assertRaises(ValueError, run, d.aget('a'))
+        self.assertEqual(calls, ['a'])
+
+    def test_aget_memo_store_cost(self):
+        calls = []
+        async def resolver(key):
+            calls.append(key)
+            return key.upper()
+        async def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k.upper()) for k in keys)
+        class Store(dict):
+            def get(self, key):
+                return self[key]
+            def set(self, key, value):
+                self[key] = value
+        batch = BatchResolver(fetch)
+        cache, store, model = MemoCache(), Store(), CostModel(default=1.0)
+        for i in range(2):
+            d = AsyncLazyDict()
+            d.set_memo(cache)
+            d.set_stub('a', resolver)
+            d.set_stub('b', batch)
+            d.set_stub('c', batch)
+            self.assertEqual(run(d.aget('a')), 'A')
+            self.assertEqual(run(d.aget('b')), 'B')
+            run(d.aresolve())
+            self.assertEqual(d['c'], 'C')
+        self.assertEqual(calls, ['a', ['b'], ['c']])
+        self.assertEqual(cache.stats()['hits'], 3)
+
+        d = AsyncLazyDict()
+        d.set_store(store)
+        d.set_cost_model(model)
+        d.set_stub('d', resolver)
+        d.set_stub('e', batch)
+        d.set_stub('f', batch)
+        self.assertEqual(run(d.aget('d')), 'D')
+        run(d.aresolve())
+        self.assertEqual(store, {'d': 'D', 'e': 'E', 'f': 'F'})
+        self.assertLess(model.estimate(resolver), 1.0)
+        self.assertLess(model.estimate(batch), 1.0)
+        x = AsyncLazyDict()
+        x.set_store(store)
+        x.set_stub('d', resolver)
+        self.assertEqual(run(x.aget('d')), 'D')
+        self.assertEqual(calls, ['a', ['b'], ['c'], 'd', ['e', 'f']])
+
+    def test_keyspace(self):
+        calls = []
+        async def resolver(key):
+            calls.append(key)
+            return key * 2
+        d = AsyncLazyDict()
+        d.add_keyspace(range(5), resolver)
+        self.assertTrue(3 in d)
+        async def main():
+            return await asyncio.gather(*[d.aget(3) for i in range(3)])
+        self.assertEqual(run(main()), [6] * 3)
+        self.assertEqual(run(d.aget(7, 'DEFAULT')), 'DEFAULT')
+        report = run(d.aresolve())
+        self.assertEqual(sorted(report.resolved), [0, 1, 2, 4])
+        self.assertEqual(dict(d), dict((i, i * 2) for i in range(5)))
+        self.assertEqual(sorted(calls), [0, 1, 2, 3, 4])
+
+    def test_dependencies(self):
+        calls = []
+        async def resolver(key):
+            calls.append(key)
+            await asyncio.sleep(0)
+            return key.upper()
+        d = AsyncLazyDict()
+        d.set_resolver(resolver)
+        for key in 'abcd':
+            d.set_stub(key)
+        d.set_dependencies('a', ['b'])
+        d.set_dependencies('b', ['c'])
+        self.assertEqual(run(d.aget('a')), 'A')
+        self.assertEqual(calls, ['c', 'b', 'a'])
+        self.assertEqual(d['b'], 'B')
+
+        d = AsyncLazyDict()
+        d.set_resolver(resolver)
+        for key in 'abcd':
+            d.set_stub(key)
+        d.set_dependencies('a', ['b', 'c'])
+        d.set_dependencies('c', ['d'])
+        del calls[:]
+        run(d.aresolve())
+        self.assertEqual(calls[-1], 'a')
+        self.assertLess(calls.index('d'), calls.index('c'))
+        self.assertEqual(len(d._stubs), 0)
+
+    def test_copy(self):
+        async def resolver(key):
+            return key
+        d = AsyncLazyDict({'a': 1})
+        d.set_stub('b', resolver)
+        x = d.copy()
+        self.assertTrue(isinstance(x, AsyncLazyDict))
+        self.assertEqual(run(x.aget('b')), 'b')
+        self.assertEqual(len(d._stubs), 1)
+
+if __name__ == '__main__':
+    unittest.main()
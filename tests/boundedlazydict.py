@@ -0,0 +1,120 @@
+import unittest
+
+from lazydict import BatchResolver
+from boundedlazydict import BoundedLazyDict, LRUPolicy, LFUPolicy
+
+class BoundedLazyDictTestCase(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def resolver(self, key):
+        self.calls.append(key)
+        return key * 2
+
+    def make(self, size, capacity, policy):
+        d = BoundedLazyDict({'real': 0})
+        d.set_capacity(capacity, policy)
+        for i in range(size):
+            d.set_stub(i, self.resolver)
+        return d
+
+    def test_lru(self):
+        d = self.make(5, 2, 'lru')
+        self.assertEqual(d[0], 0)
+        self.assertEqual(d[1], 2)
+        self.assertEqual(d[0], 0)
+        self.assertEqual(d[2], 4)
+        # 1 was least recently used
+        self.assertIn(1, d._stubs)
+        self.assertNotIn(0, d._stubs)
+        self.assertEqual(d.evictions, 1)
+        self.assertEqual(len(d), 6)
+        self.assertIn(1, d)
+        self.assertEqual(set(d), {'real', 0, 1, 2, 3, 4})
+        self.assertEqual(d[1], 2)
+        self.assertEqual(self.calls, [0, 1, 2, 1])
+
+    def test_lfu(self):
+        d = self.make(5, 2, 'lfu')
+        for i in range(3):
+            d[0]
+        d[1]
+        d[1]
+        d[2]
+        # 1 was accessed less often than 0
+        self.assertIn(1, d._stubs)
+        self.assertNotIn(0, d._stubs)
+        d[3]
+        self.assertIn(2, d._stubs)
+        self.assertEqual(d.evictions, 2)
+        self.assertEqual(len(d), 6)
+
+    def test_explicit_values_are_kept(self):
+        d = self.make(3, 1, 'lru')
+        d['x'] = 1
+        d[0]
+        d[1]
+        d[2]
+        self.assertEqual(dict.__getitem__(d, 'x'), 1)
+        self.assertEqual(dict.__getitem__(d, 'real'), 0)
+        d[2] = 'explicit'
+        d[0]
+        self.assertEqual(d[2], 'explicit')
+        del d[0]
+        self.assertNotIn(0, d)
+        self.assertEqual(len(d._origins), 0)
+
+    def test_resolve_and_items(self):
+        d = self.make(10, 3, 'lru')
+        self.assertEqual(len(d.resolve().resolved), 10)
+        self.assertEqual(len(d._origins), 3)
+        self.assertEqual(len(d), 11)
+        self.assertEqual(dict((k, d[k]) for k in list(d)),
+                         dict([('real', 0)] + [(i, i * 2) for i in range(10)]))
+        self.assertEqual(len(d._origins), 3)
+
+    def test_batch_larger_than_capacity(self):
+        calls = []
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k * 2) for k in keys)
+        batch = BatchResolver(fetch)
+        for read in (lambda d: d.get_many(range(5)),
+                     lambda d: dict(d.items())):
+            d = BoundedLazyDict()
+            d.set_capacity(2)
+            for i in range(5):
+                d.set_stub(i, batch)
+            del calls[:]
+            self.assertEqual(read(d), dict((i, i * 2) for i in range(5)))
+            self.assertEqual(calls, [list(range(5))])
+            self.assertEqual(len(d._origins), 2)
+            self.assertEqual(len(d._stubs), 3)
+
+    def test_set_capacity(self):
+        d = self.make(10, None, 'lru')
+        d.resolve()
+        self.assertEqual(len(d._stubs), 0)
+        d.set_capacity(4, 'lfu')
+        self.assertEqual(len(d._stubs), 6)
+        self.assertTrue(isinstance(d._policy, LFUPolicy))
+        d.set_capacity(None)
+        self.assertTrue(isinstance(d._policy, LRUPolicy))
+        d.resolve()
+        self.assertEqual(len(d._stubs), 0)
+
+    def test_copy_and_clear(self):
+        d = self.make(4, 2, 'lru')
+        d[0]
+        x = d.copy()
+        self.assertEqual(x._capacity, 2)
+        x[1]
+        x[2]
+        self.assertIn(0, x._stubs)
+        self.assertNotIn(0, d._stubs)
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(len(d._policy), 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,295 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from lazydict import BatchResolver
+from concurrentlazydict import ConcurrentLazyDict, WarmUp
+
+class ConcurrentLazyDictTestCase(unittest.TestCase):
+    def test_basic(self):
+        d = ConcurrentLazyDict({'a': 1})
+        d.set_stub('b', lambda x: x * 2)
+        self.assertEqual(len(d), 2)
+        self.assertEqual(d['a'], 1)
+        self.assertEqual(d['b'], 'bb')
+        self.assertRaises(KeyError, d.__getitem__, 'c')
+        d['c'] = 3
+        del d['a']
+        self.assertEqual(d, {'b': 'bb', 'c': 3})
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertTrue(isinstance(d.copy(), ConcurrentLazyDict))
+
+    def test_single_flight(self):
+        calls = []
+        def resolver(key):
+            calls.append(key)
+            time.sleep(0.05)
+            return key
+        d = ConcurrentLazyDict()
+        d.set_stub('a', resolver)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: d['a'], range(8)))
+        self.assertEqual(results, ['a'] * 8)
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(d._inflight, {})
+
+    def test_single_flight_error(self):
+        calls = []
+        def resolver(key):
+            calls.append(key)
+            time.sleep(0.05)
+            raise ValueError(key)
+        d = ConcurrentLazyDict()
+        d.set_stub('a', resolver)
+        def get(i):
+            try:
+                return d['a']
+            except ValueError as e:
+                return e
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(get, range(4)))
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertIn('a', d._stubs)
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        self.assertEqual(len(calls), 2)
+
+    def test_unrelated_keys_do_not_wait(self):
+        release = threading.Event()
+        d = ConcurrentLazyDict({'resolved': 0})
+        d.set_stub('slow', lambda k: release.wait(5) and k)
+        d.set_stub('fast', lambda k: k)
+        worker = threading.Thread(target=d.__getitem__, args=('slow',))
+        worker.start()
+        try:
+            while 'slow' not in d._inflight:
+                time.sleep(0.001)
+            self.assertEqual(d['fast'], 'fast')
+            self.assertEqual(d['resolved'], 0)
+        finally:
+            release.set()
+            worker.join()
+        self.assertEqual(d['slow'], 'slow')
+
+    def test_write_during_resolution(self):
+        started = threading.Event()
+        release = threading.Event()
+        def resolver(key):
+            started.set()
+            release.wait(5)
+            return 'resolved'
+        d = ConcurrentLazyDict()
+        d.set_stub('a', resolver)
+        results = []
+        worker = threading.Thread(target=lambda: results.append(d['a']))
+        worker.start()
+        started.wait(5)
+        d['a'] = 'written'
+        release.set()
+        worker.join()
+        self.assertEqual(results, ['resolved'])
+        self.assertEqual(d['a'], 'written')
+
+    def test_resolve(self):
+        calls = []
+        def resolver(key):
+            calls.append(key)
+            return key
+        d = ConcurrentLazyDict()
+        for i in range(50):
+            d.set_stub(i, resolver)
+        d.set_stub('b', BatchResolver(lambda keys: dict((k, k) for k in keys)))
+        d.set_stub('x', lambda k: 1 // 0)
+        report = d.resolve(errors='collect')
+        self.assertEqual(len(report.resolved), 51)
+        self.assertEqual(list(report.failed), ['x'])
+        self.assertEqual(len(report.timings), 52)
+        self.assertEqual(sorted(calls), list(range(50)))
+        self.assertEqual(list(d._stubs), ['x'])
+
+    def test_resolve_single_flight(self):
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+        def fetch(keys):
+            calls.append(sorted(keys))
+            started.set()
+            release.wait(5)
+            return dict((k, k) for k in keys)
+        batch = BatchResolver(fetch)
+        d = ConcurrentLazyDict()
+        d.set_stub('a', batch)
+        d.set_stub('b', batch)
+        worker = threading.Thread(target=d.resolve)
+        worker.start()
+        started.wait(5)
+        threading.Timer(0.05, release.set).start()
+        self.assertEqual(d['a'], 'a')
+        worker.join()
+        self.assertEqual(calls, [['a', 'b']])
+
+        calls = []
+        started.clear()
+        release.clear()
+        def load(key):
+            calls.append(key)
+            started.set()
+            release.wait(5)
+            return key
+        d = ConcurrentLazyDict()
+        d.set_stub('a', load)
+        d.set_stub('c', BatchResolver(fetch))
+        results = []
+        worker = threading.Thread(target=lambda: results.append(
+            d.resolve(executor=ThreadPoolExecutor, max_workers=2)))
+        worker.start()
+        started.wait(5)
+        while 'c' not in d._inflight or 'a' not in d._inflight:
+            time.sleep(0.001)
+        threading.Timer(0.05, release.set).start()
+        self.assertEqual((d['a'], d['c']), ('a', 'c'))
+        worker.join()
+        self.assertEqual(sorted(map(str, calls)), ["['c']", 'a'])
+        self.assertEqual(sorted(results[0].resolved), ['a', 'c'])
+        self.assertEqual(d._inflight, {})
+
+    def test_resolve_parallel_dropped(self):
+        release = threading.Event()
+        d = ConcurrentLazyDict()
+        d.set_stub('a', lambda key: 1 // 0)
+        d.set_stub('b', lambda key: key)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(release.wait, 5)
+            threading.Timer(0.05, release.set).start()
+            self.assertRaises(ZeroDivisionError, d.resolve, executor)
+        # the job of b was dropped, the lookup resolves it
+        self.assertEqual(d['b'], 'b')
+        self.assertEqual(d._inflight, {})
+
+    def test_threaded_stress(self):
+        calls = []
+        d = ConcurrentLazyDict()
+        def resolver(key):
+            calls.append(key)
+            return key * 2
+        for i in range(200):
+            d.set_stub(i, resolver)
+        def read(n):
+            return [d[i] for i in range(200)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(read, range(8)))
+        for r in results:
+            self.assertEqual(r, [i * 2 for i in range(200)])
+        self.assertEqual(sorted(calls), list(range(200)))
+        self.assertEqual(len(d), 200)
+
+    def test_dependencies(self):
+        calls = []
+        d = ConcurrentLazyDict()
+        def load(key):
+            calls.append(key)
+            time.sleep(0.01)
+            return len(calls)
+        d.set_stub('a', load)
+        d.set_stub('b', load)
+        d.set_stub('total', lambda key: d['a'] + d['b'])
+        d.set_dependencies('total', ['a', 'b'])
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda i: d['total'], range(4)))
+        self.assertEqual(results, [3] * 4)
+        self.assertEqual(sorted(calls), ['a', 'b'])
+
+    def test_keyspace(self):
+        calls = []
+        def resolver(key):
+            calls.append(key)
+            time.sleep(0.02)
+            return -key
+        d = ConcurrentLazyDict()
+        d.add_keyspace(range(1000000), resolver)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda i: d[7], range(8)))
+        self.assertEqual(results, [-7] * 8)
+        self.assertEqual(calls, [7])
+        self.assertEqual(len(d), 1000000)
+        d[8] = 'x'
+        self.assertEqual((len(d), d[8]), (1000000, 'x'))
+
+    def test_resolve_budget(self):
+        def load(key):
+            time.sleep(0.05)
+            return key
+        d = ConcurrentLazyDict()
+        for key in 'abc':
+            d.set_stub(key, load)
+        d.set_cost('a', 10)
+        ranks = {'a': 1, 'b': 3, 'c': 2}
+        report = d.resolve(budget=1, priority=lambda key, stub: ranks[key])
+        self.assertEqual(report.resolved, ['b', 'c'])
+        self.assertEqual(report.pending, ['a'])
+        self.assertGreater(d._cost_model.estimate(load), 0.04)
+
+    def test_resolve_async(self):
+        calls = []
+        release = threading.Event()
+        def load(key):
+            calls.append(key)
+            if key == 0:
+                release.wait()
+            else:
+                time.sleep(0.005)
+            return -key
+        d = ConcurrentLazyDict()
+        for key in range(20):
+            d.set_stub(key, load)
+        warmup = d.resolve_async(max_workers=2)
+        self.assertIsInstance(warmup, WarmUp)
+        self.assertEqual(warmup.progress()[1], 20)
+        # not started yet, resolved by the lookup at once
+        self.assertEqual(d[19], -19)
+        threading.Timer(0.05, release.set).start()
+        # in flight, the lookup waits for it
+        self.assertEqual(d[0], 0)
+        self.assertTrue(warmup.wait(5))
+        self.assertTrue(warmup.done())
+        self.assertEqual(warmup.progress(), (20, 20))
+        self.assertEqual(sorted(calls), list(range(20)))
+        self.assertEqual(d._stubs, {})
+
+    def test_resolve_async_cancel(self):
+        started = threading.Event()
+        release = threading.Event()
+        def load(key):
+            started.set()
+            release.wait()
+            return key
+        fetch = BatchResolver(lambda keys: dict((k, k) for k in keys
+                                                if k != 'y'), chunk_size=2)
+        d = ConcurrentLazyDict()
+        for key in range(10):
+            d.set_stub(key, load)
+        warmup = d.resolve_async(max_workers=1)
+        self.assertTrue(started.wait(5))
+        warmup.cancel()
+        release.set()
+        self.assertTrue(warmup.wait(5))
+        self.assertTrue(warmup.cancelled())
+        self.assertEqual(warmup.progress(), (1, 10))
+        self.assertEqual(len(d._stubs), 9)
+
+        d = ConcurrentLazyDict()
+        for key in 'xyz':
+            d.set_stub(key, fetch)
+        d.set_stub('fail', lambda key: 1 / 0)
+        warmup = d.resolve_async()
+        self.assertTrue(warmup.wait(5))
+        self.assertEqual(sorted(warmup.failed), ['fail', 'y'])
+        self.assertIsInstance(warmup.failed['y'], KeyError)
+        self.assertEqual(sorted(d._stubs), ['fail', 'y'])
+        self.assertEqual((d['x'], d['z']), ('x', 'z'))
+        self.assertTrue(d.resolve_async().wait(5))
+
+if __name__ == '__main__':
+    unittest.main()
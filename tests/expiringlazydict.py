@@ -0,0 +1,191 @@
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from lazydict import FailurePolicy, MemoCache
+from expiringlazydict import ExpiringLazyDict
+
+class ExpiringLazyDictTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.calls = []
+
+    def make(self):
+        d = ExpiringLazyDict({'real': 0})
+        d.clock = lambda: self.now
+        return d
+
+    def resolver(self, key):
+        self.calls.append(key)
+        return (key, len(self.calls))
+
+    def test_no_ttl(self):
+        d = self.make()
+        d.set_stub('a', self.resolver)
+        self.assertEqual(d['a'], ('a', 1))
+        self.now = 1000
+        self.assertEqual(d['a'], ('a', 1))
+        self.assertEqual(d['real'], 0)
+
+    def test_dict_ttl(self):
+        d = self.make()
+        d.set_ttl(10)
+        d.set_stub('a', self.resolver)
+        self.assertEqual(d['a'], ('a', 1))
+        self.now = 9
+        self.assertEqual(d['a'], ('a', 1))
+        self.now = 10
+        self.assertEqual(d['a'], ('a', 2))
+        self.assertEqual(d.get('a'), ('a', 2))
+        self.now = 25
+        self.assertEqual(dict(d.items()), {'real': 0, 'a': ('a', 3)})
+        self.assertEqual(len(d), 2)
+
+    def test_stub_ttl(self):
+        d = self.make()
+        d.set_ttl(10)
+        d.set_stub('a', self.resolver)
+        d.set_stub('b', self.resolver)
+        d.set_stub_ttl('b', None)
+        d.set_stub_ttl('a', 100)
+        d['a'], d['b']
+        self.now = 50
+        self.assertEqual(d['a'], ('a', 1))
+        self.assertEqual(d['b'], ('b', 2))
+        self.now = 100
+        self.assertEqual(d['a'], ('a', 3))
+        d.expire('b')
+        self.assertEqual(d['b'], ('b', 4))
+
+    def test_explicit_values_do_not_expire(self):
+        d = self.make()
+        d.set_ttl(1)
+        d.set_stub('a', self.resolver)
+        d['a']
+        d['a'] = 'explicit'
+        self.now = 10
+        self.assertEqual(d['a'], 'explicit')
+        d.set_stub('a', self.resolver)
+        self.assertEqual(d['a'], ('a', 2))
+        del d['a']
+        self.assertEqual(d._origins, {})
+
+    def test_failed_refresh(self):
+        d = self.make()
+        d.set_ttl(1)
+        fail = []
+        def resolver(key):
+            if fail:
+                raise ValueError(key)
+            return key
+        d.set_stub('a', resolver)
+        d['a']
+        fail.append(True)
+        self.now = 5
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        fail.pop()
+        self.assertEqual(d['a'], 'a')
+
+    def test_stale_while_revalidate(self):
+        release = threading.Event()
+        def resolver(key):
+            self.calls.append(key)
+            if len(self.calls) > 1:
+                release.wait(5)
+            return len(self.calls)
+        d = self.make()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            d.set_ttl(10, stale_while_revalidate=True, executor=executor)
+            d.set_stub('a', resolver)
+            self.assertEqual(d['a'], 1)
+            self.now = 20
+            self.assertEqual(d['a'], 1)
+            self.assertEqual(d['a'], 1)
+            self.assertEqual(d._refreshing, {'a'})
+            release.set()
+        self.assertEqual(d['a'], 2)
+        self.assertEqual(self.calls, ['a', 'a'])
+
+    def test_stale_while_revalidate_failure(self):
+        fail = []
+        def resolver(key):
+            self.calls.append(key)
+            if fail:
+                raise ValueError(key)
+            return len(self.calls)
+        d = self.make()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            d.set_ttl(10, stale_while_revalidate=True, executor=executor,
+                      retry=5)
+            d.set_stub('a', resolver)
+            d['a']
+            fail.append(True)
+            self.now = 20
+            self.assertEqual(d['a'], 1)
+            executor.submit(lambda: None).result()
+            self.assertEqual(d._refreshing, set())
+            # the failed refresh is not retried until the delay is over
+            self.assertEqual(d['a'], 1)
+            self.now = 24
+            self.assertEqual(d['a'], 1)
+            self.assertEqual(self.calls, ['a', 'a'])
+            fail.pop()
+            self.now = 25
+            self.assertEqual(d['a'], 1)
+        self.assertEqual(d['a'], 3)
+        self.assertEqual(self.calls, ['a', 'a', 'a'])
+
+    def test_refresh_hooks(self):
+        fail = []
+        def resolver(key):
+            self.calls.append(key)
+            if fail:
+                raise ValueError(key)
+            return key
+        d = self.make()
+        d.set_ttl(10)
+        d.set_memo(MemoCache())
+        d.set_stub('a', resolver)
+        d['a']
+        self.now = 10
+        self.assertEqual(d['a'], 'a')
+        self.assertEqual(d._memo.stats()['hits'], 1)
+        self.assertEqual(self.calls, ['a'])
+
+        d = self.make()
+        d.set_ttl(10)
+        d.set_failure_policy(FailurePolicy(negative_ttl=100))
+        d.set_stub('a', resolver)
+        d['a']
+        fail.append(True)
+        self.now = 20
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        self.assertEqual(self.calls, ['a', 'a', 'a'])
+
+    def test_stale_while_revalidate_thread(self):
+        d = self.make()
+        d.set_ttl(10, stale_while_revalidate=True)
+        d.set_stub('a', self.resolver)
+        d['a']
+        self.now = 20
+        self.assertEqual(d['a'], ('a', 1))
+        for i in range(500):
+            if not d._refreshing:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(d['a'], ('a', 2))
+
+    def test_copy(self):
+        d = self.make()
+        d.set_ttl(10)
+        d.set_stub('a', self.resolver)
+        d['a']
+        x = d.copy()
+        x.clock = d.clock
+        self.now = 10
+        self.assertEqual(x['a'], ('a', 2))
+        self.assertEqual(d['a'], ('a', 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,21 @@
 import unittest
-
-from lazydict import LazyDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import json
+import pickle
+import threading
+import time
+import traceback
+import tracemalloc
+from array import array
+from itertools import islice
+try:
+    from io import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+from lazydict import LazyDict, LazyDictDebug, LatencyHistogram, BatchResolver, \
+    Stub, FailurePolicy, CircuitOpenError, LazyOverlay, MemoCache, CostModel
 
 class LazyDictTestCase(unittest.TestCase):
     def test_constructor(self):
@@ -662,5 +677,1052 @@ class LazyDictTestCase(unittest.TestCase):
         self.assertEqual(len(d), 1)
         self.assertRaises(KeyError, d.__getitem__, '1')
 
+    def test_lazy_batch_resolve(self):
+        calls = []
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k * 2) for k in keys)
+        batch = BatchResolver(fetch)
+        d = LazyDict({'a': 1})
+        for i in range(5):
+            d.set_stub(i, batch)
+        d.set_stub('b', lambda x: x)
+        self.assertEqual(len(d), 7)
+        self.assertEqual(d[3], 6)
+        self.assertEqual(calls, [[3]])
+        self.assertEqual(set(d.values()), {1, 'b', 0, 2, 4, 6, 8})
+        self.assertEqual(calls, [[3], [0, 1, 2, 4]])
+        self.assertEqual(len(d._stubs), 0)
+
+    def test_lazy_batch_chunks(self):
+        calls = []
+        def fetch(keys):
+            calls.append(len(keys))
+            return dict((k, k) for k in keys)
+        d = LazyDict()
+        batch = BatchResolver(fetch, chunk_size=3)
+        for i in range(7):
+            d.set_stub(i, batch)
+        d.resolve()
+        self.assertEqual(sorted(calls), [1, 3, 3])
+        self.assertEqual(dict(d.items()), dict((i, i) for i in range(7)))
+
+    def test_lazy_batch_args(self):
+        batch = BatchResolver(lambda keys: dict((k, k) for k in keys))
+        d = LazyDict({'a': 1})
+        self.assertRaises(TypeError, d.set_stub, 'a', batch, 'extra')
+        self.assertRaises(TypeError, d.set_stub, 'a', batch, extra=1)
+        self.assertRaises(TypeError, d.add_keyspace, range(3), batch, 'extra')
+        self.assertEqual(dict(d.items()), {'a': 1})
+        d.set_resolver(batch)
+        self.assertRaises(TypeError, d.set_stub, 'b', None, 'extra')
+        d.set_stub('b')
+        self.assertEqual(d['b'], 'b')
+
+    def test_lazy_batch_get_many(self):
+        calls = []
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k) for k in keys if k != 'missing')
+        batch = BatchResolver(fetch)
+        d = LazyDict({'a': 1})
+        d.set_stub('b', batch)
+        d.set_stub('c', batch)
+        d.set_stub('d', batch)
+        self.assertEqual(d.get_many(['a', 'b', 'c', 'x'], 0),
+                         {'a': 1, 'b': 'b', 'c': 'c', 'x': 0})
+        self.assertEqual(calls, [['b', 'c']])
+        self.assertEqual(list(d._stubs), ['d'])
+
+        d.set_stub('missing', batch)
+        self.assertRaises(KeyError, d.get_many, ['d', 'missing'])
+        self.assertEqual(d['d'], 'd')
+        self.assertIn('missing', d._stubs)
+
+    def test_lazy_resolve_executor(self):
+        d = LazyDict({'a': 1})
+        for i in range(20):
+            d.set_stub(i, lambda x: x * 2)
+        d.set_stub('b', BatchResolver(lambda keys: dict((k, k) for k in keys)))
+        report = d.resolve(executor=ThreadPoolExecutor, max_workers=4)
+        self.assertEqual(len(report.resolved), 21)
+        self.assertEqual(report.failed, {})
+        self.assertEqual(len(d._stubs), 0)
+        self.assertEqual(dict.__getitem__(d, 7), 14)
+        self.assertEqual(dict.__getitem__(d, 'b'), 'b')
+
+        d = LazyDict()
+        d.set_stub(4, pow, 2)
+        d.set_stub(3, pow, 3)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            d.resolve(executor=executor)
+        self.assertEqual(dict(d), {4: 16, 3: 27})
+
+    def test_lazy_resolve_errors(self):
+        def r(key):
+            if key % 3 == 0:
+                raise ValueError(key)
+            return key
+        d = LazyDict()
+        for i in range(9):
+            d.set_stub(i, r)
+        report = d.resolve(executor=ThreadPoolExecutor, errors='collect')
+        self.assertEqual(sorted(report.failed), [0, 3, 6])
+        self.assertTrue(isinstance(report.failed[3], ValueError))
+        self.assertEqual(sorted(d._stubs), [0, 3, 6])
+        self.assertEqual(len(d), 9)
+
+        report = d.resolve(errors='collect')
+        self.assertEqual(sorted(report.failed), [0, 3, 6])
+        self.assertRaises(ValueError, d.resolve)
+        self.assertRaises(ValueError, d.resolve, ThreadPoolExecutor())
+        self.assertEqual(sorted(d._stubs), [0, 3, 6])
+        self.assertRaises(ValueError, d.resolve, errors='ignore')
+
+    def test_lazy_items_incremental(self):
+        calls = []
+        def r(key):
+            calls.append(key)
+            return key
+        d = LazyDict({'a': 'a'})
+        for i in range(100):
+            d.set_stub(i, r)
+        for n, (k, v) in enumerate(d.items()):
+            self.assertEqual(k, v)
+            if n == 3:
+                break
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(len(d._stubs), 97)
+        values = iter(d.values())
+        self.assertEqual(next(values), 'a')
+        self.assertEqual(len(calls), 3)
+
+    def test_lazy_items_incremental_batch(self):
+        calls = []
+        def fetch(keys):
+            calls.append(list(keys))
+            return dict((k, -k) for k in keys)
+        d = LazyDict()
+        batch = BatchResolver(fetch, chunk_size=4)
+        for i in range(10):
+            d.set_stub(i, batch)
+        items = iter(d.items())
+        self.assertEqual(next(items), (0, 0))
+        self.assertEqual(calls, [[0, 1, 2, 3]])
+        self.assertEqual(dict(items), dict((i, -i) for i in range(1, 10)))
+        self.assertEqual(calls, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_lazy_items_mutation(self):
+        d = LazyDict({'a': 1})
+        d.set_stub('b', lambda x: x)
+        d.set_stub('c', lambda x: x)
+        def mutate(d, change):
+            for k, v in d.items():
+                change(d)
+        self.assertRaises(RuntimeError, mutate, d, lambda d: d.set_stub('x', len))
+        self.assertRaises(RuntimeError, mutate, d, lambda d: d.pop('c', None))
+        d = LazyDict({'a': 1})
+        d.set_stub('b', lambda x: x)
+        # resolving or overwriting values does not change the size
+        for k, v in d.items():
+            d['a'] = 2
+            d['b']
+        self.assertEqual(d, {'a': 2, 'b': 'b'})
+
+    def test_lazy_eq(self):
+        calls = []
+        def r(key, offset=''):
+            calls.append(key)
+            return key + offset
+        d = LazyDict({'a': 'a'})
+        d.set_stub('b', r)
+        d.set_stub('c', r)
+        self.assertFalse(d == {'a': 'a', 'b': 'b'})
+        self.assertFalse(d == {'a': 'a', 'b': 'b', 'x': 'c'})
+        self.assertFalse(d == {'a': 'x', 'b': 'b', 'c': 'c'})
+        self.assertTrue(d != {'a': 'x', 'b': 'b', 'c': 'c'})
+        self.assertEqual(calls, [])
+        self.assertFalse(d == {'a': 'a', 'b': 'x', 'c': 'c'})
+        self.assertEqual(calls, ['b'])
+        self.assertTrue(d == {'a': 'a', 'b': 'b', 'c': 'c'})
+        self.assertFalse(d != {'a': 'a', 'b': 'b', 'c': 'c'})
+        self.assertTrue({'a': 'a', 'b': 'b', 'c': 'c'} == d)
+        self.assertEqual(calls, ['b', 'c'])
+        self.assertFalse(d == [1, 2, 3])
+
+    def test_lazy_eq_identical_stubs(self):
+        calls = []
+        def r(key, offset=''):
+            calls.append(key)
+            return key + offset
+        d = LazyDict({'a': 'a'})
+        d.set_stub('b', r, offset='!')
+        d.set_stub('c', r)
+        x = d.copy()
+        self.assertTrue(d == x)
+        self.assertEqual(calls, [])
+        x.set_stub('b', r, offset='!')
+        self.assertTrue(d == x)
+        self.assertEqual(calls, [])
+        x.set_stub('c', r, offset='?')
+        self.assertFalse(d == x)
+        self.assertEqual(calls, ['c', 'c'])
+        x['c'] = 'c'
+        self.assertTrue(d == x)
+        self.assertEqual(len(d._stubs), 1)
+
+    def test_lazy_eq_identical_values(self):
+        nan = float('nan')
+        self.assertTrue(LazyDict({'a': nan}) == {'a': nan})
+        self.assertFalse(LazyDict({'a': nan}) == {'a': float('nan')})
+        d = LazyDict()
+        d.set_stub('a', lambda key: nan)
+        self.assertTrue(d == {'a': nan})
+        self.assertFalse(d != {'a': nan})
+
+    def test_debug_stats(self):
+        d = LazyDictDebug({'a': 1})
+        d.set_stub('b', lambda x: x)
+        d.set_stub('c', lambda x: x)
+        d.set_stub('d', lambda x: x)
+        self.assertEqual(d['b'], 'b')
+        self.assertEqual(d['b'], 'b')
+        self.assertEqual(d['a'], 1)
+        self.assertRaises(KeyError, d.__getitem__, 'x')
+        self.assertEqual(d.get('c'), 'c')
+        d.resolve()
+        stats = d.stats
+        self.assertEqual(stats['stubs'], 3)
+        self.assertEqual(stats['resolved'], 3)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['sweeps'], 1)
+        self.assertEqual(set(d.timers), {'b', 'c', 'd'})
+        self.assertEqual(d.timers['b'].count, 1)
+
+    def test_debug_triggers(self):
+        def r(key):
+            return key
+        d = LazyDictDebug()
+        for key in 'abcdef':
+            d.set_stub(key, r)
+        d['a']
+        d.get('b')
+        d.pop('c')
+        for k, v in d.items():
+            if k == 'd':
+                break
+        self.assertFalse(d == {})
+        self.assertFalse(d == {'a': 'a', 'b': 'b', 'd': 'd', 'e': 0, 'f': 0})
+        d.resolve()
+        apis = dict((api, count) for (api, site), count in d.triggers.items())
+        self.assertEqual(apis, {'__getitem__': 1, 'get': 1, 'pop': 1,
+                                'items': 1, '__eq__': 1, 'resolve': 1})
+        for api, site in d.triggers:
+            self.assertTrue(site.startswith(__file__.rstrip('c')), site)
+        name = [n for n in d.resolver_timers if n.endswith('.r')]
+        self.assertEqual(len(name), 1)
+        self.assertEqual(d.resolver_timers[name[0]].count, 6)
+
+    def test_debug_sampling(self):
+        d = LazyDictDebug()
+        d.set_sampling(3)
+        for i in range(9):
+            d.set_stub(i, lambda x: x)
+        d.resolve()
+        self.assertEqual(d.stats['resolved'], 9)
+        self.assertEqual(d.stats['sampled'], 3)
+        self.assertEqual(len(d.timers), 3)
+        self.assertEqual(sum(d.triggers.values()), 3)
+
+    def test_debug_batch(self):
+        d = LazyDictDebug()
+        batch = BatchResolver(lambda keys: dict((k, k) for k in keys))
+        for i in range(4):
+            d.set_stub(i, batch)
+        self.assertEqual(d.get_many([0, 1]), {0: 0, 1: 1})
+        self.assertEqual([api for api, site in d.triggers], ['get_many'])
+        self.assertEqual(list(d.triggers.values()), [2])
+        self.assertEqual(len(d.timers), 2)
+        self.assertEqual(sum(h.count for h in d.resolver_timers.values()), 1)
+
+    def test_debug_executor(self):
+        d = LazyDictDebug()
+        batch = BatchResolver(lambda keys: dict((k, k) for k in keys))
+        for i in range(4):
+            d.set_stub(i, batch)
+        d.set_stub('a', lambda x: x)
+        d.resolve(executor=ThreadPoolExecutor)
+        self.assertEqual(d.stats['resolved'], 5)
+        self.assertEqual(d.stats['sampled'], 2)
+        self.assertEqual(sorted(d.timers, key=str), [0, 1, 2, 3, 'a'])
+        self.assertEqual([api for api, site in d.triggers], ['resolve'])
+        self.assertEqual(list(d.triggers.values()), [5])
+        self.assertEqual(sum(h.count for h in d.resolver_timers.values()), 2)
+
+    def test_debug_report(self):
+        d = LazyDictDebug()
+        d.set_stub('a', lambda x: x)
+        d['a']
+        out = StringIO()
+        d.export(out)
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['stats']['resolved'], 1)
+        self.assertEqual(report['keys'][0]['key'], repr('a'))
+        self.assertEqual(report['keys'][0]['count'], 1)
+        self.assertEqual(report['triggers'][0]['api'], '__getitem__')
+
+    def test_latency_histogram(self):
+        h = LatencyHistogram()
+        for seconds in [0.0000005, 0.00001, 0.00002, 0.001]:
+            h.add(seconds)
+        self.assertEqual(h.count, 4)
+        self.assertEqual(h.buckets, {1: 1, 16: 1, 32: 1, 1024: 1})
+        self.assertEqual(h.percentile(50), 0.000016)
+        self.assertEqual(h.percentile(100), 0.001024)
+        self.assertEqual(h.max, 0.001)
+
+    def test_lazy_compact_stubs(self):
+        calls = []
+        def r(key, table=None):
+            calls.append(key)
+            return (key, table)
+        d = LazyDict()
+        self.assertRaises(TypeError, d.set_stub, 'a')
+        d.set_resolver(r)
+        d.set_stub('a')
+        d.set_stub('b', None, table='items')
+        d.set_stub('c', None, table='items')
+        d.set_stub('d', r, 1)
+        d.set_stub('e', r, 1)
+        self.assertFalse(isinstance(d._stubs['a'], Stub))
+        self.assertIs(d._stubs['b'].keywords, d._stubs['c'].keywords)
+        self.assertIs(d._stubs['d'].args, d._stubs['e'].args)
+        x = d.copy()
+        self.assertEqual(d['a'], ('a', None))
+        self.assertEqual(d['b'], ('b', 'items'))
+        self.assertEqual(d['d'], ('d', 1))
+        self.assertEqual(x['a'], ('a', None))
+        self.assertEqual(calls, ['a', 'b', 'd', 'a'])
+        self.assertTrue(d == x)
+
+    def test_lazy_compact_stubs_interned(self):
+        d = LazyDict()
+        for i in range(3000):
+            d.set_stub(i, lambda key, n: n, i)
+        self.assertLessEqual(len(d._interned), d._intern_limit)
+        d.set_resolver(lambda key, n, table: n)
+        d.set_stub('a', None, 1, table='items')
+        d.set_stub('b', None, 1, table='items')
+        self.assertIs(d._stubs['a'].args, d._stubs['b'].args)
+        self.assertIs(d._stubs['a'].keywords, d._stubs['b'].keywords)
+        d.resolve()
+        self.assertEqual(d[2999], 2999)
+        d.clear()
+        self.assertEqual(d._interned, {})
+
+    def test_lazy_compact_stubs_interned_types(self):
+        d = LazyDict()
+        d.set_resolver(lambda key, n, x=None: (n, x))
+        for key, value in (('a', 1), ('b', True), ('c', 1.0)):
+            d.set_stub(key, None, value, x=value)
+        d.set_stub('d', None, (1,), x=(True,))
+        d.set_stub('e', None, (True,), x=(1,))
+        for key, value in (('a', 1), ('b', True), ('c', 1.0)):
+            self.assertIs(type(d[key][0]), type(value))
+            self.assertIs(type(d[key][1]), type(value))
+        self.assertIs(type(d['d'][0][0]), int)
+        self.assertIs(type(d['d'][1][0]), bool)
+        self.assertIs(type(d['e'][0][0]), bool)
+        self.assertIs(type(d['e'][1][0]), int)
+
+    def test_lazy_compact_stubs_memory(self):
+        size = 20000
+        keys = ['key%d' % i for i in range(size)]
+        tracemalloc.start()
+        plain = dict.fromkeys(keys)
+        dict_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        d = LazyDict()
+        d.set_resolver(lambda key: key)
+        tracemalloc.start()
+        for key in keys:
+            d.set_stub(key)
+        stub_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(stub_peak, dict_peak * 1.2)
+        self.assertEqual(d[keys[-1]], keys[-1])
+
+    def test_stub(self):
+        stub = Stub(pow, 2, (3,))
+        self.assertEqual(stub(), 8)
+        self.assertEqual(pickle.loads(pickle.dumps(stub))(), 8)
+        stub = Stub(lambda key, offset=0: key + offset, 2, (), {'offset': 1})
+        self.assertEqual(stub(), 3)
+
+    def dependent_dict(self, calls):
+        d = LazyDict()
+        def total(key):
+            calls.append(key)
+            return d['orders'] - d['refunds']
+        def load(key, value):
+            calls.append(key)
+            return value
+        d.set_stub('orders', load, 10)
+        d.set_stub('refunds', load, 3)
+        d.set_stub('total', total)
+        d.set_stub('other', load, 0)
+        d.set_dependencies('total', ['orders', 'refunds'])
+        return d
+
+    def test_lazy_dependencies(self):
+        calls = []
+        d = self.dependent_dict(calls)
+        d.set_stub('report', lambda key: 'total %d' % d['total'])
+        d.set_dependencies('report', ['total', 'missing'])
+        self.assertEqual(d['report'], 'total 7')
+        # only the sub-graph of report is resolved
+        self.assertEqual(calls, ['orders', 'refunds', 'total'])
+        self.assertIn('other', d._stubs)
+
+        calls = []
+        d = self.dependent_dict(calls)
+        d.set_dependencies('orders', ['other'])
+        d.resolve()
+        self.assertEqual(calls.index('other') < calls.index('orders') <
+                         calls.index('total'), True)
+        self.assertEqual(d['total'], 7)
+
+        calls = []
+        d = self.dependent_dict(calls)
+        self.assertEqual(d.get_many(['total']), {'total': 7})
+        self.assertEqual(sorted(calls), ['orders', 'refunds', 'total'])
+        self.assertEqual(d.copy()._deps, {'total': ('orders', 'refunds')})
+
+    def test_lazy_dependencies_cycle(self):
+        calls = []
+        d = self.dependent_dict(calls)
+        d.set_dependencies('orders', ['refunds'])
+        d.set_dependencies('refunds', ['total'])
+        with self.assertRaises(ValueError) as cm:
+            d['total']
+        self.assertIn("'total' -> ", str(cm.exception))
+        self.assertRaises(ValueError, d.resolve)
+        self.assertRaises(ValueError, d.resolve, ThreadPoolExecutor)
+        self.assertEqual(calls, [])
+        d.set_dependencies('refunds', [])
+        self.assertEqual(d['total'], 7)
+
+    def test_lazy_dependencies_parallel(self):
+        # orders and refunds can only pass the barrier together
+        barrier = threading.Barrier(2, timeout=5)
+        calls = []
+        d = self.dependent_dict(calls)
+        def load(key, value):
+            barrier.wait()
+            return value
+        d.set_stub('orders', load, 10)
+        d.set_stub('refunds', load, 3)
+        report = d.resolve(executor=ThreadPoolExecutor, max_workers=4)
+        self.assertEqual(d['total'], 7)
+        self.assertEqual(sorted(report.resolved),
+                         ['orders', 'other', 'refunds', 'total'])
+        self.assertGreater(report.resolved.index('total'),
+                           report.resolved.index('orders'))
+
+    def test_lazy_dependencies_errors(self):
+        def fail(key):
+            raise ValueError(key)
+        for executor in (None, ThreadPoolExecutor):
+            calls = []
+            d = self.dependent_dict(calls)
+            d.set_stub('refunds', fail)
+            d.set_stub('report', lambda key: d['total'])
+            d.set_dependencies('report', ['total'])
+            report = d.resolve(executor=executor, errors='collect')
+            self.assertEqual(sorted(report.failed),
+                             ['refunds', 'report', 'total'])
+            self.assertIs(report.failed['total'], report.failed['refunds'])
+            self.assertEqual(sorted(report.resolved), ['orders', 'other'])
+            self.assertNotIn('total', calls)
+            self.assertIn('total', d._stubs)
+            self.assertRaises(ValueError, d.resolve, executor)
+
+    def flaky(self, calls, failures):
+        def resolver(key):
+            calls.append(key)
+            if failures and failures[0] > 0:
+                failures[0] -= 1
+                raise ValueError(key)
+            return key.upper()
+        return resolver
+
+    def test_lazy_failed_stub_kept(self):
+        calls = []
+        d = LazyDict()
+        d.set_stub('a', self.flaky(calls, [1]))
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        self.assertIn('a', d)
+        self.assertEqual(len(d), 1)
+        self.assertEqual(d['a'], 'A')
+        self.assertEqual(calls, ['a', 'a'])
+        self.assertEqual(d._stubs, {})
+
+    def test_failure_policy_backoff(self):
+        now = [0.0]
+        policy = FailurePolicy(negative_ttl=1, backoff=2, max_ttl=3,
+                               threshold=100)
+        policy.clock = lambda: now[0]
+        calls = []
+        d = LazyDict()
+        d.set_failure_policy(policy)
+        d.set_stub('a', self.flaky(calls, [3]))
+        with self.assertRaises(ValueError) as cm:
+            d['a']
+        # the cached error is raised without calling the resolver
+        with self.assertRaises(ValueError) as cached:
+            d['a']
+        self.assertIs(cached.exception, cm.exception)
+        self.assertEqual(len(calls), 1)
+        # raising it again does not grow its traceback
+        depths = []
+        for i in range(100):
+            try:
+                d['a']
+            except ValueError as e:
+                depths.append(len(traceback.extract_tb(e.__traceback__)))
+        self.assertEqual(len(set(depths)), 1)
+        now[0] = 1.0
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        now[0] = 2.5
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        self.assertEqual(len(calls), 2)
+        now[0] = 3.0
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        # capped at max_ttl
+        now[0] = 6.0
+        self.assertEqual(d['a'], 'A')
+        self.assertEqual(len(calls), 4)
+        self.assertIs(policy.error('a'), None)
+
+        d.set_stub('b', self.flaky(calls, [1]))
+        self.assertRaises(ValueError, d.__getitem__, 'b')
+        d.set_stub('b', lambda key: 'new')
+        self.assertEqual(d['b'], 'new')
+
+    def test_failure_policy_circuit_breaker(self):
+        now = [0.0]
+        policy = FailurePolicy(negative_ttl=0, threshold=2, reset=10)
+        policy.clock = lambda: now[0]
+        calls = []
+        failures = [2]
+        resolver = self.flaky(calls, failures)
+        d = LazyDict()
+        d.set_failure_policy(policy)
+        for key in 'abc':
+            d.set_stub(key, resolver)
+        d.set_stub('x', lambda key: 'other')
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        self.assertRaises(ValueError, d.__getitem__, 'b')
+        self.assertRaises(CircuitOpenError, d.__getitem__, 'c')
+        self.assertEqual(d['x'], 'other')
+        self.assertEqual(calls, ['a', 'b'])
+        report = d.resolve(errors='collect')
+        self.assertEqual(sorted(report.failed), ['a', 'b', 'c'])
+        now[0] = 10.0
+        self.assertEqual(d['c'], 'C')
+        self.assertEqual(d.resolve(executor=ThreadPoolExecutor).resolved,
+                         ['a', 'b'])
+
+    def test_failure_policy_batch(self):
+        now = [0.0]
+        policy = FailurePolicy(threshold=100)
+        policy.clock = lambda: now[0]
+        calls = []
+        def fetch(keys):
+            calls.append(sorted(keys))
+            if 'bad' in keys:
+                raise ValueError(keys)
+            return dict((k, k.upper()) for k in keys)
+        batch = BatchResolver(fetch)
+        d = LazyDict()
+        d.set_failure_policy(policy)
+        d.set_stub('bad', batch)
+        self.assertRaises(ValueError, d.__getitem__, 'bad')
+        d.set_stub('a', batch)
+        d.set_stub('b', batch)
+        for executor in (None, ThreadPoolExecutor):
+            report = d.resolve(executor=executor, errors='collect')
+            self.assertEqual(list(report.failed), ['bad'])
+            self.assertIsInstance(report.failed['bad'], ValueError)
+        self.assertEqual(calls, [['bad'], ['a', 'b']])
+        self.assertEqual(d.get('a'), 'A')
+
+    def test_lazy_keyspace(self):
+        calls = []
+        def resolver(key, scale=1):
+            calls.append(key)
+            return key * scale
+        d = LazyDict({'a': 1})
+        tracemalloc.start()
+        d.add_keyspace(range(50000000), resolver, scale=2)
+        size = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        self.assertLess(size, 10000)
+        self.assertEqual(len(d), 50000001)
+        self.assertIn(49999999, d)
+        self.assertNotIn(50000000, d)
+        self.assertNotIn('b', d)
+        self.assertEqual(d[1234], 2468)
+        self.assertEqual(d.get(-1), None)
+        self.assertEqual(len(d), 50000001)
+        self.assertEqual(list(islice(d, 4)), ['a', 1234, 0, 1])
+
+        # explicit writes override single keys
+        d[5] = 'five'
+        d.set_stub(6, lambda key: 'six')
+        del d[7]
+        self.assertRaises(KeyError, d.__delitem__, 7)
+        self.assertNotIn(7, d)
+        self.assertEqual(len(d), 50000000)
+        self.assertEqual((d[5], d[6], d[8]), ('five', 'six', 16))
+        d[7] = 'seven'
+        self.assertEqual(len(d), 50000001)
+        self.assertEqual(list(islice(d, 7)), ['a', 1234, 5, 6, 8, 7, 0])
+        self.assertEqual(calls, [1234, 8])
+        x = d.copy()
+        self.assertEqual(x[9], 18)
+        self.assertNotIn(9, d._stubs)
+        d.clear()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(len(x), 50000001)
+
+    def test_lazy_keyspace_overlap(self):
+        resolver = lambda key: -key
+        d = LazyDict({5: 'x'})
+        d.set_stub(6, lambda key: 'six')
+        d.add_keyspace(range(10), resolver)
+        self.assertEqual(len(d), 10)
+        self.assertEqual(sorted(d), list(range(10)))
+        self.assertEqual((d[5], d[6], d[7]), ('x', 'six', -7))
+        del d[5]
+        del d[6]
+        self.assertNotIn(5, d)
+        self.assertNotIn(6, d)
+        self.assertEqual(len(d), 8)
+        self.assertRaises(KeyError, d.__getitem__, 5)
+        self.assertRaises(KeyError, d.__delitem__, 5)
+
+        d = LazyDict()
+        self.assertFalse(d)
+        d.add_keyspace(lambda key: key == 'p', resolver)
+        self.assertTrue(d)
+        d.add_keyspace(range(0), resolver)
+        self.assertTrue(d)
+        d = LazyDict()
+        d.add_keyspace(range(1), resolver)
+        self.assertTrue(d)
+        del d[0]
+        self.assertFalse(d)
+        self.assertFalse(d.overlay())
+        d[1] = 1
+        self.assertTrue(d.overlay())
+        o = d.overlay()
+        del o[1]
+        self.assertFalse(o)
+
+    def test_lazy_keyspace_kinds(self):
+        d = LazyDict()
+        d.set_resolver(lambda key: str(key))
+        d.add_keyspace(frozenset(['x', 'y']))
+        d.add_keyspace(array('q', [10, 20, 30]))
+        self.assertEqual(sorted(d, key=str), [10, 20, 30, 'x', 'y'])
+        self.assertNotIn(15, d)
+        self.assertNotIn(40, d)
+        self.assertEqual(d[20], '20')
+        self.assertEqual(d.get_many([10, 'x', 15]),
+                         {10: '10', 'x': 'x', 15: None})
+        report = d.resolve()
+        self.assertEqual(sorted(report.resolved, key=str), [30, 'y'])
+        self.assertEqual(dict.__len__(d), 5)
+        self.assertEqual(d, {10: '10', 20: '20', 30: '30', 'x': 'x', 'y': 'y'})
+
+        d = LazyDict()
+        d.add_keyspace(lambda key: isinstance(key, str) and
+                       key.startswith('user:'), lambda key: key[5:])
+        self.assertIn('user:bob', d)
+        self.assertNotIn('group:x', d)
+        self.assertNotIn(1, d)
+        self.assertEqual(d['user:bob'], 'bob')
+        self.assertRaises(TypeError, len, d)
+        self.assertRaises(TypeError, list, d)
+        self.assertRaises(TypeError, LazyDict().add_keyspace, range(3))
+
+    def test_lazy_keyspace_dependencies(self):
+        d = LazyDict()
+        d.add_keyspace(range(3), lambda key: key)
+        d.set_stub('sum', lambda key: d[0] + d[1] + d[2])
+        d.set_dependencies('sum', [0, 1, 2])
+        report = d.resolve(executor=ThreadPoolExecutor)
+        self.assertEqual(report.resolved[-1], 'sum')
+        self.assertEqual(d['sum'], 3)
+
+    def test_lazy_resolve_selected(self):
+        calls = []
+        def load(key, table=None):
+            calls.append(key)
+            return (key, table)
+        def other(key):
+            calls.append(key)
+            return key
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k) for k in keys)
+        batch = BatchResolver(fetch)
+        for executor in (None, ThreadPoolExecutor):
+            calls = []
+            d = LazyDict({'a': 1})
+            for key in 'bcd':
+                d.set_stub(key, load, table='items')
+            d.set_stub('e', load, table='users')
+            d.set_stub('f', other)
+            d.set_stub('g', batch)
+            d.set_stub('h', batch)
+            report = d.resolve(executor, keys=['a', 'b', 'c', 'x'])
+            self.assertEqual(sorted(report.resolved), ['b', 'c'])
+            self.assertEqual(sorted(calls), ['b', 'c'])
+            self.assertEqual(sorted(report.timings), ['b', 'c'])
+            self.assertTrue(all(t >= 0 for t in report.timings.values()))
+
+            report = d.resolve(executor, where=lambda key, stub:
+                               stub.keywords == {'table': 'users'})
+            self.assertEqual(report.resolved, ['e'])
+            report = d.resolve(executor, resolver=batch)
+            self.assertEqual(sorted(report.resolved), ['g', 'h'])
+            self.assertEqual(report.timings['g'], report.timings['h'])
+            report = d.resolve(executor, keys=['d', 'f'], resolver=load)
+            self.assertEqual(report.resolved, ['d'])
+            self.assertEqual(list(d._stubs), ['f'])
+            self.assertEqual(calls, ['b', 'c', 'e', ['g', 'h'], 'd'])
+
+    def test_lazy_resolve_timings(self):
+        def fail(key):
+            raise ValueError(key)
+        d = LazyDict()
+        d.set_stub('a', fail)
+        d.set_stub('b', lambda key: key)
+        for executor in (None, ThreadPoolExecutor):
+            report = d.resolve(executor, errors='collect')
+            self.assertEqual(sorted(report.timings), ['a', 'b'])
+            self.assertEqual(list(report.failed), ['a'])
+            d.set_stub('b', lambda key: key)
+
+    def test_lazy_overlay(self):
+        calls = []
+        def load(key):
+            calls.append(key)
+            return key * 2
+        d = LazyDict({'a': 1})
+        for key in 'bcd':
+            d.set_stub(key, load)
+        x = d.overlay()
+        y = d.overlay()
+        self.assertIsInstance(x, LazyOverlay)
+        self.assertEqual(len(x), 4)
+        self.assertEqual(x['b'], 'bb')
+        self.assertEqual(y['b'], 'bb')
+        self.assertEqual(d['b'], 'bb')
+        self.assertEqual(calls, ['b'])
+        self.assertFalse(dict.__contains__(x, 'b'))
+
+        x['a'] = 2
+        x['e'] = 5
+        del x['c']
+        x.set_stub('d', lambda key: 'local')
+        self.assertEqual(d['a'], 1)
+        self.assertEqual(y['a'], 1)
+        self.assertNotIn('c', x)
+        self.assertIn('c', y)
+        self.assertRaises(KeyError, x.__getitem__, 'c')
+        self.assertRaises(KeyError, x.__delitem__, 'c')
+        self.assertEqual(sorted(x), ['a', 'b', 'd', 'e'])
+        self.assertEqual(len(x), 4)
+        self.assertEqual(x['d'], 'local')
+        self.assertEqual(y['d'], 'dd')
+        self.assertEqual(calls, ['b', 'd'])
+        self.assertEqual(dict(x.items()),
+                         {'a': 2, 'b': 'bb', 'd': 'local', 'e': 5})
+        del x['a']
+        self.assertNotIn('a', x)
+        self.assertEqual(len(x), 3)
+
+        d['f'] = 6
+        self.assertEqual(x['f'], 6)
+        z = x.overlay()
+        z['b'] = 0
+        self.assertEqual(x['b'], 'bb')
+        self.assertEqual(sorted(z), ['b', 'd', 'e', 'f'])
+        c = x.copy()
+        c['g'] = 7
+        self.assertNotIn('g', x)
+        self.assertEqual(c['b'], 'bb')
+        self.assertEqual(sorted(c), ['b', 'd', 'e', 'f', 'g'])
+        x.add_keyspace(range(3), lambda key: -key)
+        x.set_cost(0, 5)
+        c = x.copy()
+        self.assertIsInstance(c, LazyOverlay)
+        self.assertEqual(len(c), len(x))
+        self.assertEqual(c[2], -2)
+        self.assertNotIn(2, x._shadowed)
+        self.assertEqual(c._costs, {0: 5})
+        self.assertIs(c._cost_model, x._cost_model)
+        x.clear()
+        self.assertEqual(len(x), 0)
+        self.assertEqual(len(d), 5)
+
+    def test_lazy_overlay_resolve(self):
+        calls = []
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k) for k in keys)
+        batch = BatchResolver(fetch)
+        d = LazyDict()
+        for key in 'abc':
+            d.set_stub(key, batch)
+        x = d.overlay()
+        x.set_stub('b', lambda key: 'local')
+        x.set_stub('e', lambda key: 'local')
+        self.assertEqual(x.get_many(['a', 'c']), {'a': 'a', 'c': 'c'})
+        self.assertEqual(calls, [['a', 'c']])
+        self.assertEqual(list(d._stubs), ['b'])
+        report = x.resolve()
+        self.assertEqual(sorted(report.resolved), ['b', 'e'])
+        self.assertEqual(list(d._stubs), ['b'])
+        report = d.overlay().resolve()
+        self.assertEqual(report.resolved, ['b'])
+        self.assertEqual(calls, [['a', 'c'], ['b']])
+
+    def test_memo_cache(self):
+        calls = []
+        def load(key, table=None):
+            calls.append((key, table))
+            return (key, table)
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k) for k in keys)
+        batch = BatchResolver(fetch)
+        cache = MemoCache()
+        for executor in (None, ThreadPoolExecutor, None):
+            d = LazyDict()
+            d.set_memo(cache)
+            d.set_stub('a', load, table='items')
+            d.set_stub('b', load, table='users')
+            d.set_stub('c', batch)
+            d.set_stub('d', batch)
+            d.set_stub('e', load, table=['unhashable'])
+            self.assertEqual(d['a'], ('a', 'items'))
+            self.assertEqual(d['c'], 'c')
+            d.resolve(executor)
+            self.assertEqual(dict(d), {'a': ('a', 'items'),
+                                       'b': ('b', 'users'), 'c': 'c',
+                                       'd': 'd', 'e': ('e', ['unhashable'])})
+        self.assertEqual(calls, [('a', 'items'), ['c'], ('b', 'users'),
+                                 ('e', ['unhashable']), ['d'],
+                                 ('e', ['unhashable']), ('e', ['unhashable'])])
+        stats = cache.stats()
+        self.assertEqual(stats['entries'], 4)
+        self.assertEqual((stats['hits'], stats['misses']), (8, 4))
+        self.assertAlmostEqual(stats['hit_rate'], 8 / 12.0)
+
+        d = LazyDict()
+        d.set_stub('a', load, table='other')
+        self.assertEqual(d['a'], ('a', 'other'))
+        d.set_memo(cache)
+        x = d.copy()
+        x.set_stub('a', load, table='items')
+        self.assertEqual(x['a'], ('a', 'items'))
+        self.assertEqual(len(calls), 8)
+
+    def test_memo_cache_batch_lookup(self):
+        calls = []
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k) for k in keys)
+        batch = BatchResolver(fetch)
+        cache = MemoCache()
+        d, x = LazyDict(), LazyDict()
+        for y in (d, x):
+            y.set_memo(cache)
+            y.set_stub('a', batch)
+            y.set_stub('b', batch)
+        d.resolve()
+        self.assertEqual((x['a'], x.get_many(['b'])), ('a', {'b': 'b'}))
+        self.assertEqual(calls, [['a', 'b']])
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(len(cache), 2)
+
+    def test_memo_cache_argument_types(self):
+        load = lambda key, n: (key, n)
+        cache = MemoCache()
+        for n in (1, True, 1.0):
+            d = LazyDict()
+            d.set_memo(cache)
+            d.set_stub('a', load, n)
+            self.assertIs(type(d['a'][1]), type(n))
+        self.assertEqual(len(cache), 3)
+
+    def test_memo_cache_eviction(self):
+        cache = MemoCache(max_entries=2)
+        for key in 'abc':
+            cache.set(key, key)
+        self.assertEqual(cache.get('c'), 'c')
+        self.assertRaises(KeyError, cache.get, 'a')
+        cache.get('b')
+        cache.set('d', 'd')
+        self.assertRaises(KeyError, cache.get, 'c')
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+        cache = MemoCache(max_bytes=10, sizeof=len)
+        cache.set('a', 'xxxx')
+        cache.set('b', 'xxxx')
+        self.assertEqual(cache.bytes, 8)
+        cache.set('c', 'xxxx')
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(KeyError, cache.get, 'a')
+        cache.set('d', 'x' * 20)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.bytes, 20)
+        cache.clear()
+        self.assertEqual((len(cache), cache.bytes), (0, 0))
+
+    def test_lazy_freeze(self):
+        calls = []
+        def load(key):
+            calls.append(key)
+            return key * 2
+        for executor in (None, ThreadPoolExecutor):
+            calls = []
+            d = LazyDict({'a': 1})
+            d.set_stub('b', load)
+            d.add_keyspace(range(3), load)
+            self.assertFalse(d.is_frozen())
+            d.freeze(executor)
+            self.assertTrue(d.is_frozen())
+            self.assertIsInstance(d, LazyDict)
+            self.assertEqual(type(d).__name__, 'LazyDict')
+            self.assertEqual(sorted(calls, key=str), [0, 1, 2, 'b'])
+            self.assertEqual(len(d), 5)
+            self.assertEqual(dict(d.items()),
+                             {'a': 1, 'b': 'bb', 0: 0, 1: 2, 2: 4})
+            self.assertEqual(d.get(1), 2)
+            self.assertIn(2, d)
+            self.assertNotIn(3, d)
+            self.assertRaises(KeyError, d.__getitem__, 3)
+            d.update(c=3)
+            self.assertEqual(d.setdefault('c', 4), 3)
+            self.assertEqual(d.pop('c'), 3)
+            del d[0]
+            self.assertEqual(sorted(d, key=str), [1, 2, 'a', 'b'])
+            self.assertEqual(d, {'a': 1, 'b': 'bb', 1: 2, 2: 4})
+            x = d.copy()
+            self.assertTrue(x.is_frozen())
+            y = pickle.loads(pickle.dumps(d))
+            self.assertEqual(y, d)
+            self.assertTrue(y.is_frozen())
+
+            d.set_stub('c', load)
+            self.assertFalse(d.is_frozen())
+            self.assertIs(type(d), LazyDict)
+            self.assertEqual(len(d), 5)
+            self.assertEqual(d['c'], 'cc')
+            self.assertEqual(calls[-1], 'c')
+            self.assertTrue(x.is_frozen())
+            x.add_keyspace(range(5, 7), load)
+            self.assertEqual(len(x), 6)
+            self.assertEqual(x[6], 12)
+
+    def test_lazy_freeze_errors(self):
+        def fail(key):
+            raise ValueError(key)
+        d = LazyDict()
+        d.set_stub('a', fail)
+        self.assertRaises(ValueError, d.freeze)
+        self.assertFalse(d.is_frozen())
+        self.assertRaises(TypeError, LazyDictDebug().freeze)
+        self.assertRaises(TypeError, d.overlay().freeze)
+        d.add_keyspace(lambda key: True, fail)
+        self.assertRaises(TypeError, d.freeze)
+
+    def test_lazy_resolve_budget(self):
+        calls = []
+        def load(key):
+            calls.append(key)
+            time.sleep(0.05)
+            return key
+        d = LazyDict()
+        for key in 'abc':
+            d.set_stub(key, load)
+            d.set_cost(key, 0.01)
+        d.set_stub('slow', load)
+        d.set_cost('slow', 10)
+        d.set_stub('dep', load)
+        d.set_dependencies('dep', ['a'])
+        ranks = {'a': 1, 'b': 2, 'c': 3}
+        report = d.resolve(budget=0.08,
+                           priority=lambda key, stub: ranks.get(key, 1))
+        self.assertEqual(calls, ['c', 'b'])
+        self.assertEqual(report.resolved, ['c', 'b'])
+        self.assertEqual(sorted(report.pending), ['a', 'dep', 'slow'])
+        self.assertGreater(d._cost_model.estimate(load), 0.04)
+
+        report = d.resolve(budget=0.08, keys=['a', 'dep', 'slow'])
+        self.assertEqual(report.resolved, ['a'])
+        self.assertEqual(sorted(report.pending), ['dep', 'slow'])
+        report = d.resolve(budget=0)
+        self.assertEqual(report.resolved, [])
+        self.assertEqual(sorted(report.pending), ['dep', 'slow'])
+        self.assertEqual(sorted(d.resolve().resolved), ['dep', 'slow'])
+        self.assertEqual(d.resolve(budget=1).pending, [])
+
+    def test_lazy_resolve_budget_parallel(self):
+        def load(key):
+            time.sleep(0.05)
+            return key
+        d = LazyDict()
+        for key in 'abcd':
+            d.set_stub(key, load)
+        ranks = {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            report = d.resolve(executor, budget=0.08,
+                               priority=lambda key, stub: ranks[key])
+        self.assertEqual(report.resolved, ['d', 'c'])
+        self.assertEqual(sorted(report.pending), ['a', 'b'])
+        self.assertEqual(sorted(d._stubs), ['a', 'b'])
+
+        x = d.overlay()
+        x.set_stub('e', load)
+        report = x.resolve(budget=0.5)
+        self.assertEqual(sorted(report.resolved), ['a', 'b', 'e'])
+        self.assertEqual(report.pending, [])
+
+    def test_cost_model(self):
+        model = CostModel(default=0.5, alpha=0.5)
+        self.assertEqual(model.estimate(len), 0.5)
+        model.observe(len, 1.0)
+        self.assertEqual(model.estimate(len), 1.0)
+        model.observe(len, 2.0)
+        self.assertEqual(model.estimate(len), 1.5)
+
+        d = LazyDict()
+        d.set_cost_model(model)
+        d.set_stub('a', lambda key: key)
+        fetch = BatchResolver(lambda keys: dict((k, k) for k in keys))
+        d.set_stub('b', fetch)
+        d.set_stub('c', fetch)
+        self.assertEqual(d['a'], 'a')
+        d.resolve(ThreadPoolExecutor)
+        self.assertLess(model.estimate(fetch), 0.5)
+        self.assertEqual(len(model._estimates), 3)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,263 @@
+import json
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from lazydict import LazyDict, LazyDictDebug, BatchResolver
+from lazystore import SqliteStore, SharedMemoryStore, shared_memory
+
+class SqliteStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.db')
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def resolver(self, key):
+        self.calls.append(key)
+        return {'key': key}
+
+    def test_store(self):
+        store = SqliteStore(self.path)
+        self.assertRaises(KeyError, store.get, 'a')
+        store.set('a', [1, 2])
+        store.set(('t', 1), None)
+        self.assertEqual(store.get('a'), [1, 2])
+        self.assertIs(store.get(('t', 1)), None)
+        self.assertIn('a', store)
+        self.assertEqual(len(store), 2)
+        store.delete('a')
+        self.assertNotIn('a', store)
+        store.clear()
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.size(), 0)
+
+    def test_lazydict_write_through(self):
+        store = SqliteStore(self.path)
+        d = LazyDict()
+        d.set_store(store)
+        d.set_stub('a', self.resolver)
+        d.set_stub('b', self.resolver)
+        self.assertEqual(d['a'], {'key': 'a'})
+        self.assertEqual(store.get('a'), {'key': 'a'})
+        store.close()
+
+        # a new process resolves from disk
+        store = SqliteStore(self.path)
+        d = LazyDict()
+        d.set_store(store)
+        d.set_stub('a', self.resolver)
+        d.set_stub('b', self.resolver)
+        self.assertEqual(d['a'], {'key': 'a'})
+        d.resolve()
+        self.assertEqual(d['b'], {'key': 'b'})
+        self.assertEqual(self.calls, ['a', 'b'])
+
+    def test_batch_and_parallel(self):
+        calls = []
+        def fetch(keys):
+            calls.append(sorted(keys))
+            return dict((k, k * 10) for k in keys)
+        store = SqliteStore(self.path)
+        store.set(1, 'stored')
+        batch = BatchResolver(fetch)
+        d = LazyDict()
+        d.set_store(store)
+        for i in range(4):
+            d.set_stub(i, batch)
+        self.assertEqual(d.get_many(range(4)),
+                         {0: 0, 1: 'stored', 2: 20, 3: 30})
+        self.assertEqual(calls, [[0, 2, 3]])
+        self.assertEqual(store.get(3), 30)
+
+        x = LazyDict()
+        x.set_store(store)
+        for i in range(6):
+            x.set_stub(i, batch)
+        report = x.resolve(executor=ThreadPoolExecutor, max_workers=2)
+        self.assertEqual(sorted(report.resolved), list(range(6)))
+        self.assertEqual(calls, [[0, 2, 3], [4, 5]])
+        self.assertEqual(dict.__getitem__(x, 1), 'stored')
+        self.assertEqual(store.get(5), 50)
+
+    def test_debug_uses_store(self):
+        store = SqliteStore(self.path)
+        store.set('a', 'stored')
+        d = LazyDictDebug()
+        d.set_store(store)
+        d.set_stub('a', self.resolver)
+        self.assertEqual(d['a'], 'stored')
+        self.assertEqual(self.calls, [])
+        self.assertEqual(d.stats['resolved'], 1)
+
+    def test_unwritable_values(self):
+        store = SqliteStore(self.path)
+        lock = threading.Lock()
+        fetch = lambda keys: dict((k, lock) for k in keys)
+        for executor in (None, ThreadPoolExecutor):
+            calls = []
+            def resolver(key):
+                calls.append(key)
+                return lock
+            d = LazyDict()
+            d.set_store(store)
+            d.set_stub('a', resolver)
+            d.set_stub('b', BatchResolver(fetch))
+            self.assertIs(d['a'], lock)
+            self.assertIs(d['a'], lock)
+            self.assertEqual(calls, ['a'])
+            d.resolve(executor)
+            self.assertIs(d['b'], lock)
+            self.assertNotIn('a', store)
+            self.assertNotIn('b', store)
+
+    def test_versions(self):
+        store = SqliteStore(self.path, namespace='users', version=1)
+        store.set('a', 1)
+        other = SqliteStore(self.path, namespace='groups', version=1)
+        other.set('a', 'group')
+        store = SqliteStore(self.path, namespace='users', version=2)
+        self.assertRaises(KeyError, store.get, 'a')
+        store.set('a', 2)
+        self.assertEqual(SqliteStore(self.path, 'users', 1).get('a'), 1)
+        store.purge()
+        self.assertRaises(KeyError, SqliteStore(self.path, 'users', 1).get, 'a')
+        self.assertEqual(store.get('a'), 2)
+        self.assertEqual(other.get('a'), 'group')
+
+    def test_serializer(self):
+        store = SqliteStore(self.path, serializer=json)
+        store.set('a', {'x': [1, 2]})
+        self.assertEqual(store.get('a'), {'x': [1, 2]})
+
+    def test_eviction(self):
+        entry = len(pickle.dumps(b'x' * 90))
+        store = SqliteStore(self.path, max_bytes=3 * entry)
+        for i in range(3):
+            store.set(i, b'x' * 90)
+        self.assertEqual(len(store), 3)
+        store.get(0)
+        store.set(3, b'x' * 90)
+        store.set(4, b'x' * 90)
+        self.assertEqual(store.size(), 3 * entry)
+        self.assertIn(0, store)
+        self.assertNotIn(1, store)
+        self.assertIn(4, store)
+
+
+def _shared_worker(prefix, lock_dir, counter, results):
+    def build(key):
+        with counter.get_lock():
+            counter.value += 1
+        return b'v' * 1000 + key.encode()
+    d = LazyDict()
+    d.set_store(SharedMemoryStore(prefix, lock_dir))
+    for key in ('a', 'b', 'c'):
+        d.set_stub(key, build)
+    d.resolve()
+    results.put(bytes(d['c'][-1:]))
+
+@unittest.skipIf(shared_memory is None, "shared memory is not available")
+class SharedMemoryStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.prefix = 'lzt%d' % os.getpid()
+        self.store = SharedMemoryStore(self.prefix, self.dir, timeout=5)
+
+    def tearDown(self):
+        self.store.clear()
+        shutil.rmtree(self.dir)
+
+    def test_store(self):
+        store = self.store
+        self.assertRaises(KeyError, store.get, 'a')
+        store.set('a', {'x': [1, 2]})
+        store.set('b', b'raw bytes')
+        store.set('c', bytearray(b'array'))
+        store.set('d', memoryview(b'view'))
+        other = SharedMemoryStore(self.prefix, self.dir)
+        self.assertEqual(other.get('a'), {'x': [1, 2]})
+        self.assertEqual(other.get('b'), b'raw bytes')
+        self.assertIs(type(other.get('b')), bytes)
+        self.assertEqual(other.get('b').decode(), 'raw bytes')
+        self.assertIs(type(other.get('c')), bytearray)
+        self.assertEqual(other.get('c'), bytearray(b'array'))
+        self.assertIs(type(other.get('d')), bytes)
+        self.assertIn('a', other)
+        store.delete('a')
+        self.assertNotIn('a', other)
+
+    @unittest.skipIf(resource is None, "resource limits are not available")
+    def test_file_descriptors(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (256, hard))
+        try:
+            d = LazyDict()
+            d.set_store(self.store)
+            for i in range(600):
+                d.set_stub(i, lambda key: (key, b'x' * key))
+            d.resolve()
+            other = LazyDict()
+            other.set_store(SharedMemoryStore(self.prefix, self.dir))
+            for i in range(600):
+                other.set_stub(i, lambda key: 1 // 0)
+            self.assertEqual(other.get_many(range(600)), dict(d.items()))
+            large = b'x' * SharedMemoryStore.zero_copy
+            for i in range(600):
+                self.store.set(('large', i), large)
+                self.assertEqual(self.store.get(('large', i))[-1:], b'x')
+            held = [self.store.get(('large', i)) for i in range(3)]
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        self.assertIsInstance(held[0], memoryview)
+        self.assertEqual(bytes(held[2]), large)
+
+    def test_claims(self):
+        store = self.store
+        other = SharedMemoryStore(self.prefix, self.dir, timeout=0.05)
+        self.assertRaises(KeyError, store.get, 'a')
+        # claimed by store, other gives up waiting
+        self.assertRaises(KeyError, other.get, 'a')
+        store.release('a')
+        self.assertRaises(KeyError, other.get, 'a')
+        other.set('a', 1)
+        self.assertEqual(store.get('a'), 1)
+
+    def test_failed_resolver_releases(self):
+        def fail(key):
+            raise ValueError(key)
+        d = LazyDict()
+        d.set_store(self.store)
+        d.set_stub('a', fail)
+        self.assertRaises(ValueError, d.__getitem__, 'a')
+        self.assertEqual(self.store._claims, {})
+
+    def test_processes_resolve_once(self):
+        context = multiprocessing.get_context('fork')
+        counter = context.Value('i', 0)
+        results = context.Queue()
+        workers = [context.Process(target=_shared_worker,
+                                   args=(self.prefix, self.dir, counter,
+                                         results))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(10)
+        self.assertEqual([results.get(timeout=1) for w in workers],
+                         [b'c'] * 4)
+        self.assertEqual(counter.value, 3)
+
+if __name__ == '__main__':
+    unittest.main()
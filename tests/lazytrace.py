@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from lazydict import BatchResolver
+from lazytrace import TraceRecorder, TracedLazyDict, read_trace, plan, main
+
+class LazyTraceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_app(self, index, lookups):
+        """
+        Traces one run of an app reading lookups from a dict of stubs
+        """
+        path = os.path.join(self.dir, 'run%d.trace' % index)
+        def load(key):
+            if key == 'slow':
+                time.sleep(0.01)
+            return key * 100
+        fetch = BatchResolver(lambda keys: dict((k, [k] * 10) for k in keys))
+        with TraceRecorder(path) as trace:
+            d = TracedLazyDict({'real': 1})
+            d.set_tracer(trace, 'app')
+            for key in ('config', 'slow', 'rare', 'never'):
+                d.set_stub(key, load)
+            d.set_stub(('batch', 1), fetch)
+            d.set_stub(('batch', 2), fetch)
+            for key in lookups:
+                d.get(key)
+        return path
+
+    def test_trace(self):
+        path = self.run_app(0, ['config', 'real', 'config', 'missing'])
+        with TraceRecorder(os.path.join(self.dir, 'other.trace')) as trace:
+            d = TracedLazyDict()
+            d.set_tracer(trace)
+            d.set_stub(1, BatchResolver(lambda keys: dict((k, k)
+                                                          for k in keys)))
+            d.set_stub(2, BatchResolver(lambda keys: {}))
+            d.resolve(errors='collect')
+            d.set_tracer(None)
+            self.assertEqual(d[1], 1)
+        events = list(read_trace(path))
+        self.assertEqual([event[:3] for event in events], [
+            ('miss', 'app', "'config'"), ('resolve', 'app', "'config'"),
+            ('hit', 'app', "'real'"), ('hit', 'app', "'config'"),
+            ('miss', 'app', "'missing'")])
+        self.assertTrue(all(event[4] is None for event in events
+                            if event[0] != 'resolve'))
+        resolved = events[1]
+        self.assertGreaterEqual(resolved[4], 0)
+        self.assertGreater(resolved[5], 0)
+        times = [event[3] for event in events]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual([event[:3] for event in read_trace(
+            os.path.join(self.dir, 'other.trace'))],
+            [('resolve', 'default', '1')])
+
+        with open(path, 'wb') as fp:
+            fp.write(b'not a trace')
+        self.assertRaises(ValueError, list, read_trace(path))
+
+    def test_trace_executor(self):
+        path = os.path.join(self.dir, 'parallel.trace')
+        with TraceRecorder(path) as trace:
+            d = TracedLazyDict()
+            d.set_tracer(trace)
+            d.set_stub('a', lambda key: key)
+            d.set_stub('b', lambda key: 1 // 0)
+            d.set_stub(1, BatchResolver(lambda keys: dict((k, k)
+                                                          for k in keys)))
+            d.resolve(executor=ThreadPoolExecutor, errors='collect')
+        self.assertEqual(sorted(event[:3] for event in read_trace(path)),
+                         [('resolve', 'default', "'a'"),
+                          ('resolve', 'default', '1')])
+
+    def test_trace_buffer(self):
+        path = os.path.join(self.dir, 'big.trace')
+        trace = TraceRecorder(path)
+        trace.buffer_events = 10
+        d = TracedLazyDict()
+        d.set_tracer(trace)
+        for key in range(50):
+            d.set_stub(key, lambda key: key)
+        for key in range(50):
+            d[key]
+            d[key]
+        self.assertGreater(os.path.getsize(path), 100)
+        trace.close()
+        trace.close()
+        events = list(read_trace(path))
+        self.assertEqual(len(events), 150)
+        self.assertEqual(sum(1 for event in events if event[0] == 'hit'), 50)
+
+    def test_trace_threads(self):
+        path = os.path.join(self.dir, 'threads.trace')
+        trace = TraceRecorder(path)
+        trace.buffer_events = 64
+        d = TracedLazyDict()
+        d.set_tracer(trace)
+        for key in range(100):
+            d[key] = key
+        def read():
+            for i in range(5):
+                for key in range(100):
+                    d[key]
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        trace.close()
+        events = list(read_trace(path))
+        self.assertEqual(len(events), 2000)
+        self.assertEqual(set(event[2] for event in events),
+                         set(repr(key) for key in range(100)))
+
+    def test_plan(self):
+        batch = [('batch', 1), ('batch', 2)]
+        paths = [
+            self.run_app(0, ['config', 'slow', 'real'] + batch),
+            self.run_app(1, ['config', 'slow', 'rare', 'config']),
+            self.run_app(2, ['config', 'rare'] + batch + ['slow']),
+            self.run_app(3, ['config', 'slow', 'config']),
+        ]
+        result = plan(paths)['app']
+        self.assertEqual(result['runs'], 4)
+        self.assertEqual(result['stubs'], 5)
+        eager = result['eager']
+        self.assertEqual(eager['keys'], ["'config'", "'slow'", "'rare'",
+                                         "('batch', 1)", "('batch', 2)"])
+        self.assertGreater(eager['startup_seconds'], 0.01)
+        self.assertGreater(eager['saved_seconds_per_run'], 0.01)
+        self.assertGreater(eager['memory_bytes'], 0)
+        self.assertEqual(result['lazy']['count'], 0)
+        self.assertEqual(result['prefetch']['order'], [])
+
+        result = plan(paths, min_share=0.75)['app']
+        self.assertEqual(result['eager']['keys'], ["'config'", "'slow'"])
+        self.assertEqual(result['lazy']['count'], 3)
+        self.assertEqual(result['prefetch']['order'],
+                         ["'rare'", "('batch', 1)", "('batch', 2)"])
+        self.assertGreater(result['lazy']['saved_memory_bytes'], 0)
+
+        cache = result['cache']
+        self.assertEqual([point['capacity'] for point in cache['curve']],
+                         [1, 2, 4, 5])
+        rates = [point['hit_rate'] for point in cache['curve']]
+        self.assertEqual(rates, sorted(rates))
+        self.assertAlmostEqual(rates[-1], 2 / 16.0)
+        self.assertEqual(cache['capacity'], 4)
+        self.assertGreater(cache['resolve_seconds_per_run'], 0.01)
+
+        out = os.path.join(self.dir, 'plan.json')
+        self.assertEqual(main(paths + ['--min-share', '0.75',
+                                       '--output', out]), 0)
+        with open(out) as fp:
+            self.assertEqual(json.load(fp)['app']['eager']['keys'],
+                             ["'config'", "'slow'"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from prefetchlazydict import PrefetchingLazyDict, Prefetcher
+
+def wait_for(predicate):
+    for i in range(500):
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+class PrefetchingLazyDictTestCase(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.threads = []
+
+    def resolver(self, key):
+        self.calls.append(key)
+        self.threads.append(threading.current_thread())
+        return key.upper()
+
+    def make(self, prefetcher, keys=('user', 'profile', 'permissions', 'other')):
+        d = PrefetchingLazyDict()
+        d.set_prefetcher(prefetcher)
+        for key in keys:
+            d.set_stub(key, self.resolver)
+        return d
+
+    def test_hints(self):
+        prefetcher = Prefetcher(hints={'user': ['profile', 'permissions']},
+                                learn=False)
+        d = self.make(prefetcher)
+        self.assertEqual(d['user'], 'USER')
+        self.assertTrue(wait_for(lambda: prefetcher.stats['completed'] == 2))
+        self.assertEqual(sorted(self.calls), ['permissions', 'profile', 'user'])
+        self.assertEqual(d['profile'], 'PROFILE')
+        self.assertEqual(d['permissions'], 'PERMISSIONS')
+        self.assertEqual(len(self.calls), 3)
+        counters = prefetcher.counters()
+        self.assertEqual(counters['hits'], 2)
+        self.assertEqual(counters['wasted'], 0)
+        self.assertEqual(counters['hit_rate'], 1.0)
+        self.assertIn('other', d._stubs)
+        prefetcher.close()
+
+    def test_learn(self):
+        prefetcher = Prefetcher(budget=1)
+        self.assertEqual(prefetcher.predict('user'), [])
+        d = self.make(prefetcher)
+        d['user']
+        d['profile']
+        self.assertEqual(prefetcher.predict('user'), ['profile'])
+        x = self.make(prefetcher)
+        x['user']
+        self.assertTrue(wait_for(lambda: prefetcher.stats['completed'] == 1))
+        self.assertNotIn('profile', x._stubs)
+        self.assertIn('permissions', x._stubs)
+        prefetcher.close()
+
+    def test_resolved_hits(self):
+        prefetcher = Prefetcher(budget=1)
+        prefetcher.max_transitions = 3
+        d = PrefetchingLazyDict(dict((key, key) for key in 'abcdef'))
+        d.set_prefetcher(prefetcher)
+        lock, prefetcher._lock = prefetcher._lock, None
+        # without stubs to prefetch, lookups do not lock
+        for key in 'ababcdef':
+            self.assertEqual(d[key], key)
+        prefetcher._lock = lock
+        self.assertLessEqual(sum(len(following) for following
+                                 in prefetcher._transitions.values()), 3)
+        self.assertEqual(prefetcher.predict('e'), ['f'])
+        prefetcher.close()
+
+    def test_threshold(self):
+        prefetcher = Prefetcher(threshold=0.5, budget=5)
+        for next_key in ['a', 'a', 'a', 'b']:
+            prefetcher._transitions.setdefault('x', {})
+            prefetcher._transitions['x'][next_key] = \
+                prefetcher._transitions['x'].get(next_key, 0) + 1
+        self.assertEqual(prefetcher.predict('x'), ['a'])
+        prefetcher.threshold = 0.1
+        self.assertEqual(prefetcher.predict('x'), ['a', 'b'])
+        prefetcher.close()
+
+    def test_cancel_and_waste(self):
+        release = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1)
+        prefetcher = Prefetcher(hints={'user': ['profile', 'permissions']},
+                                learn=False, executor=executor)
+        d = self.make(prefetcher)
+        executor.submit(release.wait, 5)
+        d['user']
+        self.assertEqual(prefetcher.stats['issued'], 2)
+        # the queued prefetches are cancelled by an unrelated lookup
+        d['other']
+        release.set()
+        executor.shutdown()
+        self.assertEqual(prefetcher.stats['cancelled'], 2)
+        self.assertEqual(sorted(self.calls), ['other', 'user'])
+        self.assertIn('profile', d._stubs)
+
+        prefetcher = Prefetcher(hints={'user': ['profile']}, learn=False)
+        d = self.make(prefetcher)
+        d['user']
+        self.assertTrue(wait_for(lambda: prefetcher.stats['completed'] == 1))
+        self.assertEqual(prefetcher.counters()['wasted'], 1)
+        prefetcher.close()
+
+    def test_single_flight_with_foreground(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        def slow(key):
+            calls.append(key)
+            started.set()
+            release.wait(5)
+            return key
+        prefetcher = Prefetcher(hints={'a': ['b']}, learn=False)
+        d = PrefetchingLazyDict({'a': 1})
+        d.set_prefetcher(prefetcher)
+        d.set_stub('b', slow)
+        d['a']
+        started.wait(5)
+        threading.Timer(0.05, release.set).start()
+        self.assertEqual(d['b'], 'b')
+        self.assertEqual(calls, ['b'])
+        prefetcher.close()
+
+if __name__ == '__main__':
+    unittest.main()
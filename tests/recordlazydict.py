@@ -0,0 +1,127 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from recordlazydict import RecordLazyDict
+
+class RecordLazyDictTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def jsonl(self, records):
+        return self.write('records.jsonl', b''.join(
+            json.dumps(r).encode('utf-8') + b'\n' for r in records))
+
+    def test_jsonl(self):
+        records = [{'id': i, 'name': 'user %d' % i} for i in range(5)]
+        path = self.jsonl(records)
+        with open(path, 'ab') as fp:
+            fp.write(b'\n')
+        d = RecordLazyDict.from_jsonl(path, key='id')
+        self.assertEqual(len(d), 5)
+        self.assertEqual(list(d), list(range(5)))
+        self.assertEqual(d[3], {'id': 3, 'name': 'user 3'})
+        self.assertEqual(len(d._stubs), 4)
+        self.assertEqual(d.get(7), None)
+        self.assertEqual(d.copy()[4], records[4])
+        self.assertEqual(d, dict((r['id'], r) for r in records))
+
+    def test_index(self):
+        path = self.jsonl([{'id': 'a', 'v': 1}, {'id': 'b', 'v': 2}])
+        d = RecordLazyDict.from_jsonl(path, key='id')
+        self.assertTrue(os.path.exists(path + '.idx'))
+
+        # the sidecar is used instead of scanning
+        scans = []
+        class Counting(RecordLazyDict):
+            def _scan(self, key):
+                scans.append(key)
+                RecordLazyDict._scan(self, key)
+        d = Counting.from_jsonl(path, key='id')
+        self.assertEqual(d['b'], {'id': 'b', 'v': 2})
+        self.assertEqual(scans, [])
+        self.assertEqual(list(d._stubs), ['a'])
+
+        # a changed file or key is scanned again
+        d = Counting.from_jsonl(path, key='v')
+        self.assertEqual(sorted(d), [1, 2])
+        with open(path, 'ab') as fp:
+            fp.write(b'{"id": "c", "v": 3}\n')
+        d = Counting.from_jsonl(path, key='id')
+        self.assertEqual(d['c']['v'], 3)
+        self.assertEqual(scans, ['v', 'id'])
+
+        index = os.path.join(self.dir, 'other.idx')
+        d = RecordLazyDict.from_jsonl(path, key=lambda r: r['v'] * 10,
+                                      index_path=index)
+        self.assertEqual(d[20], {'id': 'b', 'v': 2})
+        self.assertFalse(os.path.exists(index))
+
+    def test_stale_index(self):
+        path = self.jsonl([{'id': 'a', 'v': 1}, {'id': 2, 'v': 2}])
+        RecordLazyDict.from_jsonl(path, key='id')
+        with open(path + '.idx', 'rb') as fp:
+            saved = fp.read()
+        self.assertFalse(saved.startswith(b'\x80'))
+        for content in (pickle.dumps(['not', 'an', 'index']), b'garbage',
+                        b'[1, 2]\n', saved[:-4], saved.replace(b'"a"', b'[')):
+            with open(path + '.idx', 'wb') as fp:
+                fp.write(content)
+            d = RecordLazyDict.from_jsonl(path, key='id')
+            self.assertEqual(d, {'a': {'id': 'a', 'v': 1},
+                                 2: {'id': 2, 'v': 2}})
+        with open(path + '.idx', 'rb') as fp:
+            self.assertEqual(fp.read(), saved)
+
+    def test_csv(self):
+        path = self.write('orders.csv', b'order_id,note,total\r\n'
+                          b'o1,plain,10\r\n'
+                          b'o2,"multi\nline, ""quoted""",20\r\n'
+                          b'o3,,30\r\n')
+        for i in range(2):
+            d = RecordLazyDict.from_csv(path, key='order_id')
+            self.assertEqual(len(d), 3)
+            self.assertEqual(d['o2'], {'order_id': 'o2', 'total': '20',
+                                       'note': 'multi\nline, "quoted"'})
+            self.assertEqual(d['o3']['total'], '30')
+        path = self.write('semicolon.csv', b'id;v\n1;a\n2;b\n')
+        d = RecordLazyDict.from_csv(path, key='id', delimiter=';')
+        self.assertEqual(d['2'], {'id': '2', 'v': 'b'})
+
+    def test_resolve_in_file_order(self):
+        path = self.jsonl([{'id': i} for i in range(20)])
+        d = RecordLazyDict.from_jsonl(path, key='id', index_path=False)
+        offsets = []
+        read = d._read
+        d._read = lambda key, offset: offsets.append(offset) or \
+            read(key, offset)
+        d[5]
+        d.set_stub('extra', lambda key: 'x')
+        # stubs registered out of order are still read in file order
+        for key in (3, 1, 2):
+            offset = d._stubs.pop(key)
+            d._stubs[key] = offset
+        report = d.resolve()
+        self.assertEqual(len(report.resolved), 20)
+        self.assertEqual(len(offsets), 20)
+        self.assertEqual(offsets[1:], sorted(offsets[1:]))
+        self.assertEqual(d['extra'], 'x')
+        d = RecordLazyDict.from_jsonl(path, key='id')
+        d.resolve(executor=ThreadPoolExecutor)
+        self.assertEqual(d[19], {'id': 19})
+
+if __name__ == '__main__':
+    unittest.main()